@@ -0,0 +1,374 @@
+import os
+import json
+import math
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+import folium
+import branca.colormap as cm
+import warnings
+warnings.filterwarnings('ignore')
+
+"""
+This script contains functions to support plotting street segment (TLID) level
+data in notebooks, as an alternative to the tract choropleths of map_tracts.py.
+
+Aggregates by TLID (such as the 'segment' level of scripts/aggregate_cube.py)
+are joined to the edge geometry of a county. Because a county has hundreds of
+thousands of segments, the geometry is simplified ahead of time for several zoom
+levels: at each level, lines are simplified to about half a screen pixel, and
+segments smaller than a pixel are left out. A pixel is about 150 m at zoom 10 and
+10 m at zoom 14 (in longitude, at the equator), so at the coarser levels most
+short urban segments, and their values, are not drawn; build_levels keeps them
+with min_pixels=0. Each level is written once as a compact GeoJSON file (with
+coordinates rounded to the level's precision), and optionally as static tiles
+([[zoom]]/[[x]]/[[y]].geojson, in the usual web map tile scheme). Maps then only
+draw the level that matches the view, and the lines inside it: map_streets reads
+only the tiles that cover the requested bounds.
+"""
+
+# Zoom levels to prebuild (web map zoom: 10 shows a county, 16 a few blocks)
+ZOOM_LEVELS = [10, 12, 14, 16]
+
+TILE_PIXELS = 256
+
+LOD_DIR = "../results/street_lod/"
+
+
+def pixel_degrees(zoom):
+    """
+    Width of a screen pixel in degrees of longitude at the given zoom level
+    """
+    return 360 / (TILE_PIXELS * 2 ** zoom)
+
+
+def coordinate_decimals(zoom):
+    """
+    Number of decimals that keeps coordinates to a tenth of a pixel
+    """
+    return max(int(math.ceil(-math.log10(pixel_degrees(zoom) / 10))), 0)
+
+
+def load_edges(county_code='08031', roads_only=True):
+    """
+    Loads the edge geometry of a county from the csv-converted TIGER edges
+
+    Parameters
+    ----------
+    county_code: str
+        fips code for county
+    roads_only: bool
+        only keeps roads if true
+
+    Returns
+    -------
+    edges: gpd DataFrame
+        TLID, FULLNAME and line geometry of each edge
+    """
+    edges = pd.read_csv("../data/tiger_csv/" + county_code + "_edges.csv",
+                        usecols=['TLID', 'FULLNAME', 'ROADFLG', 'geometry'])
+    if roads_only:
+        edges = edges[edges['ROADFLG'] == 'Y']
+    return gpd.GeoDataFrame(edges[['TLID', 'FULLNAME']],
+                            geometry=gpd.GeoSeries.from_wkt(edges['geometry'].values, index=edges.index),
+                            crs='epsg:4269')
+
+
+def join_aggregates(edges, aggregates, cols=None):
+    """
+    Joins TLID-level aggregates to edge geometry
+
+    Parameters
+    ----------
+    edges: gpd DataFrame
+        output of load_edges
+    aggregates: pd DataFrame
+        indexed by TLID, such as AggregationCube.summary('segment')
+    cols: list
+        columns of aggregates to keep, all of them if None
+
+    Returns
+    -------
+    streets: gpd DataFrame
+        edges with the aggregates of their TLID, nan for edges without any
+    """
+    aggregates = aggregates if cols is None else aggregates[cols]
+    aggregates = aggregates.set_axis(pd.to_numeric(aggregates.index, errors='coerce'), axis=0)
+    streets = edges.merge(aggregates, left_on='TLID', right_index=True, how='left')
+    return gpd.GeoDataFrame(streets, geometry='geometry', crs=edges.crs)
+
+
+def build_levels(streets, zoom_levels=ZOOM_LEVELS, min_pixels=1):
+    """
+    Simplifies street geometry for each zoom level
+
+    Parameters
+    ----------
+    streets: gpd DataFrame
+        line geometry, with any columns to keep
+    zoom_levels: list
+        zoom levels to build
+    min_pixels: float
+        segments whose bounding box is smaller than this many pixels are left
+        out of a level. With the default of one pixel (about 150 m at zoom 10),
+        the coarse levels leave out most short segments; 0 keeps every segment
+        at every level.
+
+    Returns
+    -------
+    levels: dict
+        zoom level to gpd DataFrame of simplified lines
+    """
+    levels = {}
+    bounds = streets.geometry.bounds
+    size = np.maximum(bounds['maxx'] - bounds['minx'], bounds['maxy'] - bounds['miny'])
+    for zoom in zoom_levels:
+        pixel = pixel_degrees(zoom)
+        level = streets.loc[size.values >= min_pixels * pixel]
+        level = level.set_geometry(level.geometry.simplify(pixel / 2, preserve_topology=False))
+        levels[zoom] = level[~level.geometry.is_empty]
+    return levels
+
+
+def tile_xy(longitude, latitude, zoom):
+    """
+    Web map tile column and row of points at the given zoom level
+    """
+    n = 2 ** zoom
+    lat = np.radians(np.clip(latitude, -85.05, 85.05))
+    x = np.floor((np.asarray(longitude) + 180) / 360 * n).astype(int)
+    y = np.floor((1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * n).astype(int)
+    return np.clip(x, 0, n - 1), np.clip(y, 0, n - 1)
+
+
+def level_features(level, zoom):
+    """
+    GeoJSON features of a level, with coordinates rounded to its precision
+    """
+    decimals = coordinate_decimals(zoom)
+    props = level.drop(columns=level.geometry.name)
+    records = json.loads(props.to_json(orient='records'))
+    features = []
+    for geometry, properties in zip(level.geometry, records):
+        lines = geometry.geoms if hasattr(geometry, 'geoms') else [geometry]
+        coords = [np.round(np.asarray(line.coords)[:, :2], decimals).tolist() for line in lines]
+        geojson = {'type': 'LineString', 'coordinates': coords[0]} if len(coords) == 1 else \
+            {'type': 'MultiLineString', 'coordinates': coords}
+        features.append({'type': 'Feature', 'geometry': geojson, 'properties': properties})
+    return features
+
+
+def write_collection(features, path):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f, separators=(',', ':'))
+
+
+def write_levels(levels, out_dir, tiles=False):
+    """
+    Writes each level as "[[out_dir]]/[[zoom]].geojson", and optionally as tiles
+
+    Parameters
+    ----------
+    levels: dict
+        output of build_levels
+    out_dir: str
+        directory for the files
+    tiles: bool
+        if true, also writes "[[out_dir]]/[[zoom]]/[[x]]/[[y]].geojson" for every
+        tile with streets. A segment crossing tile edges is in each of its tiles.
+    """
+    for zoom, level in levels.items():
+        features = level_features(level, zoom)
+        write_collection(features, out_dir + str(zoom) + '.geojson')
+        if not tiles or level.shape[0] == 0:
+            continue
+        bounds = level.geometry.bounds
+        x0, y1 = tile_xy(bounds['minx'].values, bounds['miny'].values, zoom)
+        x1, y0 = tile_xy(bounds['maxx'].values, bounds['maxy'].values, zoom)
+        tile_features = {}
+        for i, feature in enumerate(features):
+            for x in range(x0[i], x1[i] + 1):
+                for y in range(y0[i], y1[i] + 1):
+                    tile_features.setdefault((x, y), []).append(feature)
+        for (x, y), members in tile_features.items():
+            write_collection(members, out_dir + '%d/%d/%d.geojson' % (zoom, x, y))
+
+
+def load_level(out_dir, zoom):
+    """
+    Reads a level written by write_levels
+    """
+    with open(out_dir + str(zoom) + '.geojson') as f:
+        features = json.load(f)['features']
+    return gpd.GeoDataFrame.from_features(features, crs='epsg:4269')
+
+
+def load_tiles(out_dir, zoom, bounds):
+    """
+    Reads the streets of a level inside bounds, from the tiles written by
+    write_levels
+
+    Parameters
+    ----------
+    out_dir: str
+        directory of the tiles
+    zoom: int
+        zoom level
+    bounds: tuple
+        (minx, miny, maxx, maxy) of the streets to read
+
+    Returns
+    -------
+    level: gpd DataFrame
+        the level's lines inside bounds, each segment once
+    """
+    x0, y1 = tile_xy(bounds[0], bounds[1], zoom)
+    x1, y0 = tile_xy(bounds[2], bounds[3], zoom)
+    features = {}
+    for x in range(int(x0), int(x1) + 1):
+        for y in range(int(y0), int(y1) + 1):
+            path = out_dir + '%d/%d/%d.geojson' % (zoom, x, y)
+            if os.path.exists(path):
+                with open(path) as f:
+                    # A segment crossing tile edges is in each of its tiles
+                    for feature in json.load(f)['features']:
+                        features[feature['properties']['TLID']] = feature
+    level = gpd.GeoDataFrame.from_features(list(features.values()), crs='epsg:4269')
+    if level.shape[0] == 0:
+        return level
+    return level.cx[bounds[0]:bounds[2], bounds[1]:bounds[3]]
+
+
+def tile_zooms(out_dir):
+    """
+    Zoom levels with tiles in a directory written by write_levels
+    """
+    return sorted(int(name) for name in os.listdir(out_dir) if name.isdigit() and os.path.isdir(out_dir + name))
+
+
+def prepare_county(county_code='08031', aggregates=None, cols=None, zoom_levels=ZOOM_LEVELS, tiles=False,
+                   min_pixels=1):
+    """
+    Builds and writes the levels of a county's streets, with their aggregates,
+    in "../results/street_lod/[[county_code]]/"
+
+    Returns
+    -------
+    levels: dict
+        output of build_levels
+    """
+    streets = load_edges(county_code)
+    if aggregates is not None:
+        streets = join_aggregates(streets, aggregates, cols=cols)
+    levels = build_levels(streets, zoom_levels=zoom_levels, min_pixels=min_pixels)
+    write_levels(levels, LOD_DIR + county_code + '/', tiles=tiles)
+    return levels
+
+
+def pick_level(levels, zoom):
+    """
+    The most detailed level that is not finer than the given zoom
+    """
+    available = sorted(levels)
+    coarser = [level for level in available if level <= zoom]
+    return levels[coarser[-1] if coarser else available[0]]
+
+
+def plot_streets(level, col, title='', cmap='Blues', vmin=None, vmax=None, bounds=None):
+    """
+    Creates a static map of street segments colored by an aggregate. Draws the
+    lines as a single LineCollection, which stays fast for a whole county.
+
+    Parameters
+    ----------
+    level: gpd DataFrame
+        one level of build_levels (or load_level)
+    col: str
+        column to color segments by. Segments without a value are drawn in grey.
+    title: str
+        Plot heading
+    cmap: str
+        matplotlib color map
+    vmin, vmax: float
+        range of the color map, the range of col if None
+    bounds: tuple
+        (minx, miny, maxx, maxy) to draw, the whole level if None
+    """
+    if bounds is not None:
+        level = level.cx[bounds[0]:bounds[2], bounds[1]:bounds[3]]
+    lines, values = [], []
+    for geometry, value in zip(level.geometry, level[col]):
+        for line in (geometry.geoms if hasattr(geometry, 'geoms') else [geometry]):
+            lines.append(np.asarray(line.coords)[:, :2])
+            values.append(value)
+    values = np.asarray(values, dtype=float)
+
+    fig, ax = plt.subplots(1, figsize=(10, 10))
+    collection = LineCollection(lines, cmap=cmap, linewidths=0.8)
+    collection.set_array(np.ma.masked_invalid(values))
+    collection.set_clim(vmin if vmin is not None else np.nanmin(values), vmax if vmax is not None else np.nanmax(values))
+    collection.cmap.set_bad('#cccccc')
+    ax.add_collection(collection)
+    ax.autoscale()
+    ax.set_aspect('equal')
+    fig.colorbar(collection, ax=ax, shrink=0.6)
+
+    # Get rid of the axis -- the coordinates aren't that meaningful
+    ax.axis('off')
+    ax.set_title(title, fontsize=20)
+    plt.show()
+
+
+def map_streets(levels, col, center, zoom=12, bounds=None, colors=['#deebf7', '#08519c']):
+    """
+    Creates an interactive map of street segments colored by an aggregate, using
+    the level for the given zoom. Folium embeds every drawn line in the map, so
+    only the streets inside bounds are drawn.
+
+    Parameters
+    ----------
+    levels: dict or str
+        output of build_levels, or the directory of the tiles written by
+        write_levels (such as "../results/street_lod/[[county_code]]/"), in
+        which case only the tiles covering bounds are read
+    col: str
+        column to color segments by
+    center: list
+        [latitude, longitude] of the map center, such as a COUNTY_CENTERS value
+        in map_tracts.py
+    zoom: int
+        initial zoom of the map
+    bounds: tuple
+        (minx, miny, maxx, maxy) of the streets to include. Required.
+    colors: list
+        colors of the low and high ends of the color map
+
+    Returns
+    -------
+    street_map: folium Map
+    """
+    if bounds is None:
+        raise ValueError("bounds are required, a whole county is too large to embed in one map")
+    if isinstance(levels, str):
+        coarser = [level for level in tile_zooms(levels) if level <= zoom]
+        level = load_tiles(levels, coarser[-1] if coarser else tile_zooms(levels)[0], bounds)
+    else:
+        level = pick_level(levels, zoom)
+        level = level.cx[bounds[0]:bounds[2], bounds[1]:bounds[3]]
+    level = level[['TLID', col, level.geometry.name]]
+    values = level[col].astype(float)
+    colormap = cm.LinearColormap(colors, vmin=np.nanmin(values), vmax=np.nanmax(values), caption=col)
+
+    street_map = folium.Map(location=center, zoom_start=zoom, tiles='cartodbpositron')
+    folium.GeoJson(level.to_json(na='null'),
+                   style_function=lambda feature: {
+                       'color': colormap(feature['properties'][col]) if feature['properties'][col] is not None
+                       else '#cccccc',
+                       'weight': 2},
+                   tooltip=folium.GeoJsonTooltip(fields=['TLID', col])).add_to(street_map)
+    colormap.add_to(street_map)
+    return street_map
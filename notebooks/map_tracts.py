@@ -1,6 +1,9 @@
+import os
+import json
+import pickle
+import hashlib
 import pandas as pd
 import geopandas as gpd
-import cenpy as cen
 import matplotlib.pyplot as plt
 import seaborn as sns
 import folium
@@ -10,6 +13,13 @@ warnings.filterwarnings('ignore')
 """
 This script contains functions to support plotting tract-level data in notebooks.
 See notebooks/blog.ipynb and notebooks/final_report.ipynb for implementation.
+
+Downloads are cached in CACHE_DIR, keyed on the dataset, columns, geography
+filter, map service, layer and map filter of the request, so each county is
+only downloaded once. With OFFLINE set (or offline=True), data are only served
+from the cache, and cenpy is never imported. Tests that query a LocalConnection
+pass a cache_dir of their own (such as a temporary directory), so that its data
+go through the same cache and offline paths without mixing with Census data.
 """
 
 # Define filters: tract is the spatial unit, and we will request data for 8 counties
@@ -45,7 +55,61 @@ COUNTY_CENTERS = {'Los Angeles':[34, -118],
 COLS = ['H003001','H003003']
 COLS_RENT = ['H004003','H004001']
 
-def download_merge_data(county_name='Denver', cols=[], spatial_filters=[], map_filters=[]):
+# Data sources
+DATASET = '2000sf1'
+MAPSERVICE = 'tigerWMS_ACS2014'
+TRACT_LAYER = 8
+
+CACHE_DIR = "../results/census_cache/"
+
+# If true, download_merge_data only reads from the cache
+OFFLINE = False
+
+
+class LocalConnection(object):
+    """
+    Stand-in for cenpy's Connection that serves the given tables instead of
+    querying the Census APIs, for tests and demonstrations without network access
+
+    Parameters
+    ----------
+    dem_data: pd DataFrame
+        decennial data, with state, county and tract columns
+    geodata: gpd DataFrame
+        tract geometry, with a GEOID column
+    """
+    def __init__(self, dem_data, geodata):
+        self.dem_data = dem_data
+        self.mapservice = LocalMapService(geodata)
+        self.queries = []
+
+    def query(self, cols, geo_unit='tract', geo_filter={}):
+        self.queries.append((cols, geo_unit, geo_filter))
+        return self.dem_data.copy()
+
+    def set_mapservice(self, name):
+        pass
+
+
+class LocalMapService(object):
+    def __init__(self, geodata):
+        self.geodata = geodata
+
+    def query(self, layer=TRACT_LAYER, where='', pkg='geopandas'):
+        return self.geodata.copy()
+
+
+def cache_key(cols, geo_filter, where, dataset=DATASET, mapservice=MAPSERVICE, layer=TRACT_LAYER):
+    """
+    Key of a download: a hash of everything that determines its result
+    """
+    parts = {'dataset': dataset, 'cols': list(cols), 'geo_filter': geo_filter,
+             'mapservice': mapservice, 'layer': layer, 'where': where}
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:24]
+
+
+def download_merge_data(county_name='Denver', cols=[], spatial_filters=[], map_filters=[],
+                        use_cache=True, offline=None, connection=None, cache_dir=CACHE_DIR):
     """
     Accesses 2000 decennial data and 2014 TIGER data to download tract-level
     variables specified, as well as the necessary geometry to map them.
@@ -62,6 +126,18 @@ def download_merge_data(county_name='Denver', cols=[], spatial_filters=[], map_f
         Dictionary of dictionaries containing spatial filters for decennial data
     map_filters: dict
         Dictionary of strings containing spatial filters for TIGER data
+    use_cache: bool
+        if true, reads the merged data from cache_dir when this request has
+        been downloaded before, and saves new downloads there
+    offline: bool
+        if true, only reads from the cache, raising an IOError for requests that
+        are not in it. Defaults to OFFLINE.
+    connection: object
+        connection to query instead of the 2000 Decennial Census API, such as a
+        LocalConnection
+    cache_dir: str
+        directory of the cache. Give a custom connection a directory of its own,
+        so its data are never served as Census data.
 
     Returns
     -------
@@ -70,18 +146,30 @@ def download_merge_data(county_name='Denver', cols=[], spatial_filters=[], map_f
         geometry
     """
 
+    offline = OFFLINE if offline is None else offline
+    path = os.path.join(cache_dir, cache_key(cols, spatial_filters[county_name], map_filters[county_name]) + '.pkl')
+    if (use_cache or offline) and os.path.exists(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    if offline:
+        raise IOError("No cached data for " + county_name + " county and columns " + ", ".join(cols))
+
     # Establish connection with the 2000 Decennial Census API
-    conn = cen.base.Connection('2000sf1')
+    if connection is None:
+        # cenpy is only needed for downloads
+        import cenpy as cen
+        connection = cen.base.Connection(DATASET)
+    conn = connection
 
     # Submit a query
     dem_data = conn.query(cols, geo_unit='tract',
                           geo_filter=spatial_filters[county_name])
 
     # Add a conection to get TIGER file spatial information
-    conn.set_mapservice('tigerWMS_ACS2014')
+    conn.set_mapservice(MAPSERVICE)
 
     # Submit query, requesting map data in the form of gpd DataFrame
-    geodata = conn.mapservice.query(layer=8,
+    geodata = conn.mapservice.query(layer=TRACT_LAYER,
                                     where=map_filters[county_name],
                                     pkg='geopandas')
 
@@ -93,8 +181,35 @@ def download_merge_data(county_name='Denver', cols=[], spatial_filters=[], map_f
     dem_merged = pd.merge(dem_data, geodata, left_index=True, right_on='GEOID')
     dem_merged = gpd.GeoDataFrame(dem_merged)
 
+    if use_cache:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # Write to a temporary file first, so an interrupted download never leaves a partial result
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(dem_merged, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
     return dem_merged
 
+def fill_cache(cols_list=[COLS, COLS_RENT], county_names=None, cache_dir=CACHE_DIR):
+    """
+    Downloads the data for every county in SPATIAL_FILTERS (or the given ones)
+    and column list into the cache, so that notebooks can later run offline
+
+    Parameters
+    ----------
+    cols_list: list
+        lists of decennial variable codes, one download per list and county
+    county_names: list
+        counties to download, all of SPATIAL_FILTERS if None
+    cache_dir: str
+        directory of the cache
+    """
+    for county_name in (county_names or list(SPATIAL_FILTERS)):
+        for cols in cols_list:
+            download_merge_data(county_name=county_name, cols=cols,
+                                spatial_filters=SPATIAL_FILTERS, map_filters=MAP_FILTERS, cache_dir=cache_dir)
+
 def create_choropleth(dem_merged, col, title='', bins=5, cmap_max=1):
     """
     Creates static choropleth of demographic data, using the output of
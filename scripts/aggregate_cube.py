@@ -0,0 +1,251 @@
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import instrument
+
+"""
+This script summarizes matched address records at every geographic level used
+in the analysis: street segment (TLID), block side (TLID-BLKID), block (BLKID)
+and tract (the first 11 digits of the BLKID).
+
+An AggregationCube keeps, for every TLID-BLKID pair, the number of records and,
+for each numeric variable, the number of non-missing values, their sum and their
+sum of squares. These are the only statistics computed from the records
+themselves: segments and blocks are rolled up from the TLID-BLKID cells, and
+tracts from the blocks, by adding them. Means and variances at any level follow
+from the three sums.
+
+Records can be added in chunks, and cubes built on different chunks or shards
+can be merged, so tables far larger than memory can be summarized by streaming
+them through the cube (see aggregate_csv). Memory use depends on the number of
+TLID-BLKID pairs, not on the number of records.
+
+Example:
+    python aggregate_cube.py --path matched.csv --vars A B C --level tract
+prints tract-level counts, means and variances of A, B and C
+"""
+
+logger = logging.getLogger(__name__)
+
+VAR_LIST = ['A', 'B', 'C', 'D', 'E']
+
+# Level: (index levels of the level, level it is rolled up from)
+LEVELS = {'tlid_blkid': (['TLID', 'BLKID'], None),
+          'segment': (['TLID'], 'tlid_blkid'),
+          'block': (['BLKID'], 'tlid_blkid'),
+          'tract': (['TRACT'], 'block')}
+
+# Relative size below which a variance is taken to be rounding error
+VARIANCE_TOLERANCE = 1e-12
+
+
+def stat_columns(var_list):
+    """
+    Names of the stored statistics: 'N', and for each variable '[[var]]_n',
+    '[[var]]_sum' and '[[var]]_sumsq'
+    """
+    return ['N'] + [var + suffix for var in var_list for suffix in ['_n', '_sum', '_sumsq']]
+
+
+def record_stats(records, var_list):
+    """
+    Statistics of each record, as the rows to be summed into the cube
+    """
+    values = records[var_list].to_numpy(dtype=float)
+    present = ~np.isnan(values)
+    values = np.where(present, values, 0)
+    stats = np.empty((values.shape[0], 1 + 3 * len(var_list)))
+    stats[:, 0] = 1
+    stats[:, 1::3], stats[:, 2::3], stats[:, 3::3] = present, values, values ** 2
+    return stats
+
+
+def moments(stats, var_list, ddof=0):
+    """
+    Means and variances from summed statistics
+
+    Parameters
+    ----------
+    stats: pd DataFrame
+            one level of a cube, with the columns of stat_columns
+    var_list: list
+            variables to summarize
+    ddof: int
+            delta degrees of freedom of the variances (0 for population
+            variances, 1 for sample variances)
+
+    Returns
+    -------
+    summary: pd DataFrame
+            'N', and for each variable the mean ('[[var]]') and variance
+            ('[[var]]_var'). Variances are nan where there are not more than
+            ddof values, and variances within rounding error of zero are zero.
+    """
+    summary = pd.DataFrame({'N': stats['N'].astype(np.int64)}, index=stats.index)
+    for var in var_list:
+        n, total, total_sq = stats[var + '_n'], stats[var + '_sum'], stats[var + '_sumsq']
+        mean = total / n.where(n > 0)
+        sq_dev = (total_sq - total * mean).clip(lower=0)
+        sq_dev = sq_dev.where(sq_dev > VARIANCE_TOLERANCE * total_sq, 0)
+        summary[var] = mean
+        summary[var + '_var'] = sq_dev / (n - ddof).where(n > ddof)
+    return summary
+
+
+class AggregationCube(object):
+    """
+    Counts, sums and sums of squares of numeric variables at the segment, block
+    side, block and tract levels
+
+    Parameters
+    ----------
+    var_list: list
+            numeric columns to summarize
+    max_partials: int
+            number of added chunks kept before they are combined
+    """
+    def __init__(self, var_list=VAR_LIST, max_partials=16):
+        self.var_list = list(var_list)
+        self.max_partials = max_partials
+        self.partials = []
+        self.levels = {}
+        self.rows = 0
+
+    def add(self, records):
+        """
+        Adds matched records to the cube
+
+        Parameters
+        ----------
+        records: pd DataFrame
+                with TLID, BLKID and the cube's variables. Missing values of a
+                variable are left out of its sums.
+        """
+        stats = pd.DataFrame(record_stats(records, self.var_list), columns=stat_columns(self.var_list))
+        keys = [records['TLID'].values, records['BLKID'].astype(str).values]
+        partial = stats.groupby(keys).sum()
+        partial.index.names = LEVELS['tlid_blkid'][0]
+        self.partials.append(partial)
+        self.levels = {}
+        self.rows += records.shape[0]
+        instrument.count('cube_rows', records.shape[0])
+        if len(self.partials) > self.max_partials:
+            self.combine()
+        return self
+
+    def merge(self, other):
+        """
+        Adds the records of another cube with the same variables, such as one
+        built on another shard of the data
+        """
+        if other.var_list != self.var_list:
+            raise ValueError("cubes must have the same variables")
+        self.partials += other.partials
+        self.levels = {}
+        self.rows += other.rows
+        if len(self.partials) > self.max_partials:
+            self.combine()
+        return self
+
+    def combine(self):
+        """
+        Combines the added chunks into a single table of TLID-BLKID cells
+        """
+        if len(self.partials) > 1:
+            self.partials = [pd.concat(self.partials).groupby(level=[0, 1]).sum()]
+        elif self.partials:
+            self.partials = [self.partials[0].sort_index()]
+        else:
+            empty = pd.MultiIndex.from_arrays([[], []], names=LEVELS['tlid_blkid'][0])
+            self.partials = [pd.DataFrame(columns=stat_columns(self.var_list), index=empty, dtype=float)]
+        return self.partials[0]
+
+    def level(self, name):
+        """
+        Summed statistics at one level
+
+        Parameters
+        ----------
+        name: str
+                'tlid_blkid', 'segment', 'block' or 'tract'
+
+        Returns
+        -------
+        stats: pd DataFrame
+                the columns of stat_columns, indexed by the level's ids
+        """
+        if name not in LEVELS:
+            raise ValueError("level must be one of " + ", ".join(LEVELS))
+        if name not in self.levels:
+            index, parent = LEVELS[name]
+            if parent is None:
+                stats = self.combine()
+            elif name == 'tract':
+                blocks = self.level(parent)
+                stats = blocks.groupby(blocks.index.str[:11].rename('TRACT')).sum()
+            else:
+                stats = self.level(parent).groupby(level=index[0]).sum()
+            self.levels[name] = stats
+        return self.levels[name]
+
+    def summary(self, name, ddof=0):
+        """
+        Counts, means and variances at one level (see moments)
+        """
+        return moments(self.level(name), self.var_list, ddof=ddof)
+
+
+def build_cube(data, var_list=VAR_LIST):
+    """
+    Builds a cube from matched records in memory
+
+    Parameters
+    ----------
+    data: pd DataFrame
+            demographic (or synthetic) data with columns for TLIDs and
+            BLKIDs. Each row represents a MAFID-indexed household.
+    var_list: list
+            numeric columns to summarize
+    """
+    return AggregationCube(var_list=var_list).add(data)
+
+
+def aggregate_csv(path, var_list=VAR_LIST, chunksize=1000000, tlid_column='TLID'):
+    """
+    Builds a cube by streaming a CSV of matched records in chunks
+
+    Parameters
+    ----------
+    path: str
+            csv with a TLID column, BLKID and the variables
+    var_list: list
+            numeric columns to summarize
+    chunksize: int
+            rows read at a time
+    tlid_column: str
+            name of the TLID column, such as 'TLID_match' for match results
+    """
+    cube = AggregationCube(var_list=var_list)
+    with instrument.stage('aggregate_csv') as record:
+        chunks = pd.read_csv(path, usecols=[tlid_column, 'BLKID'] + list(var_list), chunksize=chunksize,
+                             converters={'BLKID': lambda x: str(x)})
+        for chunk in chunks:
+            cube.add(chunk.rename(columns={tlid_column: 'TLID'}))
+        record['rows'] = cube.rows
+    logger.info("Aggregated %d records into %d TLID-BLKID cells", cube.rows, cube.level('tlid_blkid').shape[0])
+    return cube
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize matched records at the segment, block side, block and tract levels")
+    parser.add_argument('--path', required=True, help="csv of matched records with TLID, BLKID and variables")
+    parser.add_argument('--vars', nargs='+', default=VAR_LIST)
+    parser.add_argument('--level', default='tract', choices=list(LEVELS))
+    parser.add_argument('--tlid-column', default='TLID')
+    parser.add_argument('--chunksize', type=int, default=1000000)
+    args = parser.parse_args()
+    instrument.configure_logging()
+    with instrument.run('aggregate_cube', level=args.level):
+        cube = aggregate_csv(args.path, var_list=args.vars, chunksize=args.chunksize, tlid_column=args.tlid_column)
+        print(cube.summary(args.level).to_string())
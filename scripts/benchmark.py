@@ -0,0 +1,267 @@
+import os
+import json
+import time
+import platform
+import argparse
+import logging
+import subprocess
+import multiprocessing
+import numpy as np
+import pandas as pd
+import instrument
+import synthetic_county
+
+"""
+This script benchmarks the workflow on synthetic counties generated with
+synthetic_county.py. For each scale, it times each stage of the workflow
+(tiger_xwalk.process_county, match_tlid.match_county_tlid,
+match_tlid_geo.run_distance_calc and permute_tlids.find_global_p_val), and records
+wall time, throughput and peak memory. match_county_tlid is also run with profiling
+on, which measures the profiler's overhead and checks that profiled runs work, and
+sampling.stratified_sample is checked to draw its allocated size from every stratum.
+Every stage should report status "ok" on a generated county.
+
+Each stage runs in a fresh process, so that peak memory is measured for that stage
+alone. Results are appended, one JSON record per stage, to
+results/benchmarks/benchmark_results.jsonl so that runs at different commits can
+be compared. The per-stage instrumentation records of each workflow run (see
+instrument.py) are written next to them, in results/benchmarks/stage_metrics.jsonl.
+
+Example:
+    python benchmark.py --scales 10k 100k --stages process_county match_county_tlid
+"""
+
+SCALES = {'10k': 10000,
+          '100k': 100000,
+          '1m': 1000000,
+          '10m': 10000000,
+          '100m': 100000000}
+
+STAGES = ['process_county', 'match_county_tlid', 'match_county_tlid_profiled', 'run_distance_calc', 'find_global_p_val',
+          'stratified_sample']
+
+RESULTS_PATH = "../results/benchmarks/benchmark_results.jsonl"
+METRICS_PATH = "../results/benchmarks/stage_metrics.jsonl"
+
+logger = logging.getLogger(__name__)
+
+
+def stage_process_county(county_code):
+    """
+    Builds the possible TLID crosswalk, ignoring the stage cache
+    """
+    import tiger_xwalk
+    t0 = time.time()
+    tiger_xwalk.process_county(county_code=county_code, use_cache=False)
+    return time.time() - t0
+
+
+def stage_match_county_tlid(county_code):
+    """
+    Matches every address to a TLID with vertex distances
+    """
+    import match_tlid
+    t0 = time.time()
+    match_tlid.match_county_tlid(county_code=county_code, sample=False, use_cache=False)
+    return time.time() - t0
+
+
+def stage_match_county_tlid_profiled(county_code):
+    """
+    Matches every address to a TLID with vertex distances, with the hot
+    functions timed and the stacks sampled (see profiling.py)
+    """
+    import match_tlid
+    t0 = time.time()
+    match_tlid.match_county_tlid(county_code=county_code, sample=False, use_cache=False, profile=True)
+    return time.time() - t0
+
+
+def stage_run_distance_calc(county_code):
+    """
+    Matches every address to a TLID with shapely distances
+    """
+    import match_tlid_geo
+    t0 = time.time()
+    match_tlid_geo.run_distance_calc(county_code=county_code)
+    return time.time() - t0
+
+
+def stage_find_global_p_val(county_code, iterations=10):
+    """
+    Runs the permutation test on matched addresses with random data. Only the
+    test itself is timed, not loading the match results.
+    """
+    import permute_tlids
+    addresses = pd.read_csv("../data/addresses/" + county_code + "_addresses.csv", converters={'BLKID': lambda x: str(x)})
+    xwalk = pd.read_csv("../results/address_tlid_xwalk/" + county_code + "_tlid_match.csv")
+    data = pd.merge(addresses, xwalk, on='MAFID').rename(columns={'TLID_match': 'TLID'})
+    column_names = ['A', 'B', 'C', 'D', 'E']
+    rand_data = np.random.default_rng(0).standard_normal((data.shape[0], len(column_names)))
+    data = data.join(pd.DataFrame(rand_data, columns=column_names, index=data.index))
+    t0 = time.time()
+    permute_tlids.find_global_p_val(data, iterations=iterations)
+    return time.time() - t0
+
+
+def stage_stratified_sample(county_code, fraction=.1):
+    """
+    Draws a stratified sample of the addresses, and checks that every candidate
+    stratum got the number of addresses allocated to it
+    """
+    import sampling
+    addresses = pd.read_csv("../data/addresses/" + county_code + "_addresses.csv", converters={'BLKID': lambda x: str(x)})
+    candidates = sampling.county_candidate_counts(addresses, county_code=county_code)
+    t0 = time.time()
+    sample, design = sampling.stratified_sample(addresses, candidates, fraction=fraction)
+    seconds = time.time() - t0
+    strata = pd.Series(sampling.candidate_strata(candidates), index=addresses['MAFID'].values)
+    drawn = strata[sample['MAFID'].values].value_counts().reindex(design.population.index, fill_value=0)
+    allocated = sampling.allocate(design.population.values, fraction)
+    if not np.array_equal(drawn.values, allocated):
+        raise ValueError("Sampled strata %s do not match the allocation %s" % (drawn.to_dict(),
+                                                                             dict(zip(drawn.index, allocated.tolist()))))
+    return seconds
+
+
+def run_stage_worker(stage, county_code, queue, quiet):
+    """
+    Runs one stage inside a child process and reports its timing and memory use
+    """
+    instrument.configure_logging(level='WARNING' if quiet else 'INFO', metrics_path=METRICS_PATH)
+    record = {'baseline_rss_mb': instrument.peak_rss_mb()}
+    try:
+        record['seconds'] = globals()['stage_' + stage](county_code)
+        record['status'] = 'ok'
+    except ImportError as e:
+        record['status'] = 'skipped'
+        record['error'] = str(e)
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = repr(e)
+    record['peak_rss_mb'] = instrument.peak_rss_mb()
+    queue.put(record)
+
+
+def run_stage(stage, county_code, quiet=True):
+    """
+    Runs one stage in a fresh process
+
+    Parameters
+    ----------
+    stage: str
+            one of STAGES
+    county_code: str
+            fips code for the (synthetic) county
+    quiet: bool
+            if true, hides the stage's logged progress
+
+    Returns
+    -------
+    record: dict
+            status, seconds, baseline and peak resident memory in megabytes
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=run_stage_worker, args=(stage, county_code, queue, quiet))
+    proc.start()
+    record = queue.get()
+    proc.join()
+    return record
+
+
+def run_metadata():
+    """
+    Describes the environment the benchmark ran in
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()}
+
+
+def run_benchmarks(scales=['10k'], stages=STAGES, county_code='99001', segments_per_side=2,
+                   vertices_per_segment=3, seed=0, results_path=RESULTS_PATH, quiet=True):
+    """
+    Generates a synthetic county at each scale and times each workflow stage on it.
+
+    Parameters
+    ----------
+    scales: list
+            keys of SCALES, or integer numbers of addresses
+    stages: list
+            stages to run, in workflow order. Later stages read the outputs of
+            earlier ones, so process_county must have been run for a scale before
+            the other stages.
+    county_code: str
+            fips code for the synthetic county
+    segments_per_side: float
+            mean number of street segments per block side
+    vertices_per_segment: int
+            number of interior vertices per street segment
+    seed: int
+            random seed for the synthetic county
+    results_path: str
+            JSON lines file that results are appended to
+    quiet: bool
+            if true, hides the stages' logged progress
+
+    Returns
+    -------
+    records: list
+            one dict per stage and scale
+    """
+    if not os.path.exists(os.path.dirname(results_path)):
+        os.makedirs(os.path.dirname(results_path))
+
+    metadata = run_metadata()
+    records = []
+    for scale in scales:
+        n_addresses = SCALES.get(scale, None) or int(scale)
+        gen_t0 = time.time()
+        county = synthetic_county.generate_county(county_code=county_code, n_addresses=n_addresses,
+                                                  segments_per_side=segments_per_side,
+                                                  vertices_per_segment=vertices_per_segment, seed=seed)
+        logger.info("Generated %s county in %.2f seconds", scale, time.time() - gen_t0)
+
+        for stage in stages:
+            record = {**metadata, 'scale': str(scale), 'stage': stage,
+                      'addresses': county['addresses'], 'edges': county['edges'],
+                      'blocks': county['blocks'], 'segments_per_side': segments_per_side,
+                      'vertices_per_segment': vertices_per_segment, 'seed': seed}
+            record.update(run_stage(stage, county_code, quiet=quiet))
+            if record['status'] == 'ok':
+                record['addresses_per_second'] = county['addresses'] / max(record['seconds'], 1e-9)
+            logger.info("%s %s %s: %s seconds, %.1f MB peak", stage, scale, record['status'],
+                        record.get('seconds'), record['peak_rss_mb'])
+
+            with open(results_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            records.append(record)
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the workflow on synthetic counties")
+    parser.add_argument('--scales', nargs='+', default=['10k'],
+                        help="number of addresses: " + ", ".join(SCALES) + " or an integer")
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--county-code', default='99001')
+    parser.add_argument('--segments-per-side', type=float, default=2)
+    parser.add_argument('--vertices-per-segment', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--results', default=RESULTS_PATH)
+    parser.add_argument('--verbose', action='store_true', help="show the stages' logged progress")
+    args = parser.parse_args()
+    instrument.configure_logging()
+
+    run_benchmarks(scales=args.scales, stages=args.stages, county_code=args.county_code,
+                   segments_per_side=args.segments_per_side, vertices_per_segment=args.vertices_per_segment,
+                   seed=args.seed, results_path=args.results, quiet=not args.verbose)
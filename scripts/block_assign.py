@@ -0,0 +1,246 @@
+import os
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from shapely.wkt import loads
+import instrument
+
+"""
+This script assigns census block ids (BLKID) to address points from their
+coordinates, in place of the external spatial join against TIGER faces that the
+sample addresses went through.
+
+The face polygons are parsed once into a FaceIndex, which lays a uniform grid
+over the county and lists, for every grid cell, the faces whose bounding boxes
+overlap it. Points are binned into the same grid, sorted by cell, and each face
+is tested only against the points in its cells and bounding box, with a
+vectorized even-odd (ray casting) test over all of its rings, so holes and
+multi-part faces are handled. Points outside every face get no BLKID.
+
+Example:
+    python block_assign.py --county-code 08031
+fills in missing BLKIDs of ../data/addresses/08031_addresses.csv, writing the
+result to ../results/assigned_blocks/08031_addresses.csv (or --output). The input
+file is never modified.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def polygon_rings(geometry):
+    """
+    Extracts the rings of a polygon or multipolygon as arrays of vertices
+    """
+    polygons = geometry.geoms if hasattr(geometry, 'geoms') else [geometry]
+    rings = []
+    for polygon in polygons:
+        rings.append(np.asarray(polygon.exterior.coords)[:, :2])
+        rings += [np.asarray(interior.coords)[:, :2] for interior in polygon.interiors]
+    return rings
+
+
+def points_in_rings(x, y, rings, max_pairs=1000000):
+    """
+    Even-odd point-in-polygon test of many points against one face
+
+    Parameters
+    ----------
+    x, y: np array
+            point coordinates (longitude, latitude)
+    rings: list
+            closed rings of the face, as arrays of vertices
+    max_pairs: int
+            maximum number of point-edge pairs tested at once, to bound memory
+
+    Returns
+    -------
+    inside: np array
+            boolean, true for points inside the face
+    """
+    inside = np.zeros(x.shape[0], dtype=bool)
+    for ring in rings:
+        x1, y1 = ring[:-1, 0], ring[:-1, 1]
+        x2, y2 = ring[1:, 0], ring[1:, 1]
+        step = max(max_pairs // max(x1.shape[0], 1), 1)
+        for start in range(0, x.shape[0], step):
+            px, py = x[start:start + step, None], y[start:start + step, None]
+            # Count the edges crossing the horizontal ray to the right of each point
+            crosses = (y1 > py) != (y2 > py)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+            inside[start:start + step] ^= ((crosses & (px < x_cross)).sum(axis=1) % 2).astype(bool)
+    return inside
+
+
+class FaceIndex(object):
+    """
+    Grid index over the block faces of a county
+
+    Parameters
+    ----------
+    faces: pd DataFrame
+            face data from TIGER files, with BLKID and WKT geometry
+    cells_per_face: float
+            target mean number of faces per grid cell, which sets the grid size
+    """
+    def __init__(self, faces, cells_per_face=1.0):
+        faces = faces[faces['BLKID'].notnull() & faces['geometry'].notnull()]
+        self.blkids = faces['BLKID'].astype(str).values
+        self.rings = [polygon_rings(loads(wkt)) for wkt in faces['geometry']]
+        self.bounds = np.array([[min(r[:, 0].min() for r in rings), min(r[:, 1].min() for r in rings),
+                                 max(r[:, 0].max() for r in rings), max(r[:, 1].max() for r in rings)]
+                                for rings in self.rings]).reshape(-1, 4)
+        if self.bounds.shape[0] == 0:
+            self.origin, self.cell_size, self.shape = np.zeros(2), 1.0, (1, 1)
+            self.cell_faces = [[]]
+            return
+
+        # Square cells, sized so that there are about as many cells as faces
+        self.origin = self.bounds[:, :2].min(axis=0)
+        extent = np.maximum(self.bounds[:, 2:].max(axis=0) - self.origin, 1e-9)
+        self.cell_size = np.sqrt(extent[0] * extent[1] * cells_per_face / self.bounds.shape[0])
+        self.shape = tuple(np.maximum(np.ceil(extent / self.cell_size).astype(int), 1))
+        self.cell_faces = [[] for _ in range(self.shape[0] * self.shape[1])]
+        low, high = self.cells(self.bounds[:, :2]), self.cells(self.bounds[:, 2:])
+        for face, ((i0, j0), (i1, j1)) in enumerate(zip(low, high)):
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    self.cell_faces[i * self.shape[1] + j].append(face)
+
+    def cells(self, points):
+        """
+        Grid cell (column, row) of each point, clipped to the grid
+        """
+        cells = np.floor((points - self.origin) / self.cell_size).astype(int)
+        return np.clip(cells, 0, np.array(self.shape) - 1)
+
+    def assign(self, longitude, latitude):
+        """
+        Finds the block containing each point
+
+        Parameters
+        ----------
+        longitude, latitude: array-like
+                point coordinates
+
+        Returns
+        -------
+        blkids: np array
+                BLKID of each point, or None for points outside every face
+        """
+        x, y = np.asarray(longitude, dtype=float), np.asarray(latitude, dtype=float)
+        face_of = np.full(x.shape[0], -1)
+        points = np.column_stack([x, y])
+        cells = self.cells(points)
+        cell_id = cells[:, 0] * self.shape[1] + cells[:, 1]
+        # Points outside the grid cannot be in any face
+        in_grid = ((points >= self.origin) & (points <= self.origin + np.array(self.shape) * self.cell_size)).all(axis=1)
+        cell_id[~in_grid] = -1
+        order = np.argsort(cell_id, kind='stable')
+        sorted_cells = cell_id[order]
+        starts = np.searchsorted(sorted_cells, np.arange(len(self.cell_faces)), side='left')
+        ends = np.searchsorted(sorted_cells, np.arange(len(self.cell_faces)), side='right')
+
+        tests = 0
+        for cell, faces in enumerate(self.cell_faces):
+            if not faces or starts[cell] == ends[cell]:
+                continue
+            members = order[starts[cell]:ends[cell]]
+            for face in faces:
+                # Only points not yet assigned, inside the face's bounding box
+                x0, y0, x1, y1 = self.bounds[face]
+                candidates = members[(face_of[members] < 0) & (x[members] >= x0) & (x[members] <= x1)
+                                     & (y[members] >= y0) & (y[members] <= y1)]
+                if candidates.shape[0] == 0:
+                    continue
+                tests += candidates.shape[0]
+                inside = points_in_rings(x[candidates], y[candidates], self.rings[face])
+                face_of[candidates[inside]] = face
+
+        instrument.count('pip_tests', tests)
+        blkids = np.full(x.shape[0], None, dtype=object)
+        blkids[face_of >= 0] = self.blkids[face_of[face_of >= 0]]
+        return blkids
+
+
+def load_face_index(county_code='08031'):
+    """
+    Builds a FaceIndex from a county's csv-converted TIGER faces
+    """
+    faces = pd.read_csv("../data/tiger_csv/" + county_code + "_faces.csv",
+                        converters={'STATEFP10': lambda x: str(x), 'COUNTYFP10': lambda x: str(x),
+                                    'TRACTCE10': lambda x: str(x), 'BLOCKCE10': lambda x: str(x)})
+    faces['BLKID'] = faces['STATEFP10'] + faces['COUNTYFP10'] + faces['TRACTCE10'] + faces['BLOCKCE10']
+    return FaceIndex(faces)
+
+
+def assign_blocks(addresses, county_code='08031', face_index=None, overwrite=False):
+    """
+    Fills in the BLKID of addresses from their coordinates
+
+    Parameters
+    ----------
+    addresses: pd DataFrame
+            address points with LATITUDE and LONGITUDE, and optionally BLKID
+    county_code: str
+            fips code for county, used to load the faces if face_index is None
+    face_index: FaceIndex
+            already built index of the county's faces
+    overwrite: bool
+            if true, reassigns every address, otherwise only those with a
+            missing or empty BLKID
+
+    Returns
+    -------
+    addresses: pd DataFrame
+            a copy of addresses with BLKID filled in. Addresses outside every
+            face are left with an empty BLKID.
+    """
+    with instrument.stage('assign_blocks') as record:
+        addresses = addresses.copy()
+        if 'BLKID' not in addresses.columns:
+            addresses['BLKID'] = ''
+        addresses['BLKID'] = addresses['BLKID'].fillna('').astype(str)
+        missing = np.ones(addresses.shape[0], dtype=bool) if overwrite else \
+            addresses['BLKID'].isin(['', 'nan']).values
+        record['rows'] = int(missing.sum())
+        if missing.any():
+            if face_index is None:
+                face_index = load_face_index(county_code)
+            blkids = face_index.assign(addresses['LONGITUDE'].values[missing], addresses['LATITUDE'].values[missing])
+            addresses.loc[missing, 'BLKID'] = np.where(pd.isnull(blkids), '', blkids)
+            record['unassigned'] = int(pd.isnull(blkids).sum())
+            logger.info("Assigned blocks to %d addresses, %d outside every face", missing.sum(), record['unassigned'])
+    return addresses
+
+
+def fill_missing_blocks(addresses, county_code='08031'):
+    """
+    Returns addresses as they are if every one has a BLKID, and otherwise fills
+    in the missing ones with assign_blocks
+    """
+    if 'BLKID' in addresses.columns:
+        blkids = addresses['BLKID']
+        if blkids.notnull().all() and not blkids.astype(str).isin(['', 'nan']).any():
+            return addresses
+    return assign_blocks(addresses, county_code=county_code)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill in missing BLKIDs of a county's addresses from their coordinates")
+    parser.add_argument('--county-code', default='08031')
+    parser.add_argument('--overwrite', action='store_true', help="reassign every address")
+    parser.add_argument('--output', default=None,
+                        help="CSV to write, defaults to ../results/assigned_blocks/[county_code]_addresses.csv")
+    args = parser.parse_args()
+    instrument.configure_logging()
+    path = "../data/addresses/" + args.county_code + "_addresses.csv"
+    output = args.output or "../results/assigned_blocks/" + args.county_code + "_addresses.csv"
+    if os.path.abspath(output) == os.path.abspath(path):
+        parser.error("--output must not be the input address file")
+    with instrument.run('assign_blocks', county_code=args.county_code):
+        addresses = pd.read_csv(path, converters={'BLKID': lambda x: str(x)})
+        if os.path.dirname(output) and not os.path.exists(os.path.dirname(output)):
+            os.makedirs(os.path.dirname(output))
+        assign_blocks(addresses, county_code=args.county_code, overwrite=args.overwrite).to_csv(output, index=False)
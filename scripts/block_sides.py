@@ -0,0 +1,283 @@
+import logging
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+from shapely.wkt import loads
+import instrument
+import stage_cache
+import tiger_xwalk
+
+"""
+This script chains TIGER edges into block-side polylines using node topology.
+
+One side of a block is often cut into several TLIDs by intersections with
+non-road features (ditches, pipelines, paths), so many addresses have several
+candidate TLIDs that are really one continuous street. Edges that border the same
+block and carry the same name are chained at shared nodes (TNIDF/TNIDT, which
+make_csv.py keeps from the TIGER edges) into one polyline per block side. Each
+polyline keeps its vertices in one array, with the node vertex shared by two
+consecutive TLIDs stored once, and remembers which TLID(s) each vertex belongs
+to, so a distance search over the polyline maps straight back to a TLID.
+
+The output is a table with one row per block side (SIDE_ID, BLKID, FULLNAME and
+the TLIDs in chain order) and a dictionary of the sides' geometry. It is built
+once per county and kept in the stage cache (see county_block_sides). When an
+address's candidates are exactly the TLIDs of whole sides of its block, both
+match_tlid_utils.find_closest and matching_service.CountyIndex search the merged
+polylines instead of each TLID's vertices (see covering_sides).
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def order_chain(segments):
+    """
+    Orders the segments of one connected chain by walking from an end node
+
+    Parameters
+    ----------
+    segments: list
+            of (TLID, TNIDF, TNIDT) tuples that are connected through their nodes
+
+    Returns
+    -------
+    ordered: list
+            of (TLID, start node, end node, backwards) tuples in walking order,
+            each segment oriented in the direction it is walked, and backwards
+            true if that is against its TNIDF to TNIDT direction. Segments that
+            branch off the walk are appended after it, in their own direction.
+    """
+    by_node = defaultdict(list)
+    for i, (tlid, node_from, node_to) in enumerate(segments):
+        by_node[node_from].append(i)
+        by_node[node_to].append(i)
+    # Start from a node of degree one if there is one (a path), otherwise anywhere (a loop)
+    ends = [node for node, members in by_node.items() if len(members) == 1]
+    node = ends[0] if ends else segments[0][1]
+    used = set()
+    ordered = []
+    while True:
+        options = [i for i in by_node[node] if i not in used]
+        if not options:
+            break
+        i = options[0]
+        used.add(i)
+        tlid, node_from, node_to = segments[i]
+        if node_from == node:
+            ordered.append((tlid, node_from, node_to, False))
+            node = node_to
+        else:
+            ordered.append((tlid, node_to, node_from, True))
+            node = node_from
+    ordered += [segments[i] + (False,) for i in range(len(segments)) if i not in used]
+    return ordered
+
+
+def find_chains(segments):
+    """
+    Splits segments into chains connected through shared nodes
+
+    Parameters
+    ----------
+    segments: list
+            of (TLID, TNIDF, TNIDT) tuples
+
+    Returns
+    -------
+    chains: list
+            of ordered chains, as returned by order_chain
+    """
+    parent = {}
+
+    def find(node):
+        while parent.setdefault(node, node) != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for tlid, node_from, node_to in segments:
+        parent[find(node_from)] = find(node_to)
+    components = defaultdict(list)
+    for segment in segments:
+        components[find(segment[1])].append(segment)
+    return [order_chain(members) for members in components.values()]
+
+
+def merge_chain(chain, coords):
+    """
+    Merges the vertices of an ordered chain into one array, storing the node
+    vertex shared by consecutive TLIDs once
+
+    Parameters
+    ----------
+    chain: list
+            of (TLID, start node, end node, backwards) tuples, as returned by
+            order_chain
+    coords: dict
+            TLIDs as keys, arrays of (longitude, latitude) vertices in TNIDF to
+            TNIDT order as values
+
+    Returns
+    -------
+    merged: np array
+            vertices of the polyline
+    owners: np array
+            two positions in the chain for each vertex: the TLIDs the vertex
+            belongs to (the same position twice, except at shared nodes)
+    """
+    merged, owners = [], []
+    last_node = None
+    for position, (tlid, node_from, node_to, backwards) in enumerate(chain):
+        vertices = coords[tlid]
+        if vertices is None:
+            last_node = None
+            continue
+        if backwards:
+            vertices = vertices[::-1]
+        pair = np.full((vertices.shape[0], 2), position)
+        if position > 0 and node_from == last_node and np.array_equal(vertices[0], merged[-1][-1]):
+            # The first vertex is the node shared with the previous TLID, at the same coordinates
+            owners[-1][-1, 1] = position
+            vertices, pair = vertices[1:], pair[1:]
+        merged.append(vertices)
+        owners.append(pair)
+        last_node = node_to
+    if not merged:
+        return np.empty((0, 2)), np.empty((0, 2), int)
+    return np.concatenate(merged), np.concatenate(owners)
+
+
+def create_block_sides(edges, faces, roads_only=True):
+    """
+    Chains edges bordering the same block with the same name into block sides
+
+    Parameters
+    ----------
+    edges: pd DataFrame
+            edge data from TIGER files, with TLID, TFIDL, TFIDR, FULLNAME,
+            ROADFLG, TNIDF, TNIDT and WKT geometry
+    faces: pd DataFrame
+            face data from TIGER files, with TFID and concatinated block id
+    roads_only: bool
+            only chains roads if true, as in tiger_xwalk.create_edge_face
+
+    Returns
+    -------
+    sides: pd DataFrame
+            one row per block side, with SIDE_ID, BLKID, FULLNAME and TLIDs (a
+            list, in chain order)
+    geometry: dict
+            SIDE_ID as keys, (TLIDs, vertices, owners) as values, where owners
+            holds two positions in TLIDs per vertex (see merge_chain)
+    """
+    if roads_only:
+        edges = edges[edges['ROADFLG'] == 'Y']
+    edges = edges.assign(TLID=edges['TLID'].astype(str))
+    coords = {tlid: np.asarray(loads(wkt).coords)[:, :2] if isinstance(wkt, str) else None
+              for tlid, wkt in zip(edges['TLID'], edges['geometry'])}
+
+    # One row per edge and bordering block
+    edge_sides = pd.concat([edges[['TLID', 'FULLNAME', 'TNIDF', 'TNIDT', 'TFIDL']].rename(columns={'TFIDL': 'TFID'}),
+                            edges[['TLID', 'FULLNAME', 'TNIDF', 'TNIDT', 'TFIDR']].rename(columns={'TFIDR': 'TFID'})])
+    edge_sides = edge_sides.assign(TFID=edge_sides['TFID'].astype(str))
+    edge_sides = edge_sides.merge(faces[['TFID', 'BLKID']].astype(str), on='TFID', how='inner')
+    edge_sides = edge_sides.drop_duplicates(['BLKID', 'TLID'])
+
+    rows, geometry = [], {}
+    for (blkid, name), group in edge_sides.groupby(['BLKID', 'FULLNAME'], sort=False, dropna=False):
+        segments = list(zip(group['TLID'], group['TNIDF'], group['TNIDT']))
+        for chain in find_chains(segments):
+            side_id = len(rows)
+            tlids = [segment[0] for segment in chain]
+            rows.append((side_id, blkid, name, tlids))
+            geometry[side_id] = (tlids,) + merge_chain(chain, coords)
+
+    sides = pd.DataFrame(rows, columns=['SIDE_ID', 'BLKID', 'FULLNAME', 'TLIDs'])
+    n_vertices = sum(v.shape[0] for tlids, v, owners in geometry.values())
+    n_edge_vertices = sum(coords[tlid].shape[0] for tlids in sides['TLIDs'] for tlid in tlids
+                          if coords[tlid] is not None)
+    instrument.set_value('block_side_vertex_rate', n_vertices / max(n_edge_vertices, 1))
+    logger.info("Chained %d edge-block pairs into %d block sides", edge_sides.shape[0], sides.shape[0])
+    return sides, geometry
+
+
+def side_lookup(sides):
+    """
+    SIDE_ID of each (BLKID, TLID) pair of a block sides table, with TLIDs as
+    strings
+    """
+    return {(blkid, str(tlid)): side_id
+            for side_id, blkid, tlids in zip(sides['SIDE_ID'], sides['BLKID'], sides['TLIDs'])
+            for tlid in tlids}
+
+
+def covering_sides(side_of, geometry, blkid, tlids):
+    """
+    Finds the sides of a block whose TLIDs are exactly the given ones
+
+    Parameters
+    ----------
+    side_of: dict
+            as returned by side_lookup
+    geometry: dict
+            as returned by create_block_sides
+    blkid: str
+            15-digit block id
+    tlids: list
+            distinct TLIDs, as strings
+
+    Returns
+    -------
+    side_ids: list
+            the sides, in order of their first TLID, or None if the TLIDs are
+            not whole sides of the block
+    """
+    side_ids = []
+    for tlid in tlids:
+        side_id = side_of.get((blkid, tlid))
+        if side_id is None:
+            return None
+        if side_id not in side_ids:
+            side_ids.append(side_id)
+    if sum(len(geometry[side_id][0]) for side_id in side_ids) != len(tlids):
+        return None
+    return side_ids
+
+
+def county_block_sides(county_code='08031', edges=None, faces=None, use_cache=True):
+    """
+    Block sides of a county, as returned by create_block_sides
+
+    Parameters
+    ----------
+    county_code: str
+            fips code for county
+    edges, faces: pd DataFrame
+            the county's TIGER tables, if already loaded. Otherwise they are
+            read from its TIGER CSVs when the sides have to be built.
+    use_cache: bool
+            if true, reuses the sides from the stage cache (see stage_cache.py)
+            while the edges and faces files are unchanged
+
+    Returns
+    -------
+    sides: pd DataFrame
+            one row per block side, empty if the edges have no node ids (TNIDF
+            and TNIDT)
+    geometry: dict
+            SIDE_ID as keys, (TLIDs, vertices, owners) as values
+    """
+    def compute():
+        county_edges, county_faces = edges, faces
+        if county_edges is None or county_faces is None:
+            county_edges, county_faces = tiger_xwalk.load_tiger_csv("../data/tiger_csv/" + county_code + "_edges.csv",
+                                                                    "../data/tiger_csv/" + county_code + "_faces.csv")
+        if 'TNIDF' not in county_edges.columns or 'TNIDT' not in county_edges.columns:
+            logger.info("Edges have no node ids, so no block sides are merged")
+            return pd.DataFrame(columns=['SIDE_ID', 'BLKID', 'FULLNAME', 'TLIDs']), {}
+        return create_block_sides(county_edges, county_faces)
+
+    with instrument.stage('block_sides') as record:
+        sides = stage_cache.StageCache(county_code).cached('sides', compute) if use_cache else compute()
+        record['sides'] = sides[0].shape[0]
+    return sides
@@ -0,0 +1,268 @@
+import os
+import time
+import logging
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import Point
+from shapely import wkt
+import match_tlid
+import match_tlid_geo
+import match_tlid_utils as tlid_utils
+import instrument
+
+"""
+This script compares the accuracy and speed of the TLID matching modes:
+
+* 'vertex': distance to the closest vertex (match_tlid_utils.find_closest)
+* 'vertex_float32', 'vertex_fixed': the vertex mode with compact float32 or
+  int32 fixed-point coordinates (match_tlid_utils.CoordinateCodec)
+* 'exact': shapely distance to the full line (match_tlid_geo.min_dist_geo)
+* 'simplified': shapely distance to lines simplified with
+  match_tlid_geo.simplify_road, at several tolerances
+* 'midpoint': shapely distance to the midpoint of each line
+  (match_tlid_geo.find_midpoints)
+
+Every mode is run on the same multi-option addresses. Each mode's matches are
+compared with the exact mode, giving an agreement rate and the average extra
+distance (in the coordinate units of the edges) between the point and the line
+chosen, relative to the closest line. The results table can be used to pick the
+fastest mode that meets an accuracy bar with fastest_mode().
+"""
+
+logger = logging.getLogger(__name__)
+
+# Tolerances, in degrees (roughly 1m, 5m, 10m and 50m)
+SIMPLIFY_TOLS = [0.00001, 0.00005, 0.0001, 0.0005]
+
+
+def load_multi_addresses(county_code='08031', n_addresses=None, seed=0):
+    """
+    Loads addresses, edges, and the crosswalk, and keeps addresses that have
+    more than one possible TLID -- the only ones where matching modes can differ
+
+    Parameters
+    ----------
+    county_code: str
+            fips code for county
+    n_addresses: int
+            if given, a random sample of this many multi-option addresses is kept
+    seed: int
+            random seed for the sample
+
+    Returns
+    -------
+    multi: pd DataFrame
+            multi-option addresses, indexed by MAFID, with TLIDs, LATITUDE and LONGITUDE
+    edges: pd DataFrame
+            of edges lines, indexed by TLID, with WKT geometry
+    """
+    addresses, edges = tlid_utils.import_data(county_code=county_code, sample=False)
+    xwalk = tlid_utils.import_xwalk(county_code=county_code)
+    maf_xwalk = tlid_utils.merge_xwalk_addresses(addresses, xwalk)
+
+    multi = maf_xwalk.loc[maf_xwalk['TLIDs'].apply(lambda x: isinstance(x, list) and len(x) > 1)]
+    if n_addresses is not None and n_addresses < multi.shape[0]:
+        multi = multi.sample(n=n_addresses, random_state=seed)
+    logger.info("Number of multi-option addresses compared: %d", multi.shape[0])
+    return multi[['TLIDs', 'LATITUDE', 'LONGITUDE']], edges
+
+
+def to_spatial(multi, edges):
+    """
+    Converts addresses and the edges they may be matched to into gpd DataFrames,
+    in the form expected by match_tlid_geo.min_dist_geo
+
+    Returns
+    -------
+    points: gpd DataFrame
+            address points with a 'TLIDs' column
+    edges_gdf: gpd DataFrame
+            candidate edges with a 'TLID' column
+    """
+    crs = 'epsg:4269'
+    geometry = [Point(xy) for xy in zip(multi.LONGITUDE, multi.LATITUDE)]
+    points = gpd.GeoDataFrame(multi[['TLIDs']], crs=crs, geometry=geometry)
+
+    candidates = set(tlid for tlids in multi['TLIDs'] for tlid in tlids)
+    edges_gdf = edges.loc[edges.index.isin(candidates), ['geometry']].reset_index()
+    edges_gdf = edges_gdf.assign(geometry=edges_gdf['geometry'].apply(wkt.loads))
+    edges_gdf = gpd.GeoDataFrame(edges_gdf, crs=crs, geometry='geometry')
+    return points, edges_gdf
+
+
+def run_vertex_mode(multi, edges, coords='float64'):
+    """
+    Matches addresses with match_tlid's vertex distance approach, with
+    coordinates stored as coords (see match_tlid_utils.CoordinateCodec)
+
+    Returns
+    -------
+    matches: pd Series
+            TLID match, indexed by MAFID
+    prep_time: float
+            seconds spent collecting candidate geometries
+    match_time: float
+            seconds spent matching
+    """
+    t0 = time.time()
+    multi_match = multi.to_dict('index')
+    geom_list = tlid_utils.get_candidate_geoms(multi_match, edges)
+    t1 = time.time()
+    codec = tlid_utils.county_codec(coords, multi['LONGITUDE'].values, multi['LATITUDE'].values)
+    matches = match_tlid.match_generator(multi_match, geom_list, codec=codec)
+    t2 = time.time()
+    return pd.Series(matches), t1 - t0, t2 - t1
+
+
+def run_geo_mode(points, edges_gdf):
+    """
+    Matches addresses with match_tlid_geo.min_dist_geo, given (possibly simplified)
+    edges
+
+    Returns
+    -------
+    matches: pd Series
+            TLID match, indexed by MAFID
+    match_time: float
+            seconds spent matching
+    """
+    t0 = time.time()
+    matches = points.apply(lambda row: match_tlid_geo.min_dist_geo(row, edges_gdf), axis=1)
+    return matches, time.time() - t0
+
+
+def match_distances(points, edges_gdf, matches):
+    """
+    Finds the exact distance between each point and the line it was matched to
+
+    Returns
+    -------
+    dists: pd Series
+            indexed by MAFID
+    """
+    lines = edges_gdf.set_index('TLID').geometry
+    return pd.Series([point.distance(lines[tlid]) if tlid in lines.index else np.nan
+                      for point, tlid in zip(points.geometry, matches.reindex(points.index))],
+                     index=points.index)
+
+
+def compare_modes(county_code='08031', n_addresses=1000, tols=SIMPLIFY_TOLS, seed=0, save=True):
+    """
+    Runs every matching mode on the same addresses, and reports per-mode runtime
+    and agreement with the exact mode.
+
+    Parameters
+    ----------
+    county_code: str
+            fips code for county
+    n_addresses: int
+            number of multi-option addresses to compare, or None for all of them
+    tols: list
+            simplification tolerances to sweep
+    seed: int
+            random seed for the address sample
+    save: bool
+            if true, saves the results as
+            "../results/mode_comparison/[[county_code]]_mode_comparison.csv"
+
+    Returns
+    -------
+    results: pd DataFrame
+            one row per mode (and tolerance) with preparation and match times,
+            throughput, agreement rate with the exact mode, and the mean extra
+            distance to the chosen line
+    matches: pd DataFrame
+            TLID matches for each address (rows) and mode (columns)
+    """
+    multi, edges = load_multi_addresses(county_code=county_code, n_addresses=n_addresses, seed=seed)
+
+    t0 = time.time()
+    points, edges_gdf = to_spatial(multi, edges)
+    spatial_time = time.time() - t0
+
+    runs = []
+    matches = {}
+
+    vertex_matches, prep_time, match_time = run_vertex_mode(multi, edges)
+    runs.append({'mode': 'vertex', 'tol': np.nan, 'prep_seconds': prep_time, 'match_seconds': match_time})
+    matches['vertex'] = vertex_matches
+
+    for coords in ['float32', 'fixed']:
+        vertex_matches, prep_time, match_time = run_vertex_mode(multi, edges, coords=coords)
+        runs.append({'mode': 'vertex_' + coords, 'tol': np.nan, 'prep_seconds': prep_time, 'match_seconds': match_time})
+        matches['vertex_' + coords] = vertex_matches
+
+    exact_matches, match_time = run_geo_mode(points, edges_gdf)
+    runs.append({'mode': 'exact', 'tol': np.nan, 'prep_seconds': spatial_time, 'match_seconds': match_time})
+    matches['exact'] = exact_matches
+
+    t0 = time.time()
+    midpoints = match_tlid_geo.find_midpoints(edges_gdf)
+    prep_time = time.time() - t0
+    mid_matches, match_time = run_geo_mode(points, midpoints)
+    runs.append({'mode': 'midpoint', 'tol': np.nan, 'prep_seconds': spatial_time + prep_time, 'match_seconds': match_time})
+    matches['midpoint'] = mid_matches
+
+    for tol in tols:
+        t0 = time.time()
+        simplified = match_tlid_geo.simplify_road(edges_gdf.copy(), county_code=county_code, tol=tol, save=False)
+        prep_time = time.time() - t0
+        simp_matches, match_time = run_geo_mode(points, simplified)
+        runs.append({'mode': 'simplified', 'tol': tol, 'prep_seconds': spatial_time + prep_time, 'match_seconds': match_time})
+        matches['simplified_' + str(tol)] = simp_matches
+
+    matches = pd.DataFrame(matches).reindex(multi.index)
+    exact_dists = match_distances(points, edges_gdf, matches['exact'])
+
+    for run, col in zip(runs, matches.columns):
+        run['addresses'] = multi.shape[0]
+        run['addresses_per_second'] = multi.shape[0] / max(run['match_seconds'], 1e-9)
+        run['agreement_rate'] = (matches[col] == matches['exact']).mean()
+        extra_dist = match_distances(points, edges_gdf, matches[col]) - exact_dists
+        run['mean_extra_dist'] = extra_dist.mean()
+        run['max_extra_dist'] = extra_dist.max()
+    results = pd.DataFrame(runs)
+    results.loc[:, 'total_seconds'] = results['prep_seconds'] + results['match_seconds']
+    logger.info("Mode comparison:\n%s", results[['mode', 'tol', 'total_seconds', 'agreement_rate', 'mean_extra_dist']])
+
+    if save:
+        if not os.path.exists("../results/mode_comparison/"):
+            os.makedirs("../results/mode_comparison/")
+        results.to_csv("../results/mode_comparison/" + county_code + "_mode_comparison.csv", index=False)
+        matches.to_csv("../results/mode_comparison/" + county_code + "_mode_matches.csv")
+    return results, matches
+
+
+def fastest_mode(results, min_agreement=0.99):
+    """
+    Picks the fastest matching mode whose agreement with the exact mode meets
+    the given accuracy bar
+
+    Parameters
+    ----------
+    results: pd DataFrame
+            output of compare_modes
+    min_agreement: float
+            minimum share of addresses matched to the same TLID as the exact mode
+
+    Returns
+    -------
+    best: pd Series
+            the row of results for the fastest acceptable mode, or for the exact
+            mode if no mode meets the bar
+    """
+    acceptable = results.loc[results['agreement_rate'] >= min_agreement]
+    if acceptable.empty:
+        # Even the exact mode can fall short, when some of its matches are missing
+        logger.warning("No mode has an agreement of at least %s, falling back to the exact mode", min_agreement)
+        return results.loc[results['mode'] == 'exact'].iloc[0]
+    best = acceptable.sort_values('total_seconds').iloc[0]
+    logger.info("Fastest mode with agreement of at least %s: %s %s", min_agreement, best['mode'], best['tol'])
+    return best
+
+
+if __name__ == "__main__":
+    instrument.configure_logging()
+    results, matches = compare_modes(county_code='08031', n_addresses=1000)
+    fastest_mode(results)
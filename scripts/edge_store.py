@@ -0,0 +1,234 @@
+import csv
+import logging
+import numpy as np
+import pandas as pd
+import shapely
+import instrument
+import stage_cache
+
+"""
+This script loads only the TIGER edges that matching needs.
+
+Only TLIDs that appear in some multi-option candidate list are ever used by the
+distance calculations, but the edges file also holds every other road, rail line
+and stream of the county, each with its full WKT geometry. read_edges takes the
+set of needed TLIDs and returns just those rows.
+
+Where possible it uses an offset index of the edges file: the TLID, byte offset
+and length of every row, sorted by TLID. The index is built in one pass over the
+file, and kept in the stage cache (see stage_cache.py) for as long as the edges
+file is unchanged. With it, the needed rows are found with a binary search, read
+with one seek each, and parsed, without reading the rest of the file. Without an
+index, the file is read in chunks, keeping only the needed rows of each chunk.
+
+The bounding box of every edge is kept in the stage cache the same way, so that
+candidate lines can be pruned by their box (see match_tlid_utils.candidate_bounds)
+without parsing their geometry on every match.
+"""
+
+logger = logging.getLogger(__name__)
+
+CHUNK_ROWS = 100000
+
+
+def edges_path(county_code='08031'):
+    return "../data/tiger_csv/" + county_code + "_edges.csv"
+
+
+def build_offset_index(path):
+    """
+    Indexes the rows of an edges CSV by TLID
+
+    Parameters
+    ----------
+    path: str
+            path to a csv-converted TIGER edges file
+
+    Returns
+    -------
+    index: dict
+            'header' (column names), and 'tlids', 'offsets' and 'lengths' arrays
+            sorted by TLID
+    """
+    tlids, offsets, lengths = [], [], []
+    with open(path, 'rb') as f:
+        header_line = f.readline()
+        header = next(csv.reader([header_line.decode()]))
+        tlid_col = header.index('TLID')
+        offset = len(header_line)
+        for line in f:
+            fields = line.split(b',', tlid_col + 1)
+            # Fall back to the csv module if a field before TLID is quoted (and may hold commas)
+            if b'"' in line[:len(line) - len(fields[-1])]:
+                fields = [field.encode() for field in next(csv.reader([line.decode()]))]
+            if len(fields) > tlid_col and fields[tlid_col].strip():
+                tlids.append(int(fields[tlid_col]))
+                offsets.append(offset)
+                lengths.append(len(line))
+            offset += len(line)
+    tlids = np.array(tlids, dtype=np.int64)
+    order = np.argsort(tlids, kind='stable')
+    return {'header': header, 'tlids': tlids[order],
+            'offsets': np.array(offsets, dtype=np.int64)[order], 'lengths': np.array(lengths, dtype=np.int64)[order]}
+
+
+def load_offset_index(county_code='08031'):
+    """
+    Offset index of a county's edges file, from the stage cache if the file is unchanged
+    """
+    cache = stage_cache.StageCache(county_code)
+    return cache.cached('edge_offsets', lambda: build_offset_index(edges_path(county_code)))
+
+
+def build_box_index(path):
+    """
+    Finds the bounding box of every edge in an edges CSV
+
+    Parameters
+    ----------
+    path: str
+            path to a csv-converted TIGER edges file
+
+    Returns
+    -------
+    index: dict
+            'tlids' array, sorted, and 'boxes' array of the (minx, miny, maxx,
+            maxy) box of each TLID
+    """
+    tlids, boxes = [], []
+    for chunk in pd.read_csv(path, usecols=['TLID', 'geometry'], chunksize=CHUNK_ROWS):
+        chunk = chunk[chunk['TLID'].notnull() & chunk['geometry'].notnull()]
+        tlids.append(chunk['TLID'].values.astype(np.int64))
+        boxes.append(shapely.bounds(shapely.from_wkt(chunk['geometry'].values)).reshape(-1, 4))
+    tlids = np.concatenate(tlids) if tlids else np.zeros(0, dtype=np.int64)
+    boxes = np.concatenate(boxes) if boxes else np.zeros((0, 4))
+    order = np.argsort(tlids, kind='stable')
+    return {'tlids': tlids[order], 'boxes': boxes[order]}
+
+
+def load_box_index(county_code='08031'):
+    """
+    Box index of a county's edges file, from the stage cache if the file is unchanged
+    """
+    cache = stage_cache.StageCache(county_code)
+    return cache.cached('edge_boxes', lambda: build_box_index(edges_path(county_code)))
+
+
+def find_boxes(index, tlids):
+    """
+    Looks up the boxes of the given TLIDs in a box index
+
+    Parameters
+    ----------
+    index: dict
+            output of build_box_index
+    tlids: list
+            TLIDs, as strings or numbers
+
+    Returns
+    -------
+    boxes: np array
+            box of each TLID, in order, with nan rows for TLIDs not in the index
+    """
+    wanted = pd.to_numeric(pd.Series(list(tlids), dtype=object), errors='coerce').values
+    boxes = np.full((wanted.shape[0], 4), np.nan)
+    valid = ~np.isnan(wanted)
+    if not index['tlids'].shape[0] or not valid.any():
+        return boxes
+    wanted = wanted[valid].astype(np.int64)
+    position = np.clip(np.searchsorted(index['tlids'], wanted), 0, index['tlids'].shape[0] - 1)
+    found = index['tlids'][position] == wanted
+    rows = np.flatnonzero(valid)[found]
+    boxes[rows] = index['boxes'][position[found]]
+    return boxes
+
+
+def tlid_ints(tlids):
+    """
+    Converts TLIDs (as strings or numbers) to a sorted array of unique integers,
+    ignoring values that are not TLIDs
+    """
+    values = pd.to_numeric(pd.Series(list(tlids), dtype=object), errors='coerce').dropna()
+    return np.unique(values.astype(np.int64).values)
+
+
+def read_indexed(path, index, tlids, columns):
+    """
+    Reads the rows of the given TLIDs from an edges file, using its offset index
+    """
+    wanted = tlid_ints(tlids)
+    # The index is sorted by TLID, so each wanted TLID is a binary search away
+    position = np.clip(np.searchsorted(index['tlids'], wanted), 0, max(index['tlids'].shape[0] - 1, 0))
+    found = index['tlids'][position] == wanted if index['tlids'].shape[0] else np.zeros(0, bool)
+    rows = position[found]
+    # Read in file order, so that the disk is read forwards
+    offsets, lengths = index['offsets'][rows], index['lengths'][rows]
+    order = np.argsort(offsets)
+    lines = []
+    with open(path, 'rb') as f:
+        for offset, length in zip(offsets[order], lengths[order]):
+            f.seek(offset)
+            lines.append(f.read(length).decode())
+    edges = pd.DataFrame(list(csv.reader(lines)), columns=index['header'])
+    return edges if columns is None else edges[columns]
+
+
+def read_filtered(path, tlids, columns):
+    """
+    Reads the rows of the given TLIDs from an edges file in chunks, without an index
+    """
+    wanted = set(str(tlid) for tlid in tlids)
+    chunks = pd.read_csv(path, usecols=columns, converters={'TLID': lambda x: str(x)}, chunksize=CHUNK_ROWS)
+    return pd.concat([chunk[chunk['TLID'].isin(wanted)] for chunk in chunks], ignore_index=True)
+
+
+def read_edges(county_code='08031', tlids=None, columns=['TLID', 'geometry'], use_index=True):
+    """
+    Loads edges of a county, limited to the given TLIDs
+
+    Parameters
+    ----------
+    county_code: str
+            fips code for county
+    tlids: iterable
+            TLIDs to load, or None to load every edge
+    columns: list
+            columns to load, or None for all of them
+    use_index: bool
+            if true, finds the rows with the file's offset index, building it if
+            needed, otherwise reads the file in chunks
+
+    Returns
+    -------
+    edges: pd DataFrame
+            the requested columns for the rows of the requested TLIDs, with
+            TLIDs as strings, in file order
+    """
+    path = edges_path(county_code)
+    with instrument.stage('read_edges', indexed=use_index and tlids is not None) as record:
+        if tlids is None:
+            edges = pd.read_csv(path, usecols=columns, converters={'TLID': lambda x: str(x)})
+        elif use_index:
+            edges = read_indexed(path, load_offset_index(county_code), tlids, columns)
+        else:
+            edges = read_filtered(path, tlids, columns)
+        record['rows'] = edges.shape[0]
+    logger.info("Loaded %d edges", edges.shape[0])
+    return edges
+
+
+def candidate_tlids(xwalk):
+    """
+    TLIDs in the crosswalk's multi-option candidate lists, which are the only
+    ones whose geometry is used by the distance calculations
+
+    Parameters
+    ----------
+    xwalk: pd DataFrame
+            crosswalk, where TLIDs is a column of lists
+    """
+    tlids = set()
+    for candidates in xwalk['TLIDs']:
+        if isinstance(candidates, list) and len(candidates) > 1:
+            tlids.update(candidates)
+    return tlids
@@ -0,0 +1,368 @@
+import os
+import json
+import shutil
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import instrument
+import matching_service
+import results_store
+import match_tlid
+import block_assign
+
+"""
+This script matches new address batches to TLIDs incrementally, instead of
+rematching every address in the county with match_tlid.match_county_tlid.
+
+A persistent match store, keyed by MAFID, holds the TLID match of every address
+seen so far, along with a hash of the address fields used for matching (MAF_NAME,
+BLKID, LATITUDE and LONGITUDE). Each refresh only matches rows that are new, or
+whose fields have changed since they were matched, using the county index of
+matching_service.py (which is cached for as long as the crosswalk and TIGER edges
+are unchanged). Name-block combinations that are not in the crosswalk go through
+the index's name match fallback (see matching_service.NameFallback). Addresses
+that got no match are kept with their fields, and are matched again on every
+refresh, whether or not they are in the batch.
+
+The results are appended to the store's log, so a refresh writes only the delta.
+The store's base holds MAFID-sorted arrays (as in results_store.py) that are
+memory-mapped, and the stored hashes of a batch are found with a binary search,
+so a refresh reads the pages of the batch's MAFIDs rather than the whole store.
+The log is folded into the base once it has more rows than the base.
+
+If the crosswalk or the TIGER edges change (for example, for a new TIGER vintage),
+the store is cleared and every address is rematched.
+
+Example:
+    python incremental_match.py --county-code 08031 --batch ../data/addresses/08031_new.csv
+"""
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = "../results/incremental/"
+
+MATCH_FIELDS = ['MAF_NAME', 'BLKID', 'LATITUDE', 'LONGITUDE']
+
+
+def row_hashes(addresses):
+    """
+    Hashes the fields used for matching, for each address
+
+    Parameters
+    ----------
+    addresses: pd DataFrame
+            of address points, with MAFID and MATCH_FIELDS
+
+    Returns
+    -------
+    hashes: pd Series
+            uint64 hash of each row, indexed by MAFID
+    """
+    hashes = pd.util.hash_pandas_object(addresses[MATCH_FIELDS].astype(str), index=False)
+    return pd.Series(hashes.values, index=addresses['MAFID'].values, name='ROW_HASH')
+
+
+class MatchStore(object):
+    """
+    Append-only store of TLID matches for one county
+
+    The store's base is a directory of MAFID-sorted .npy arrays: MAFIDs (int64),
+    row hashes (uint64) and TLID matches (int64, -1 for none). New matches are
+    appended to a log CSV with MAFID, ROW_HASH and TLID_match columns, whose rows
+    replace those of the base. The fields of the addresses without a match are
+    kept in a separate CSV, and a JSON file records the key of the county index
+    the matches were made with.
+
+    Parameters
+    ----------
+    county_code: str
+            fips code for county
+    store_dir: str
+            directory of the store's files
+    """
+    def __init__(self, county_code='08031', store_dir=STORE_DIR):
+        self.base_path = store_dir + county_code + "_matches/"
+        self.log_path = store_dir + county_code + "_matches_log.csv"
+        self.unmatched_path = store_dir + county_code + "_unmatched.csv"
+        self.meta_path = store_dir + county_code + "_matches.json"
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+    def index_key(self):
+        """
+        Key of the county index used for the stored matches, or None for an empty store
+        """
+        if not os.path.exists(self.meta_path):
+            return None
+        with open(self.meta_path) as f:
+            return json.load(f)['index_key']
+
+    def reset(self, index_key):
+        """
+        Deletes all stored matches, and records the key of the new county index
+        """
+        if os.path.exists(self.base_path):
+            shutil.rmtree(self.base_path)
+        for path in (self.log_path, self.unmatched_path):
+            if os.path.exists(path):
+                os.remove(path)
+        with open(self.meta_path, 'w') as f:
+            json.dump({'index_key': index_key}, f)
+
+    def base(self):
+        """
+        Returns
+        -------
+        mafids, hashes, tlids: np array, np array, np array
+                the base arrays, memory-mapped
+        """
+        if not os.path.exists(self.base_path):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+        return tuple(np.load(self.base_path + name + '.npy', mmap_mode='r') for name in ('mafids', 'hashes', 'tlids'))
+
+    def read_log(self):
+        """
+        Returns
+        -------
+        log: pd DataFrame
+                latest ROW_HASH and TLID_match (-1 for none) of each MAFID in the
+                log, indexed by MAFID
+        """
+        if not os.path.exists(self.log_path):
+            return pd.DataFrame({'ROW_HASH': pd.Series(dtype='uint64'), 'TLID_match': pd.Series(dtype='int64')},
+                                index=pd.Index([], name='MAFID', dtype='int64'))
+        log = pd.read_csv(self.log_path, index_col='MAFID', dtype={'MAFID': 'int64', 'ROW_HASH': 'uint64',
+                                                                   'TLID_match': 'int64'})
+        return log[~log.index.duplicated(keep='last')]
+
+    def stored_hashes(self, mafids, log):
+        """
+        Latest stored row hashes of some MAFIDs
+
+        Parameters
+        ----------
+        mafids: np array
+                int64 MAFIDs
+        log: pd DataFrame
+                as returned by read_log
+
+        Returns
+        -------
+        hashes: np array
+                uint64 hash of each MAFID's stored row
+        found: np array
+                boolean, false for MAFIDs that are not stored
+        """
+        base_mafids, base_hashes, _ = self.base()
+        hashes = np.zeros(mafids.shape[0], dtype=np.uint64)
+        found = np.zeros(mafids.shape[0], dtype=bool)
+        if base_mafids.shape[0]:
+            rows = np.minimum(np.searchsorted(base_mafids, mafids), base_mafids.shape[0] - 1)
+            found = base_mafids[rows] == mafids
+            hashes[found] = base_hashes[rows[found]]
+        in_log = log.index.get_indexer(mafids)
+        logged = in_log >= 0
+        hashes[logged] = log['ROW_HASH'].values[in_log[logged]]
+        return hashes, found | logged
+
+    def append(self, delta):
+        """
+        Appends new matches to the log
+
+        Parameters
+        ----------
+        delta: pd DataFrame
+                ROW_HASH and TLID_match (-1 for none), indexed by MAFID
+        """
+        delta.to_csv(self.log_path, mode='a', header=not os.path.exists(self.log_path), index_label='MAFID')
+
+    def read_unmatched(self):
+        """
+        Returns
+        -------
+        unmatched: pd DataFrame
+                MAFID and MATCH_FIELDS of the stored addresses without a match
+        """
+        if not os.path.exists(self.unmatched_path):
+            return pd.DataFrame(columns=['MAFID'] + MATCH_FIELDS)
+        return pd.read_csv(self.unmatched_path, converters={'BLKID': lambda x: str(x)})
+
+    def write_unmatched(self, unmatched):
+        """
+        Replaces the addresses without a match
+        """
+        unmatched[['MAFID'] + MATCH_FIELDS].to_csv(self.unmatched_path, index=False)
+
+    def compact(self, log):
+        """
+        Folds the log into the base, and empties the log
+
+        Parameters
+        ----------
+        log: pd DataFrame
+                as returned by read_log
+        """
+        base_mafids, base_hashes, base_tlids = self.base()
+        kept = ~np.isin(base_mafids, log.index.values)
+        mafids = np.concatenate([base_mafids[kept], log.index.values.astype(np.int64)])
+        order = np.argsort(mafids, kind='stable')
+        arrays = {'mafids': mafids[order],
+                  'hashes': np.concatenate([base_hashes[kept], log['ROW_HASH'].values.astype(np.uint64)])[order],
+                  'tlids': np.concatenate([base_tlids[kept], log['TLID_match'].values.astype(np.int64)])[order]}
+        tmp_path = self.base_path.rstrip('/') + '.tmp/'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name, values in arrays.items():
+            np.save(tmp_path + name + '.npy', values)
+        if os.path.exists(self.base_path):
+            shutil.rmtree(self.base_path)
+        os.replace(tmp_path, self.base_path)
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+    def log_is_large(self, log):
+        """
+        True when the log has more rows than the base
+        """
+        return log.shape[0] > self.base()[0].shape[0]
+
+    def matches(self, log):
+        """
+        All stored matches
+
+        Returns
+        -------
+        results: dict
+                MAFID as keys and TLID match (or None) as values
+        """
+        base_mafids, _, base_tlids = self.base()
+        tlids = pd.concat([pd.Series(np.asarray(base_tlids), index=np.asarray(base_mafids)), log['TLID_match']])
+        tlids = tlids[~tlids.index.duplicated(keep='last')]
+        return {mafid: (tlid if tlid >= 0 else None) for mafid, tlid in tlids.items()}
+
+
+def find_delta(addresses, store, log):
+    """
+    Finds addresses that are not in the store, whose match fields changed, or
+    that have no match yet, along with the store's other addresses without a
+    match
+
+    Parameters
+    ----------
+    addresses: pd DataFrame
+            of address points, with integer MAFIDs and MATCH_FIELDS
+    store: MatchStore
+    log: pd DataFrame
+            the store's log, as returned by MatchStore.read_log
+
+    Returns
+    -------
+    delta: pd DataFrame
+            the rows to match, with MAFID, MATCH_FIELDS and ROW_HASH columns
+    """
+    hashes = row_hashes(addresses)
+    stored, found = store.stored_hashes(results_store.int_ids(hashes.index, 'MAFID'), log)
+    unmatched = store.read_unmatched()
+    retry = np.isin(addresses['MAFID'].values, unmatched['MAFID'].values)
+    changed = ~found | (stored != hashes.values) | retry
+    instrument.count('retried_unmatched', unmatched.shape[0])
+    delta = addresses.loc[changed, ['MAFID'] + MATCH_FIELDS]
+    unmatched = unmatched.loc[~np.isin(unmatched['MAFID'].values, addresses['MAFID'].values)]
+    if unmatched.shape[0] > 0:
+        delta = pd.concat([delta, unmatched], ignore_index=True)
+    return delta.assign(ROW_HASH=row_hashes(delta).values)
+
+
+def match_rows(index, rows):
+    """
+    Matches address rows with a county index
+
+    Returns
+    -------
+    tlids: list
+            TLID match (or None) of each row
+    """
+    return [index.match(maf_name, blkid, lat, lon)[0] for maf_name, blkid, lat, lon in
+            zip(rows['MAF_NAME'].astype(str), rows['BLKID'].astype(str), rows['LATITUDE'], rows['LONGITUDE'])]
+
+
+def match_increment(county_code='08031', addresses=None, write_results=False):
+    """
+    Matches new and changed addresses, and those still without a match, and
+    merges them into the county's match store
+
+    Parameters
+    ----------
+    county_code: str
+            fips code for county
+    addresses: pd DataFrame or str
+            address rows (or the path to a CSV of them) with MAFID and
+            MATCH_FIELDS. This can be a batch of new addresses, or the county's
+            full address file, in which case unchanged rows are skipped. Defaults
+            to the county's address file.
+    write_results: bool
+            if true, also writes the full match table to the file written by
+            match_tlid.match_county_tlid. This takes time in proportion to the
+            county rather than the delta.
+
+    Returns
+    -------
+    delta_results: dict
+            synthetic MAFID as keys and TLID match (or None) as values, for the
+            rows that were matched in this run
+    """
+    with instrument.run('match_increment', county_code=county_code):
+        with instrument.stage('load') as record:
+            if addresses is None:
+                addresses = "../data/addresses/" + county_code + "_addresses.csv"
+            if isinstance(addresses, str):
+                addresses = pd.read_csv(addresses, converters={'BLKID': lambda x: str(x)})
+            addresses = block_assign.fill_missing_blocks(addresses, county_code=county_code)
+            cache = matching_service.index_cache(county_code)
+            index = cache.cached('index', lambda: matching_service.build_county_index(county_code))
+            store = MatchStore(county_code)
+            if store.index_key() != cache.key('index'):
+                logger.info("Crosswalk or edges changed, rematching all addresses")
+                store.reset(cache.key('index'))
+                record['reset'] = True
+            log = store.read_log()
+            record['rows'], record['logged'] = addresses.shape[0], log.shape[0]
+
+        with instrument.stage('delta') as record:
+            delta = find_delta(addresses, store, log)
+            record['rows'] = delta.shape[0]
+        logger.info("Matching %d new, changed or unmatched addresses (batch of %d)", delta.shape[0],
+                    addresses.shape[0])
+
+        with instrument.stage('match') as record:
+            tlids = match_rows(index, delta)
+            delta_matches = pd.DataFrame({'ROW_HASH': delta['ROW_HASH'].values,
+                                          'TLID_match': results_store.int_ids(tlids, 'TLID')},
+                                         index=pd.Index(delta['MAFID'].values, name='MAFID'))
+            record['rows'] = delta_matches.shape[0]
+            record['unmatched'] = int((delta_matches['TLID_match'] < 0).sum())
+
+        with instrument.stage('store') as record:
+            if delta_matches.shape[0] > 0:
+                store.append(delta_matches)
+                log = pd.concat([log, delta_matches])
+                log = log[~log.index.duplicated(keep='last')]
+            store.write_unmatched(delta.loc[(delta_matches['TLID_match'] < 0).values])
+            if write_results:
+                match_tlid.write_results(store.matches(log), county_code=county_code)
+            if store.log_is_large(log):
+                store.compact(log)
+                record['compacted'] = True
+    return dict(zip(delta['MAFID'].tolist(), tlids))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Match new and changed addresses into a county's match store")
+    parser.add_argument('--county-code', default='08031')
+    parser.add_argument('--batch', default=None, help="CSV of new address rows, defaults to the full address file")
+    parser.add_argument('--write-results', action='store_true')
+    args = parser.parse_args()
+    instrument.configure_logging()
+    match_increment(county_code=args.county_code, addresses=args.batch, write_results=args.write_results)
@@ -0,0 +1,313 @@
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+import tracemalloc
+import contextlib
+import contextvars
+from collections import Counter, defaultdict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+"""
+This script contains the instrumentation used to report progress from the other
+scripts, in place of print statements.
+
+Each top-level call (for example tiger_xwalk.process_county or
+match_tlid.match_county_tlid) is a run, made of named stages. Stages record wall
+time, peak memory, row counts, and any counters incremented while they were active.
+One JSON record is logged per stage, and one per run, to the 'metrics' logger. Hot
+loops only increment counters (which cost next to nothing when no run is active),
+and log individual events at DEBUG level, so they stay silent by default.
+
+Work done ahead of its run (such as reading the next county's files while the
+current county is processed, see prefetch.py) is collected in a buffer, and
+replayed into its own run once that run starts, rather than being counted in the
+run that happens to be active.
+
+Example:
+    instrument.configure_logging(level='INFO', metrics_path='../results/metrics.jsonl')
+    with instrument.run('my_run', county_code='08031'):
+        with instrument.stage('load') as record:
+            df = load()
+            record['rows'] = df.shape[0]
+"""
+
+logger = logging.getLogger(__name__)
+metrics_logger = logging.getLogger('metrics')
+
+# The active run, if any
+CURRENT = None
+
+# Buffer that the stages and counters of the current context go to instead of CURRENT
+BUFFER = contextvars.ContextVar('instrument_buffer', default=None)
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of the current process, in megabytes, or None where
+    the resource module is not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak / 1024 ** 2
+    return peak / 1024
+
+
+class RunMetrics(object):
+    """
+    Collects stage records and counters for a single run
+
+    Parameters
+    ----------
+    name: str
+            name of the run
+    params: dict
+            parameters of the run, such as county code, included in every record
+    trace_memory: bool
+            if true, uses tracemalloc to record the peak memory allocated by Python
+            within each stage. This is more precise than the process peak, but
+            slows the run down.
+    buffered: bool
+            if true, stage records are only kept, not logged, until they are
+            replayed into another run (see buffer)
+    """
+    def __init__(self, name, params, trace_memory=False, buffered=False):
+        self.name = name
+        self.params = params
+        self.buffered = buffered
+        self.run_id = uuid.uuid4().hex[:12]
+        self.trace_memory = trace_memory
+        self.counters = Counter()
+        self.histograms = defaultdict(Counter)
+        self.values = {}
+        self.stages = []
+        # Stages can run on several threads at once (see prefetch.py), each with its own nesting
+        self.local = threading.local()
+        self.t0 = time.time()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @property
+    def stage_stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def emit(self, record):
+        if not self.buffered:
+            metrics_logger.info(json.dumps(record, default=str))
+
+    def replay(self, buffered):
+        """
+        Logs the stage records of a buffer as stages of this run (marked as
+        'buffered'), and adds its counters, histograms and values to this run's
+        """
+        for record in buffered.stages:
+            record = dict(record, run=self.name, run_id=self.run_id, buffered=buffered.name,
+                          stage='/'.join(self.stage_stack + [record['stage']]))
+            self.stages.append(record)
+            self.emit(record)
+        self.counters.update(buffered.counters)
+        for name, counts in buffered.histograms.items():
+            self.histograms[name].update(counts)
+        self.values.update(buffered.values)
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """
+        Times a stage, yielding its record so that row counts and other fields
+        can be added to it. Nested stages are named parent/child.
+        """
+        full_name = '/'.join(self.stage_stack + [name])
+        self.stage_stack.append(name)
+        record = {'type': 'stage', 'run': self.name, 'run_id': self.run_id, 'stage': full_name}
+        record.update(fields)
+        counters_before = self.counters.copy()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        t0 = time.time()
+        logger.debug("Starting stage %s", full_name)
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.time() - t0
+            record['peak_rss_mb'] = peak_rss_mb()
+            if self.trace_memory:
+                record['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            counters = self.counters - counters_before
+            if counters:
+                record['counters'] = dict(counters)
+            self.stage_stack.pop()
+            self.stages.append(record)
+            self.emit(record)
+
+    def finish(self):
+        """
+        Logs the run record: total time, peak memory, counters, histograms, values
+        set during the run, and a summary of the time spent in each stage
+        """
+        record = {'type': 'run', 'run': self.name, 'run_id': self.run_id, 'params': self.params,
+                  'seconds': time.time() - self.t0, 'peak_rss_mb': peak_rss_mb(),
+                  'counters': dict(self.counters),
+                  'histograms': {k: dict(sorted(v.items())) for k, v in self.histograms.items()},
+                  'stages': {s['stage']: s['seconds'] for s in self.stages}}
+        record.update(self.values)
+        self.emit(record)
+        return record
+
+
+@contextlib.contextmanager
+def run(name, trace_memory=False, **params):
+    """
+    Starts a run. If a run is already active (for example when process_county is
+    called from a larger pipeline), this is treated as a stage of that run.
+
+    Parameters
+    ----------
+    name: str
+            name of the run
+    trace_memory: bool
+            if true, records per-stage Python memory peaks with tracemalloc
+    params: dict
+            parameters recorded with the run
+
+    Yields
+    ------
+    metrics: RunMetrics
+    """
+    global CURRENT
+    metrics = active()
+    if metrics is not None:
+        with metrics.stage(name, **params):
+            yield metrics
+        return
+
+    CURRENT = RunMetrics(name, params, trace_memory=trace_memory)
+    try:
+        yield CURRENT
+    finally:
+        metrics, CURRENT = CURRENT, None
+        metrics.finish()
+
+
+def active():
+    """
+    The run that stages and counters go to: the buffer of the current context
+    (see buffer), or else the active run, if any
+    """
+    metrics = BUFFER.get()
+    return metrics if metrics is not None else CURRENT
+
+
+@contextlib.contextmanager
+def buffer(name, **params):
+    """
+    Collects the stages and counters of the enclosed code, including functions
+    run with prefetch.run_concurrently, without logging them, so that they can be
+    replayed into the run they belong to with RunMetrics.replay
+
+    Parameters
+    ----------
+    name: str
+            name of the buffered work, recorded with its replayed stages
+    params: dict
+            parameters of the buffered work, such as county code
+
+    Yields
+    ------
+    metrics: RunMetrics
+            the buffer
+    """
+    metrics = RunMetrics(name, params, buffered=True)
+    token = BUFFER.set(metrics)
+    try:
+        yield metrics
+    finally:
+        BUFFER.reset(token)
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """
+    Times a stage of the active run. Without an active run, yields a record
+    that is filled in but not logged.
+    """
+    metrics = active()
+    if metrics is not None:
+        with metrics.stage(name, **fields) as record:
+            yield record
+        return
+
+    record = dict(fields, stage=name)
+    t0 = time.time()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.time() - t0
+
+
+def count(name, n=1):
+    """
+    Increments a counter of the active run
+    """
+    metrics = active()
+    if metrics is not None:
+        metrics.counters[name] += n
+
+
+def observe_counts(name, value_counts):
+    """
+    Adds counts to a histogram of the active run
+
+    Parameters
+    ----------
+    name: str
+            name of the histogram
+    value_counts: dict or pd Series
+            count of observations for each value
+    """
+    metrics = active()
+    if metrics is not None:
+        for value, n in dict(value_counts).items():
+            metrics.histograms[name][str(value)] += int(n)
+
+
+def set_value(name, value):
+    """
+    Sets a value (such as a rate) to be included in the run record
+    """
+    metrics = active()
+    if metrics is not None:
+        metrics.values[name] = value
+
+
+def configure_logging(level='INFO', metrics_path=None):
+    """
+    Sets up logging for the scripts' main functions. Progress messages are written
+    to stderr at the given level, along with metrics records. If metrics_path is
+    given, metrics records are instead appended there, one JSON object per line.
+
+    Parameters
+    ----------
+    level: str or int
+            logging level for progress messages. DEBUG shows per-address events
+            from the matching loops.
+    metrics_path: str
+            JSON lines file for stage and run records
+    """
+    logging.basicConfig(level=level, format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+    if metrics_path is not None:
+        handler = logging.FileHandler(metrics_path)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        metrics_logger.addHandler(handler)
+        metrics_logger.setLevel(logging.INFO)
+        metrics_logger.propagate = False
@@ -1,19 +1,21 @@
 from glob import glob
 import os
+import logging
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 
+logger = logging.getLogger(__name__)
+
 def make_csv(dir, columns=[]):
   shapefiles = glob(dir + "/*/")
   gpd_files = [gpd.read_file(shapefile + os.path.basename(os.path.normpath(shapefile)) + '.shp') for shapefile in shapefiles]
   merged_df = pd.concat(gpd_files)[columns]
-  print(dir + 'all_counties.csv')
-  print(list(merged_df))
-  print(merged_df.shape)
-  print('\n\n\n', merged_df.head())
+  logger.info("Writing %s with shape %s", dir + 'all_counties.csv', merged_df.shape)
+  logger.debug("Columns: %s\n%s", list(merged_df), merged_df.head())
   merged_df.to_csv(dir + 'all_counties.csv')
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     make_csv('./edges/', ['STATEFP', 'COUNTYFP', 'TLID', 'TFIDL', 'TFIDR', 'MTFCC', 'FULLNAME', 'ROADFLG','TNIDF','TNIDT','geometry'])
     make_csv('./faces/', ['STATEFP10','COUNTYFP10','TRACTCE10','BLOCKCE10','TFID','geometry'])
@@ -2,6 +2,16 @@ import pandas as pd
 import numpy as np
 import csv
 import os
+import logging
+import instrument
+import profiling
+import stage_cache
+import block_sides
+import spatial_sort
+import edge_store
+import prefetch
+import results_store
+import sampling
 import match_tlid_utils as tlid_utils
 
 """
@@ -12,10 +22,12 @@ address. There is a column in this table called "TLID_match," which contains
 the Tiger Line Identifier for the closest street segment.
 """
 
-def county_to_dicts(county_code='08031', sample=True):
+logger = logging.getLogger(__name__)
+
+def county_to_dicts(county_code='08031', sample=True, sort_curve=None, seed=sampling.DEFAULT_SEED, budget=None):
     """
-    Imports address points, crosswalk from tiger_xwalk.py, and TIGER edges data
-    Merges addresses with crosswalk, indexing on synthetic MAFID. Identifies addresses
+    Imports address points, crosswalk from tiger_xwalk.py, and the TIGER edges in
+    the crosswalk's multi-option candidate lists (the only ones that are used). Merges addresses with crosswalk, indexing on synthetic MAFID. Identifies addresses
     with only one TLID option and assigns match. Seperates ones with multiple TLID options
     for distance-based matching. Both single-option and multi-option addresses are stored
     in dictionaries. Stores wkt geometry of TLID possibilities in a dictionary
@@ -25,8 +37,17 @@ def county_to_dicts(county_code='08031', sample=True):
     ----------
     county_code: str
             fips code for county
-    sample: bool
-            if true, only process 10% of addresses
+    sample: bool or float
+            if true, only process a stratified 10% sample of addresses (or this
+            fraction, if a number; see sampling.py)
+    sort_curve: str
+            if 'hilbert' or 'zorder', addresses are sorted along that curve
+            before merging and matching (see spatial_sort.py)
+    seed: int
+            random seed of the sample
+    budget: float
+            if given with sample, the sample is sized to about this many seconds
+            of matching
 
     Returns
     -------
@@ -41,18 +62,66 @@ def county_to_dicts(county_code='08031', sample=True):
             TLIDs as keys and WKT geometries as values
     """
     # Import data and convert to dictionaries
-    addresses, edges = tlid_utils.import_data(county_code=county_code, sample=sample)
-    xwalk = tlid_utils.import_xwalk(county_code=county_code)
-    maf_xwalk = tlid_utils.merge_xwalk_addresses(addresses, xwalk)
+    with instrument.stage('load') as record:
+        # The edges needed depend on the crosswalk, but the addresses can be read meanwhile
+        def import_xwalk_edges():
+            xwalk = tlid_utils.import_xwalk(county_code=county_code)
+            return xwalk, tlid_utils.import_edges(county_code=county_code, tlids=edge_store.candidate_tlids(xwalk))
+
+        addresses, (xwalk, edges) = prefetch.run_concurrently(
+            lambda: tlid_utils.import_addresses(county_code=county_code, sample=sample, seed=seed, budget=budget),
+            import_xwalk_edges)
+        record['addresses'], record['edges'], record['xwalk'] = addresses.shape[0], edges.shape[0], xwalk.shape[0]
+
+    return tables_to_dicts(addresses, edges, xwalk, sort_curve=sort_curve)
+
+def tables_to_dicts(addresses, edges, xwalk, sort_curve=None):
+    """
+    Merges addresses with the crosswalk, and splits them into single-option
+    and multi-option dictionaries, as in county_to_dicts. Takes tables that are
+    already in memory, such as those passed between stages by pipeline.py.
+
+    Parameters
+    ----------
+    addresses: pd DataFrame
+            of address points, with MAFID, MAF_NAME, BLKID, LATITUDE and LONGITUDE
+    edges: pd DataFrame
+            of edges lines, indexed by TLID, with WKT geometry
+    xwalk: pd DataFrame
+            crosswalk, where TLIDs is a column of lists
+    sort_curve: str
+            if 'hilbert' or 'zorder', addresses are sorted along that curve
+            before merging, so that they are matched in spatial order
+
+    Returns
+    -------
+    single_match, multi_match, geom_list: dict, dict, dict
+            as returned by county_to_dicts
+    """
+    if sort_curve is not None:
+        with instrument.stage('spatial_sort', curve=sort_curve):
+            addresses = spatial_sort.spatial_sort(addresses, curve=sort_curve)
+
+    with instrument.stage('merge') as record:
+        maf_xwalk = tlid_utils.merge_xwalk_addresses(addresses, xwalk)
+        record['rows'] = maf_xwalk.shape[0]
 
-    single_match = tlid_utils.get_single_TLID_addresses(maf_xwalk)
-    multi_match = tlid_utils.get_multi_TLID_addresses(maf_xwalk)
-    geom_list = tlid_utils.get_candidate_geoms(multi_match, edges)
+    with instrument.stage('split_options'):
+        single_match = tlid_utils.get_single_TLID_addresses(maf_xwalk)
+        multi_match = tlid_utils.get_multi_TLID_addresses(maf_xwalk)
+    n = max(maf_xwalk.shape[0], 1)
+    instrument.set_value('option_rates', {'single': len(single_match) / n,
+                                          'multi': len(multi_match) / n,
+                                          'none': (maf_xwalk.shape[0] - len(single_match) - len(multi_match)) / n})
 
+    with instrument.stage('candidate_geoms') as record:
+        geom_list = tlid_utils.get_candidate_geoms(multi_match, edges)
+        record['rows'] = len(geom_list)
 
     return single_match, multi_match, geom_list
 
-def match_an_address(id, attributes, geom_list):
+def match_an_address(id, attributes, geom_list, codec=tlid_utils.DEFAULT_CODEC, bounds=None, margins=False,
+                     side_list=None):
     """
     Applies match_tlid_utils.find_closest to a single address. Extracts both
     line geometries from geom_list, and point coordinates from input dictionary.
@@ -68,6 +137,17 @@ def match_an_address(id, attributes, geom_list):
     geom_list:dict
             dictionary, where key is a MAFID and value is a dictionary with
             TLIDs as keys and WKT geometries as values
+    codec: match_tlid_utils.CoordinateCodec
+            storage type of the coordinates in the distance calculation
+    bounds: dict
+            bounding box of each candidate TLID, used to skip candidates that
+            cannot be the closest (see match_tlid_utils.candidate_bounds)
+    margins: bool
+            if true, v is the tuple of match margins returned by
+            match_tlid_utils.find_closest instead of the TLID
+    side_list: dict
+            merged block sides of the addresses whose candidates are whole
+            sides, as returned by match_tlid_utils.candidate_sides
     Returns
     -------
     k, v: str, str
@@ -75,11 +155,14 @@ def match_an_address(id, attributes, geom_list):
     """
     # Get dictionary of geom of all possible TLIDs
     linedict = geom_list[id]
-    point = np.array((float(attributes['LATITUDE']), float(attributes['LONGITUDE'])))
-    k, v = id, tlid_utils.find_closest(linedict, point)
+    # Order coordinates as (x, y) to match the WKT vertices
+    point = np.array((float(attributes['LONGITUDE']), float(attributes['LATITUDE'])))
+    sides = side_list.get(id) if side_list is not None else None
+    k, v = id, tlid_utils.find_closest(linedict, point, codec=codec, bounds=bounds, margins=margins, sides=sides)
     return k, v
 
-def match_generator(multi_match, geom_list):
+def match_generator(multi_match, geom_list, codec=tlid_utils.DEFAULT_CODEC, bounds=None, margins=False,
+                    side_list=None):
     """
     Applies match_an_address to entire dictionary of addresses with multiple options
     using a generator list comprehension. Converts results to a dictionary.
@@ -92,6 +175,14 @@ def match_generator(multi_match, geom_list):
     geom_list:dict
             dictionary, where key is a MAFID and value is a dictionary with
             TLIDs as keys and WKT geometries as values
+    codec: match_tlid_utils.CoordinateCodec
+            storage type of the coordinates in the distance calculation
+    bounds: dict
+            bounding box of each candidate TLID (see match_an_address)
+    margins: bool
+            if true, values are tuples of match margins (see match_an_address)
+    side_list: dict
+            merged block sides of addresses (see match_an_address)
 
     Returns
     -------
@@ -99,42 +190,246 @@ def match_generator(multi_match, geom_list):
             results dictionary -- contains results for one-option addresses, synthetic
             MAFID as keys and TLID as values
     """
-    results_list = (match_an_address(id, attributes, geom_list) for id, attributes in multi_match.items())
+    results_list = (match_an_address(id, attributes, geom_list, codec=codec, bounds=bounds, margins=margins,
+                                     side_list=side_list)
+                    for id, attributes in multi_match.items())
     return dict(results_list)
 
 
-def match_county_tlid(county_code='08031', sample=False):
+def match_dicts(single, multi, geom_list, coords='float64', prune=True, margins=False, sides=None,
+                box_index=None):
     """
-    Opens data, crosswalk, and edges file and performs TLID match for address points.
-    Saves results as a csv named "address_tlid_xwalk/[[county_code]]_tlid_match.csv"
+    Matches multi-option addresses and combines them with single-option ones
+
+    Parameters
+    ----------
+    single, multi, geom_list: dict, dict, dict
+            as returned by county_to_dicts or tables_to_dicts
+    coords: str
+            storage type of coordinates in the distance calculation: 'float64',
+            or 'float32' or 'fixed' (int32) offsets from the south-west corner of
+            the addresses, which halve the memory of parsed geometries (see
+            match_tlid_utils.CoordinateCodec)
+    prune: bool
+            if true, finds the bounding box of every candidate line first, and
+            skips candidates whose box is farther than the closest vertex found
+            so far. Matches are the same either way.
+    box_index: dict
+            with prune, the boxes of the edges file the geometries come from (see
+            edge_store.load_box_index), so that the candidate lines are not all
+            parsed to find their boxes
+    margins: bool
+            if true, also returns the match margins of every address, found in
+            the same pass (see margins_table)
+    sides: tuple
+            block sides table and geometry (see block_sides.county_block_sides).
+            Addresses whose candidates are whole sides of their block are
+            matched on the merged side polylines. Matches are the same either
+            way.
+
+    Returns
+    -------
+    results: dict
+            synthetic MAFID as keys and TLID match as values
+    margins: pd DataFrame
+            only if margins is true, the output of margins_table
+    """
+    with instrument.stage('match', coords=coords) as record:
+        longitude = [float(attributes['LONGITUDE']) for attributes in multi.values()]
+        latitude = [float(attributes['LATITUDE']) for attributes in multi.values()]
+        codec = tlid_utils.county_codec(coords, longitude, latitude)
+        if coords != 'float64' and multi:
+            extent = max(np.nanmax(longitude) - codec.origin[0], np.nanmax(latitude) - codec.origin[1])
+            # Candidate lines extend a little beyond the addresses
+            record['coordinate_error_bound'] = codec.error_bound(extent=2 * extent)
+        bounds = tlid_utils.candidate_bounds(geom_list, codec=codec, box_index=box_index) if prune else None
+        side_list = tlid_utils.candidate_sides(multi, sides, codec=codec) if sides is not None else None
+        if side_list is not None:
+            record['side_merged_rate'] = len(side_list) / max(len(multi), 1)
+        cache_before = tlid_utils.vertex_cache.cache_info()
+        multi_results = match_generator(multi, geom_list, codec=codec, bounds=bounds, margins=margins,
+                                        side_list=side_list)
+        if margins:
+            multi_margins = multi_results
+            multi_results = {k: v[0] for k, v in multi_margins.items()}
+        record['rows'] = len(multi_results)
+        cache_after = tlid_utils.vertex_cache.cache_info()
+        lookups = (cache_after.hits + cache_after.misses) - (cache_before.hits + cache_before.misses)
+        if lookups:
+            record['geometry_cache_hit_rate'] = (cache_after.hits - cache_before.hits) / lookups
+    results = {**single, **multi_results}
+    logger.info("Length of crosswalk results: %d", len(results))
+    if margins:
+        return results, margins_table(single, multi_margins)
+    return results
+
+
+def margins_table(single, multi_margins):
+    """
+    Collects how clear each match is, so that ambiguous matches can be flagged
+    without computing distances again (as match_tlid_geo.run_distance_calc does)
+
+    Parameters
+    ----------
+    single: dict
+            single-option matches, synthetic MAFID as keys and TLID as values
+    multi_margins: dict
+            synthetic MAFID as keys and match margin tuples (see
+            match_tlid_utils.find_closest) as values
+
+    Returns
+    -------
+    margins: pd DataFrame
+            indexed by MAFID, with the match ('TLID_match'), its distance
+            ('DIST'), the second closest candidate ('SECOND_TLID') and its
+            distance ('SECOND_DIST'), the difference of the two distances
+            ('MARGIN', in degrees) and the number of candidates ('CANDIDATES').
+            Single-option addresses have no distances.
+    """
+    columns = ['TLID_match', 'DIST', 'SECOND_TLID', 'SECOND_DIST', 'CANDIDATES']
+    rows = [(tlid, np.nan, None, np.nan, 1) for tlid in single.values()] + list(multi_margins.values())
+    margins = pd.DataFrame(rows, columns=columns, index=list(single.keys()) + list(multi_margins.keys()))
+    margins.index.name = 'MAFID'
+    margins.insert(4, 'MARGIN', margins['SECOND_DIST'] - margins['DIST'])
+    return margins
+
+
+def write_results(results, county_code='08031', sample=False):
+    """
+    Saves match results as a csv named "address_tlid_xwalk/[[county_code]]_tlid_match.csv"
     where the first column is synthetic MAFID and the second column is TLID match.
 
     Parameters
     ----------
+    results: dict
+            synthetic MAFID as keys and TLID match as values
     county_code: str
             fips code for county
     sample: bool
-            if true, only process 10% of addresses
-
+            if true, results are saved with a sample file name
     """
-    single, multi, geom_list = county_to_dicts(county_code=county_code, sample=sample)
-    multi_results = match_generator(multi, geom_list)
-    results = {**single, **multi_results}
+    with instrument.stage('write') as record:
+        if not os.path.exists("../results/address_tlid_xwalk/"):
+            os.mkdir("../results/address_tlid_xwalk/")
 
-    print("Length of crosswalk results:", len(results))
+        if sample:
+            outfile_name = "../results/address_tlid_xwalk/" + county_code + "samp_tlid_match.csv"
+        else:
+            outfile_name = "../results/address_tlid_xwalk/" + county_code + "_tlid_match.csv"
+
+        with open(outfile_name, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(["MAFID", "TLID_match"])
+            for row in results.items():
+                writer.writerow(row)
+        record['rows'] = len(results)
+
+
+def write_estimates(estimates, county_code='08031'):
+    """
+    Saves the estimates from a sample run as a csv named
+    "address_tlid_xwalk/[[county_code]]samp_match_estimates.csv"
+    """
     if not os.path.exists("../results/address_tlid_xwalk/"):
         os.mkdir("../results/address_tlid_xwalk/")
+    estimates.to_csv("../results/address_tlid_xwalk/" + county_code + "samp_match_estimates.csv")
+
 
-    if sample:
-        outfile_name = "../results/address_tlid_xwalk/" + county_code + "samp_tlid_match.csv"
-    else:
-        outfile_name = "../results/address_tlid_xwalk/" + county_code + "_tlid_match.csv"
+def write_margins(margins, county_code='08031', sample=False):
+    """
+    Saves match margins as a csv named "address_tlid_xwalk/[[county_code]]_tlid_margins.csv"
+    (or "[[county_code]]samp_tlid_margins.csv" for samples)
+    """
+    with instrument.stage('write_margins') as record:
+        if not os.path.exists("../results/address_tlid_xwalk/"):
+            os.mkdir("../results/address_tlid_xwalk/")
+        suffix = "samp_tlid_margins.csv" if sample else "_tlid_margins.csv"
+        margins.to_csv("../results/address_tlid_xwalk/" + county_code + suffix)
+        record['rows'] = margins.shape[0]
 
-    with open(outfile_name, 'w') as f:
-        writer = csv.writer(f)
-        writer.writerow(["MAFID", "TLID_match"])
-        for row in results.items():
-            writer.writerow(row)
+
+def match_county_tlid(county_code='08031', sample=False, profile=False, use_cache=True, sort_curve=None,
+                      coords='float64', margins=False, seed=sampling.DEFAULT_SEED, budget=None):
+    """
+    Opens data, crosswalk, and edges file and performs TLID match for address points.
+    Saves results as a csv named "address_tlid_xwalk/[[county_code]]_tlid_match.csv"
+    where the first column is synthetic MAFID and the second column is TLID match.
+
+    Parameters
+    ----------
+    county_code: str
+            fips code for county
+    sample: bool or float
+            if true, only process a stratified 10% sample of addresses (or this
+            fraction, if a number; see sampling.py). County-wide estimates from
+            the sample, with standard errors, are logged and saved as
+            "address_tlid_xwalk/[[county_code]]samp_match_estimates.csv"
+    profile: bool
+            if true, times hot functions and samples stacks, writing the results
+            to "../results/profiles/match_county_tlid_[[county_code]]*" (see profiling.py)
+    use_cache: bool
+            if true, reuses match results from the stage cache (see stage_cache.py)
+            when the addresses, edges and crosswalk files have not changed. Samples
+            are never cached.
+    sort_curve: str
+            if 'hilbert' or 'zorder', addresses are matched in that curve's order
+            (see spatial_sort.py). Matches are the same, but rows are written in
+            curve order.
+    coords: str
+            storage type of coordinates in the distance calculation, 'float64',
+            'float32' or 'fixed' (see match_dicts)
+    margins: bool
+            if true, also finds the match margins of every address in the same
+            pass (see margins_table), and saves them as
+            "address_tlid_xwalk/[[county_code]]_tlid_margins.csv". The distances
+            are also saved in the results store.
+    seed: int
+            random seed of the sample
+    budget: float
+            if given with sample, the sample is sized to about this many seconds
+            of matching
+
+    The results are also saved as a MAFID-indexed store (see results_store.py)
+    in "address_tlid_xwalk/[[county_code]]_tlid_match/".
+
+    Returns
+    -------
+    results: dict
+            synthetic MAFID as keys and TLID match as values
+    margins: pd DataFrame
+            only if margins is true, the output of margins_table
+    """
+    with instrument.run('match_county_tlid', county_code=county_code, sample=sample, seed=seed, budget=budget), \
+            profiling.profile('match_county_tlid_' + county_code, enabled=profile):
+        cache = None
+        results = None
+        # With margins, the results and margins are cached together
+        stage = 'margins' if margins else 'match'
+        if use_cache and not sample:
+            xwalk_path = "../results/possible_tlids/" + county_code + "_address_maf_xwalk.csv"
+            cache = stage_cache.StageCache(county_code, params={'coords': coords}, files={'xwalk': xwalk_path})
+            results = cache.get(stage)
+        if results is None:
+            single, multi, geom_list = county_to_dicts(county_code=county_code, sample=sample, sort_curve=sort_curve,
+                                                       seed=seed, budget=budget)
+            sides = block_sides.county_block_sides(county_code)
+            results = match_dicts(single, multi, geom_list, coords=coords, margins=margins, sides=sides,
+                                  box_index=edge_store.load_box_index(county_code))
+            if cache is not None:
+                cache.put(stage, results)
+        if margins:
+            results, margins_df = results
+            write_margins(margins_df, county_code=county_code, sample=sample)
+        write_results(results, county_code=county_code, sample=sample)
+        results_store.write_store(results, results_store.store_path(county_code, sample=sample),
+                                  dists=margins_df['DIST'] if margins else None)
+        if sample:
+            design = sampling.county_design(county_code, sample=sample, seed=seed, budget=budget)
+            write_estimates(design.match_estimates(results, margins_df if margins else None), county_code=county_code)
+    if margins:
+        return results, margins_df
+    return results
 
 if __name__ == "__main__":
+    instrument.configure_logging()
     match_county_tlid(county_code='08031')
@@ -6,6 +6,11 @@ from shapely import ops
 from shapely import wkt
 import os
 import time
+import logging
+import instrument
+import profiling
+import edge_store
+import sampling
 
 # Hide warnings from output
 import warnings
@@ -24,7 +29,9 @@ demonstrate how the shapely approach is less efficient than a euclidean distance
 approach, as implemented in match_tlid.py
 """
 
-def import_data(county_code = '08031', spatial = True, sample=True):
+logger = logging.getLogger(__name__)
+
+def import_data(county_code = '08031', spatial = True, sample=True, tlids=None, seed=sampling.DEFAULT_SEED, budget=None):
     """
     Imports address and TIGER data
 
@@ -36,8 +43,17 @@ def import_data(county_code = '08031', spatial = True, sample=True):
             flag to load data and create spatial object with geopandas
             if false, data remain in pandas df with 'geometry' column
             containing wkt
-    sample: bool
-            if true, calculate a random 10% sample of the address data
+    sample: bool or float
+            if true, calculate a stratified 10% sample of the address data (or
+            this fraction, if a number; see sampling.py)
+    tlids: iterable
+            if given, only the edges of these TLIDs are loaded and parsed (see
+            edge_store.py)
+    seed: int
+            random seed of the sample
+    budget: float
+            if given with sample, the sample is sized to about this many seconds of
+            matching
 
     Returns
     -------
@@ -48,13 +64,21 @@ def import_data(county_code = '08031', spatial = True, sample=True):
     """
     # Open address point csv
 
-    edges_df = pd.read_csv("../data/tiger_csv/" + county_code + "_edges.csv")
+    if tlids is None:
+        edges_df = pd.read_csv("../data/tiger_csv/" + county_code + "_edges.csv")
+    else:
+        edges_df = edge_store.read_edges(county_code=county_code, tlids=tlids, columns=None)
+        edges_df['TLID'] = pd.to_numeric(edges_df['TLID'])
     edges_df.set_index(['TLID'])
 
-    print(edges_df.head())
+    logger.debug("Edges:\n%s", edges_df.head())
 
-    county_address_df = pd.read_csv("../data/addresses/" + county_code + "_addresses.csv")
+    county_address_df = pd.read_csv("../data/addresses/" + county_code + "_addresses.csv",
+                                    converters={'BLKID': lambda x: str(x)})
     county_address_df.set_index('MAFID')
+    # Sample before building points, so that only the sampled ones are built
+    county_address_df = sampling.sample_addresses(county_address_df, county_code=county_code, sample=sample,
+                                                  seed=seed, budget=budget)
 
     if spatial:
         crs = {'init': 'epsg:4269'}
@@ -68,9 +92,6 @@ def import_data(county_code = '08031', spatial = True, sample=True):
         edges_df['geometry'] = edges_df['geometry'].apply(wkt.loads)
         edges_df = gpd.GeoDataFrame(edges_df, crs=crs, geometry='geometry')
 
-    if sample:
-        county_address_df = county_address_df.sample(frac=.1)
-
     return county_address_df, edges_df
 
 
@@ -86,11 +107,13 @@ def import_xwalk(county_code = '08031'):
     Returns
     -------
     xwalk: pd DataFrame
-            crosswalk
+            crosswalk, with lists of integer TLIDs, the type of the TLID column
+            of the edges from import_data
     """
-    xwalk = pd.read_csv("../results/possible_tlids/" + county_code + "_address_maf_xwalk.csv", converters={'BLKID': lambda x: int(x)})
+    xwalk = pd.read_csv("../results/possible_tlids/" + county_code + "_address_maf_xwalk.csv", converters={'BLKID': lambda x: str(x)})
     # Convert TLIDs column to lists
     xwalk = xwalk.assign(TLIDs=xwalk.TLIDs.str.strip('[]').str.replace(" ", "").str.split(','))
+    xwalk['TLIDs'] = [[int(tlid) for tlid in tlids if tlid] for tlids in xwalk['TLIDs']]
     return xwalk
 
 
@@ -114,7 +137,7 @@ def merge_xwalk_addresses(addresses, xwalk):
     return maf_xwalk
 
 
-def simplify_road(edges, county_code='08031', tol=10):
+def simplify_road(edges, county_code='08031', tol=10, save=True):
     """
     Simplifies road geometry using shapely
     Saves as shapefile for easy result viewing in QGIS
@@ -126,7 +149,10 @@ def simplify_road(edges, county_code='08031', tol=10):
     county_code: str
             fips code for county
     tol: int
-            maximum allowable meters away from original roads
+            maximum allowable distance away from original roads, in the units
+            of the edges' coordinate system
+    save: bool
+            if true, saves the simplified edges as a shapefile
 
     Returns
     -------
@@ -134,6 +160,8 @@ def simplify_road(edges, county_code='08031', tol=10):
             of simplified edges lines
     """
     edges.loc[:,'geometry'] = edges.simplify(tolerance=tol, preserve_topology=False)
+    if not save:
+        return edges
     if not os.path.exists("../data/tiger_csv/simplified_edges/"):
         os.mkdir("../data/tiger_csv/simplified_edges/")
     edges.to_file(driver = 'ESRI Shapefile', filename = "../data/tiger_csv/simplified_edges/" + county_code + "_simp_" + str(tol).replace(".",""))
@@ -153,12 +181,14 @@ def min_dist_geo(point, edges):
 
     Returns
     -------
-    closest_tlid['TLID']: str
-            TLID of the closest street segment. If none are found, returns 'None'
+    closest_tlid['TLID']: int
+            TLID of the closest street segment. If none are found, returns None
     """
 
     tlid_df = edges.loc[edges['TLID'].isin(point['TLIDs'])].copy(deep=True).reset_index()
-    tlid_df.loc[:,'dist'] = tlid_df.apply(lambda row: point.geometry.distance(row.geometry), axis=1)
+    if tlid_df.shape[0] == 0:
+        return None
+    tlid_df.loc[:,'dist'] = tlid_df.geometry.distance(point.geometry).values
     closest_tlid = tlid_df.iloc[np.argmin(tlid_df['dist'])]
     return closest_tlid['TLID']
 
@@ -180,7 +210,8 @@ def find_midpoints(edges):
     midpoints.loc[:,'geometry'] = edges.centroid
     return midpoints
 
-def run_distance_calc(county_code='08031', spatial=True, simplify=False, tol=0, mids=False, sample=False):
+def run_distance_calc(county_code='08031', spatial=True, simplify=False, tol=0, mids=False, sample=False, profile=False,
+                      seed=sampling.DEFAULT_SEED, budget=None):
     """
     Finds the TLID closest to the point, given that the TLID is one of the options
     found using the tiger_xwalk.py crosswalk
@@ -199,8 +230,17 @@ def run_distance_calc(county_code='08031', spatial=True, simplify=False, tol=0,
             that is acceptable
     mids: bool
             flag to instead calculate distances from the midpoints of each line segment
-    sample: bool
-            if True, only run process on a random 10% of the addresses
+    sample: bool or float
+            if True, only run process on a stratified 10% sample of the addresses
+            (or this fraction, if a number; see sampling.py)
+    profile: bool
+            if true, times hot functions and samples stacks, writing the results
+            to "../results/profiles/run_distance_calc_[[county_code]]*" (see profiling.py)
+    seed: int
+            random seed of the sample
+    budget: float
+            if given with sample, the sample is sized to about this many seconds of
+            matching
 
     Output
     ------
@@ -209,52 +249,56 @@ def run_distance_calc(county_code='08031', spatial=True, simplify=False, tol=0,
     input data with the closest possible TLID, after having narrowed the search area using
     the tiger_xwalk.py crosswalk
     """
-    total_t0 = time.time()
-    addresses, edges = import_data(spatial = spatial, sample = sample)
-    maf_xwalk = merge_xwalk_addresses(addresses, import_xwalk())
-
-    # Identify rows needing a TLID match
-    maf_needs_tlid = maf_xwalk.loc[maf_xwalk['OPTIONS'] > 1]
-    maf_has_tlid = maf_xwalk.loc[maf_xwalk['OPTIONS'] == 1]
-
-    maf_has_tlid.loc[:,'TLID_match'] = maf_has_tlid.apply(lambda row: row['TLIDs'][0], axis=1)
-
-    simplify_time = 0
-    if spatial==True:
-        if  mids==True:
-            simp_t0 = time.time()
-            edges = find_midpoints(edges)
-            simp_t1 = time.time()
-        elif simplify==True:
-            simp_t0 = time.time()
-            edges = simplify_road(edges, tol = tol)
-            simp_t1 = time.time()
-            simplify_time = simp_t1 - simp_t0
-        #maf_needs_tlid = maf_needs_tlid[pd.notnull(maf_needs_tlid['TLIDs'])]
-
-        match_t0 = time.time()
-        maf_needs_tlid.loc[:,'TLID_match'] = maf_needs_tlid.apply(lambda row: min_dist_geo(row, edges), axis=1)
-        match_t1 = time.time()
-        match_time = match_t1-match_t0
-
-    maf_xwalk = pd.concat([maf_has_tlid, maf_needs_tlid])
-
-
-    if not os.path.exists("../results/address_tlid_xwalk/"):
-        os.mkdir("../results/address_tlid_xwalk/")
-
-    if sample:
-        outfile_name = "../results/address_tlid_xwalk/" + county_code + "_samp_geo_match.csv"
-    else:
-        outfile_name = "../results/address_tlid_xwalk/" + county_code + "_geo_match.csv"
-
-    maf_xwalk.to_csv(outfile_name)
-
-    total_t1 = time.time()
-
-    total_time = total_t1 - total_t0
+    with instrument.run('run_distance_calc', county_code=county_code, spatial=spatial,
+                        simplify=simplify, tol=tol, mids=mids, sample=sample), \
+            profiling.profile('run_distance_calc_' + county_code, enabled=profile):
+        total_t0 = time.time()
+        with instrument.stage('load') as record:
+            xwalk = import_xwalk(county_code=county_code)
+            addresses, edges = import_data(county_code=county_code, spatial = spatial, sample = sample,
+                                           tlids=edge_store.candidate_tlids(xwalk), seed=seed, budget=budget)
+            maf_xwalk = merge_xwalk_addresses(addresses, xwalk)
+            record['rows'] = maf_xwalk.shape[0]
+
+        # Identify rows needing a TLID match
+        maf_needs_tlid = maf_xwalk.loc[maf_xwalk['OPTIONS'] > 1]
+        maf_has_tlid = maf_xwalk.loc[maf_xwalk['OPTIONS'] == 1]
+
+        maf_has_tlid.loc[:,'TLID_match'] = maf_has_tlid.apply(lambda row: row['TLIDs'][0], axis=1)
+
+        simplify_time = 0
+        if spatial==True:
+            if  mids==True:
+                with instrument.stage('midpoints'):
+                    edges = find_midpoints(edges)
+            elif simplify==True:
+                with instrument.stage('simplify') as record:
+                    edges = simplify_road(edges, tol = tol)
+                simplify_time = record['seconds']
+            #maf_needs_tlid = maf_needs_tlid[pd.notnull(maf_needs_tlid['TLIDs'])]
+
+            with instrument.stage('match') as record:
+                maf_needs_tlid.loc[:,'TLID_match'] = maf_needs_tlid.apply(lambda row: min_dist_geo(row, edges), axis=1)
+                record['rows'] = maf_needs_tlid.shape[0]
+            match_time = record['seconds']
+
+        maf_xwalk = pd.concat([maf_has_tlid, maf_needs_tlid])
+
+        with instrument.stage('write'):
+            if not os.path.exists("../results/address_tlid_xwalk/"):
+                os.mkdir("../results/address_tlid_xwalk/")
+
+            if sample:
+                outfile_name = "../results/address_tlid_xwalk/" + county_code + "_samp_geo_match.csv"
+            else:
+                outfile_name = "../results/address_tlid_xwalk/" + county_code + "_geo_match.csv"
+
+            maf_xwalk.to_csv(outfile_name)
+
+        total_time = time.time() - total_t0
 
     return [tol, simplify_time, match_time, total_time]
 
 if __name__ == "__main__":
+    instrument.configure_logging()
     run_distance_calc(county_code = '08031')
@@ -3,40 +3,112 @@ import pandas as pd
 from shapely.geometry import Point
 from shapely.geometry import LineString
 from shapely.wkt import loads
+import shapely
 import math
+import functools
+import logging
+import instrument
+import block_assign
+import name_dictionary
+import edge_store
+import prefetch
+import sampling
+import block_sides
 
 """
 This script contains functions required to run match_tlid.py
 """
 
-def import_data(county_code = '08031', sample=True):
+logger = logging.getLogger(__name__)
+
+# Number of parsed edge geometries kept by parse_vertices. Neighboring addresses
+# share candidates, so this is most effective when addresses are matched in
+# spatial order (see spatial_sort.py).
+GEOMETRY_CACHE_SIZE = 4096
+
+# Storage types of coordinates in the distance calculations (see CoordinateCodec)
+COORDINATE_TYPES = ['float64', 'float32', 'fixed']
+
+FIXED_RESOLUTION = 1e-7
+
+def import_addresses(county_code = '08031', sample=True, seed=sampling.DEFAULT_SEED, budget=None):
     """
-    Imports address and TIGER data
+    Imports address points, with missing block ids assigned from their
+    coordinates (see block_assign.py)
 
     Parameters
     ----------
     county_code: str
             fips code for county
-    sample: bool
-            if true, only process 10% of addresses
-
-    Returns
-    -------
-    county_address_df: pd DataFrame
-            of address points
-    edges_df: pd DataFrame
-            of edges lines
+    sample: bool or float
+            if true, only process a stratified 10% sample of addresses (or this
+            fraction, if a number; see sampling.py)
+    seed: int
+            random seed of the sample
+    budget: float
+            if given with sample, the sample is sized to about this many seconds of
+            matching
     """
     # Open address point csv
     county_address_df = pd.read_csv("../data/addresses/" + county_code + "_addresses.csv", converters={'BLKID': lambda x: str(x)})
-    print("Number of addresses in input file:", county_address_df.shape[0])
+    logger.info("Number of addresses in input file: %d", county_address_df.shape[0])
 
     # Extract a sample for code testing and shorter run-times
-    if sample:
-        county_address_df = county_address_df.sample(frac=.1)
-    edges_df = pd.read_csv("../data/tiger_csv/" + county_code + "_edges.csv", converters={'TLID': lambda x: str(x)})
+    county_address_df = sampling.sample_addresses(county_address_df, county_code=county_code, sample=sample,
+                                                  seed=seed, budget=budget)
+    county_address_df = block_assign.fill_missing_blocks(county_address_df, county_code=county_code)
+    return county_address_df
+
+
+def import_edges(county_code = '08031', tlids=None):
+    """
+    Imports TIGER edges, indexed by TLID
+
+    Parameters
+    ----------
+    county_code: str
+            fips code for county
+    tlids: iterable
+            if given, only the edges of these TLIDs are loaded (see edge_store.py)
+    """
+    if tlids is None:
+        edges_df = pd.read_csv("../data/tiger_csv/" + county_code + "_edges.csv", converters={'TLID': lambda x: str(x)})
+    else:
+        edges_df = edge_store.read_edges(county_code=county_code, tlids=tlids)
     edges_df = edges_df.set_index(['TLID'])
+    return edges_df
+
 
+def import_data(county_code = '08031', sample=True, tlids=None, seed=sampling.DEFAULT_SEED, budget=None):
+    """
+    Imports address and TIGER data, reading the two files concurrently
+
+    Parameters
+    ----------
+    county_code: str
+            fips code for county
+    sample: bool or float
+            if true, only process a stratified sample of addresses (see
+            import_addresses)
+    tlids: iterable
+            if given, only the edges of these TLIDs are loaded (see edge_store.py)
+    seed: int
+            random seed of the sample
+    budget: float
+            if given with sample, the sample is sized to about this many seconds of
+            matching
+
+    Returns
+    -------
+    county_address_df: pd DataFrame
+            of address points, with missing block ids assigned from their
+            coordinates (see block_assign.py)
+    edges_df: pd DataFrame
+            of edges lines
+    """
+    county_address_df, edges_df = prefetch.run_concurrently(
+        lambda: import_addresses(county_code=county_code, sample=sample, seed=seed, budget=budget),
+        lambda: import_edges(county_code=county_code, tlids=tlids))
     return county_address_df, edges_df
 
 
@@ -60,7 +132,7 @@ def import_xwalk(county_code = '08031'):
     return xwalk
 
 
-def merge_xwalk_addresses(addresses, xwalk):
+def merge_xwalk_addresses(addresses, xwalk, name_dict=None):
     """
     Merges crosswalk with addresses to find possible TLIDs for each
 
@@ -70,19 +142,26 @@ def merge_xwalk_addresses(addresses, xwalk):
             of address points
     xwalk: pd DataFrame
             crosswalk
+    name_dict: name_dictionary.NameDictionary
+            dictionary used to merge on integer street name IDs. A temporary one
+            is used if None.
     Returns
     -------
     maf_xwalk: pd or gpd DataFrame
             addresses with possible TLIDs from xwalk, index is (synthetic) MAFID or other point identifier
     """
-    # Convert street names and block IDs to strings
+    if name_dict is None:
+        name_dict = name_dictionary.NameDictionary()
+    # Convert street names to integer IDs, and block IDs to strings
     addresses['MAF_NAME'], addresses['BLKID'] = addresses['MAF_NAME'].astype(str), addresses['BLKID'].astype(str)
     xwalk['MAF_NAME'], xwalk['BLKID'] = xwalk['MAF_NAME'].astype(str), xwalk['BLKID'].astype(str)
+    addresses['MAF_NAME_ID'] = name_dict.encode(addresses['MAF_NAME'])
+    xwalk = xwalk.drop(columns=['MAF_NAME']).assign(MAF_NAME_ID=name_dict.encode(xwalk['MAF_NAME']))
 
     # Merge addresses with crosswalk, created with tiger_xwalk.py
-    maf_xwalk = pd.merge(addresses, xwalk,  how='left', left_on=['MAF_NAME','BLKID'], right_on = ['MAF_NAME','BLKID'])
+    maf_xwalk = pd.merge(addresses, xwalk,  how='left', on=['MAF_NAME_ID','BLKID'])
     maf_xwalk = maf_xwalk.set_index(['MAFID'])
-    print("Number of addresses sucessfully merged with crosswalk:", maf_xwalk.shape[0])
+    logger.info("Number of addresses sucessfully merged with crosswalk: %d", maf_xwalk.shape[0])
     return maf_xwalk
 
 def is_multi_TLID_candidates(edges_row_TLIDs):
@@ -120,7 +199,7 @@ def get_single_TLID_addresses(xwalk):
     """
     # Convert possible TLIDs to dictionary
     address_point_TLID_candidates = xwalk.loc[:,'TLIDs'].to_dict()
-    print("Number of candidates in dictionary form: ", len(address_point_TLID_candidates))
+    logger.info("Number of candidates in dictionary form: %d", len(address_point_TLID_candidates))
     address_point_TLID = {}
     address_no_cand = []
 
@@ -130,13 +209,17 @@ def get_single_TLID_addresses(xwalk):
             if len(candidates) == 1:
                 address_point_TLID[id] = candidates[0]
             elif len(candidates) == 0:
-                print("Found address with empty list of TLID candidates")
+                logger.debug("Found address with empty list of TLID candidates: %s", id)
                 address_no_cand.append(id)
         else:
-            print("Found address with no list of TLID candidates")
+            logger.debug("Found address with no list of TLID candidates: %s", id)
             address_no_cand.append(id)
-    print("Number of one-option addresses:", len(address_point_TLID))
-    print("Number of no-option addresses:", len(address_no_cand))
+    logger.info("Number of one-option addresses: %d", len(address_point_TLID))
+    logger.info("Number of no-option addresses: %d", len(address_no_cand))
+    instrument.count('single_option', len(address_point_TLID))
+    instrument.count('no_option', len(address_no_cand))
+    instrument.observe_counts('candidate_count', pd.Series([len(c) if isinstance(c, list) else 0
+                                                            for c in address_point_TLID_candidates.values()]).value_counts())
     return address_point_TLID
 
 def get_multi_TLID_addresses(xwalk):
@@ -154,9 +237,10 @@ def get_multi_TLID_addresses(xwalk):
             dictionary of addresses points, where key is synthetic MAFID, and values
             are another dictionary containing TLID lists, latitude, and longitude
     """
-    # Covert pd address/MAFX data to dictionary format
-    address_points = xwalk.loc[:,['TLIDs', 'LATITUDE', 'LONGITUDE']].to_dict('index')
-    print("Number of candidates in dictionary form, multi: ", len(address_points))
+    # Covert pd address/MAFX data to dictionary format, with the block to look up its sides (see candidate_sides)
+    columns = ['TLIDs', 'LATITUDE', 'LONGITUDE'] + (['BLKID'] if 'BLKID' in xwalk.columns else [])
+    address_points = xwalk.loc[:,columns].to_dict('index')
+    logger.info("Number of candidates in dictionary form, multi: %d", len(address_points))
     multi_TLID_addresses = {}
     address_no_cand = []
 
@@ -166,9 +250,9 @@ def get_multi_TLID_addresses(xwalk):
             if len(data['TLIDs']) > 1:
                 multi_TLID_addresses[id] = data
         else:
-            print("Found address with no list of TLID candidates")
             address_no_cand.append(id)
-    print("Number of multi-option addresses:", len(multi_TLID_addresses))
+    logger.info("Number of multi-option addresses: %d", len(multi_TLID_addresses))
+    instrument.count('multi_option', len(multi_TLID_addresses))
     return multi_TLID_addresses
 
 def find_edge_geo(id, edges):
@@ -190,8 +274,9 @@ def find_edge_geo(id, edges):
     try:
         geo = edges.loc[id, 'geometry']
         return geo
-    except:
-        print("Could not find edge geometry from TLID")
+    except KeyError:
+        logger.debug("Could not find edge geometry from TLID %s", id)
+        instrument.count('missing_edge_geometry')
         return None
 
 def get_candidate_geoms(multi_TLID_addresses, edges):
@@ -213,36 +298,418 @@ def get_candidate_geoms(multi_TLID_addresses, edges):
     return geom_list
 
 
-def find_closest(linedict, point):
+class CoordinateCodec(object):
+    """
+    Storage type of the coordinates used by the distance calculations
+
+    'float64' keeps coordinates as they are. 'float32' stores offsets from an
+    origin as float32, and 'fixed' stores them as int32 multiples of resolution
+    (in degrees), both halving the memory of parsed geometries. Distances are
+    computed in the storage type (exactly, in int64, for 'fixed'), so candidates
+    whose distances differ by more than twice error_bound() are ranked as with
+    float64 coordinates.
+
+    Parameters
+    ----------
+    kind: str
+            one of COORDINATE_TYPES
+    origin: tuple
+            (longitude, latitude) subtracted from every coordinate, such as the
+            south-west corner of the county
+    resolution: float
+            size in degrees of one fixed-point unit. The default of 1e-7 degrees
+            is about 1 cm, and int32 offsets then span 214 degrees.
+    """
+    def __init__(self, kind='float64', origin=(0.0, 0.0), resolution=FIXED_RESOLUTION):
+        if kind not in COORDINATE_TYPES:
+            raise ValueError("kind must be one of " + ", ".join(COORDINATE_TYPES))
+        self.kind = kind
+        self.origin = np.array(origin, dtype=float) if kind != 'float64' else np.zeros(2)
+        self.resolution = resolution
+
+    def key(self):
+        return (self.kind, tuple(self.origin), self.resolution)
+
+    def __eq__(self, other):
+        return isinstance(other, CoordinateCodec) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def encode(self, coords):
+        """
+        Converts (longitude, latitude) coordinates to the storage type
+
+        Parameters
+        ----------
+        coords: array-like
+                a point, or a sequence of points
+
+        Returns
+        -------
+        encoded: np array
+                of float64, float32 or int32 values
+        """
+        coords = np.asarray(coords, dtype=float)[..., :2]
+        if self.kind == 'float64':
+            return coords
+        offsets = coords - self.origin
+        if self.kind == 'float32':
+            return offsets.astype(np.float32)
+        units = np.rint(offsets / self.resolution)
+        if np.abs(units).max(initial=0) >= 2 ** 31:
+            raise ValueError("coordinates too far from the origin for int32 fixed point")
+        return units.astype(np.int32)
+
+    def distances(self, vertices, point):
+        """
+        Distances from encoded vertices to an encoded point, in units that only
+        preserve their order (squared, and in resolution units for 'fixed')
+        """
+        if self.kind == 'fixed':
+            # Exact in int64 unless the points are more than 200 degrees apart
+            diff = vertices.astype(np.int64) - point
+            return (diff * diff).sum(axis=1)
+        if self.kind == 'float32':
+            diff = vertices - point
+            return (diff * diff).sum(axis=1)
+        return np.sqrt(((vertices - point) ** 2).sum(axis=1))
+
+    def closest_distance(self, vertices, point):
+        """
+        Smallest of distances(vertices, point), taking the square root (for
+        'float64') of the smallest squared distance only
+        """
+        if self.kind != 'float64':
+            return self.distances(vertices, point).min()
+        return math.sqrt(((vertices - point) ** 2).sum(axis=1).min())
+
+    def closest_distances(self, vertices, point, owners, n):
+        """
+        closest_distance for each of n lines sharing one vertex array, such as
+        the TLIDs of a merged block side
+
+        Parameters
+        ----------
+        vertices: np array
+                encoded vertices
+        point: np array
+                encoded point
+        owners: np array
+                two line positions per vertex (the same one twice, except at a
+                vertex shared by two lines), as in block_sides.merge_chain
+        n: int
+                number of lines
+
+        Returns
+        -------
+        closest: np array
+                closest distance of each line
+        found: np array
+                boolean, false for lines without vertices
+        """
+        if self.kind == 'float64':
+            dist = ((vertices - point) ** 2).sum(axis=1)
+        else:
+            dist = self.distances(vertices, point)
+        fill = np.inf if dist.dtype.kind == 'f' else np.iinfo(dist.dtype).max
+        closest = np.full(n, fill, dtype=dist.dtype)
+        np.minimum.at(closest, owners[:, 0], dist)
+        np.minimum.at(closest, owners[:, 1], dist)
+        found = np.zeros(n, dtype=bool)
+        found[owners.ravel()] = True
+        if self.kind == 'float64':
+            closest = np.sqrt(closest)
+        return closest, found
+
+    def to_degrees(self, distance):
+        """
+        Converts a distance in the units of distances() to degrees, with nan for inf
+        """
+        if not np.isfinite(distance):
+            return np.nan
+        if self.kind == 'float64':
+            return float(distance)
+        if self.kind == 'float32':
+            return math.sqrt(distance)
+        return math.sqrt(distance) * self.resolution
+
+    def box_distances(self, boxes, point):
+        """
+        Lower bounds of the distances from an encoded point to the vertices
+        inside encoded boxes, in the units of distances()
+
+        Parameters
+        ----------
+        boxes: list
+                (minx, miny, maxx, maxy) tuples. Candidate lists are short, so
+                these are computed with Python numbers rather than NumPy.
+        point: np array
+                encoded point
+        """
+        px, py = point.tolist()
+        lower_bounds = []
+        for x0, y0, x1, y1 in boxes:
+            dx = max(x0 - px, px - x1, 0)
+            dy = max(y0 - py, py - y1, 0)
+            lower_bounds.append(dx * dx + dy * dy)
+        if self.kind == 'float64':
+            # The same operations as distances(), so never larger than a vertex distance
+            return [math.sqrt(bound) for bound in lower_bounds]
+        if self.kind == 'float32':
+            # Allow for the rounding of distances() in float32
+            return [bound * (1 - 1e-6) for bound in lower_bounds]
+        return lower_bounds
+
+    def error_bound(self, extent=1.0):
+        """
+        Largest difference, in degrees, between a distance computed from encoded
+        coordinates and the float64 distance
+
+        Parameters
+        ----------
+        extent: float
+                largest offset, in degrees, of any point from the origin
+        """
+        if self.kind == 'fixed':
+            # Each coordinate of the vertex and of the point is rounded by at most resolution / 2
+            return np.sqrt(2) * self.resolution
+        # Rounding of each coordinate, and of the arithmetic, relative to the extent
+        eps = np.finfo(np.float32 if self.kind == 'float32' else np.float64).eps
+        return 4 * np.sqrt(2) * extent * eps
+
+
+def county_codec(kind='float64', longitude=(), latitude=(), resolution=FIXED_RESOLUTION):
+    """
+    Codec with its origin at the south-west corner of the given points
+    """
+    longitude, latitude = np.asarray(longitude, dtype=float), np.asarray(latitude, dtype=float)
+    origin = (np.nanmin(longitude), np.nanmin(latitude)) if longitude.shape[0] else (0.0, 0.0)
+    return CoordinateCodec(kind, origin=origin, resolution=resolution)
+
+
+DEFAULT_CODEC = CoordinateCodec()
+
+
+def candidate_bounds(geom_list, codec=DEFAULT_CODEC, box_index=None):
+    """
+    Finds the bounding box of every candidate line, looking them up in the box
+    index of the edges file if given, and otherwise parsing the lines in one
+    vectorized pass
+
+    Parameters
+    ----------
+    geom_list: dict
+            dictionary, where key is a MAFID and value is a dictionary with
+            TLIDs as keys and WKT geometries as values
+    codec: CoordinateCodec
+            storage type of the boxes
+    box_index: dict
+            boxes of the edges the lines come from (see edge_store.load_box_index).
+            Only lines whose TLID is not in it are parsed.
+
+    Returns
+    -------
+    bounds: dict
+            TLID as keys, and encoded (minx, miny, maxx, maxy) boxes as values
+    """
+    lines = {}
+    for linedict in geom_list.values():
+        for tlid, aline_wkt in linedict.items():
+            if isinstance(aline_wkt, str):
+                lines[tlid] = aline_wkt
+    if not lines:
+        return {}
+    tlids = list(lines)
+    if box_index is not None:
+        boxes = edge_store.find_boxes(box_index, tlids)
+    else:
+        boxes = np.full((len(tlids), 4), np.nan)
+    missing = np.flatnonzero(np.isnan(boxes).any(axis=1))
+    instrument.count('parsed_boxes', missing.shape[0])
+    if missing.shape[0]:
+        boxes[missing] = shapely.bounds(shapely.from_wkt([lines[tlids[i]] for i in missing])).reshape(-1, 4)
+    boxes = codec.encode(boxes.reshape(-1, 2)).reshape(-1, 4)
+    return dict(zip(lines.keys(), map(tuple, boxes.tolist())))
+
+
+def candidate_sides(multi, sides, codec=DEFAULT_CODEC):
     """
-    Finds closest TLID to the given point, looping through
-    the vertices of the line. Finds a local minimum distance
+    Finds the merged block-side polylines (see block_sides.py) of the
+    multi-option addresses whose candidates are exactly the TLIDs of whole
+    sides of their block
+
+    Parameters
+    ----------
+    multi: dict
+            as returned by get_multi_TLID_addresses, with BLKID
+    sides: tuple
+            block sides table and geometry, as returned by
+            block_sides.create_block_sides
+    codec: CoordinateCodec
+            storage type of the vertices
+
+    Returns
+    -------
+    side_list: dict
+            MAFID as keys, and a list with one (positions, vertices, owners, box)
+            tuple per side as values: the position of each of the side's TLIDs
+            among the address's distinct candidates, the encoded vertices, two
+            positions in the side's TLIDs per vertex (see block_sides.merge_chain)
+            and the encoded bounding box
+    """
+    sides_table, geometry = sides
+    side_of = block_sides.side_lookup(sides_table)
+    encoded = {}
+    units = {}
+    side_list = {}
+    for id, attributes in multi.items():
+        key = (str(attributes.get('BLKID')), tuple(attributes['TLIDs']))
+        if key not in units:
+            # Addresses with the same name on the same block share their candidates
+            tlids = [str(tlid) for tlid in dict.fromkeys(key[1])]
+            side_ids = block_sides.covering_sides(side_of, geometry, key[0], tlids)
+            if side_ids is not None:
+                position = {tlid: i for i, tlid in enumerate(tlids)}
+                units[key] = []
+                for side_id in side_ids:
+                    if side_id not in encoded:
+                        vertices = codec.encode(geometry[side_id][1])
+                        vertices.setflags(write=False)
+                        box = None
+                        if vertices.shape[0]:
+                            box = tuple(np.concatenate([vertices.min(axis=0), vertices.max(axis=0)]).tolist())
+                        encoded[side_id] = (vertices, geometry[side_id][2], box)
+                    vertices, owners, box = encoded[side_id]
+                    if box is not None:
+                        units[key].append(([position[tlid] for tlid in geometry[side_id][0]], vertices, owners, box))
+            else:
+                units[key] = None
+        if units[key] is not None:
+            side_list[id] = units[key]
+    instrument.count('side_merged', len(side_list))
+    return side_list
+
+
+@functools.lru_cache(maxsize=GEOMETRY_CACHE_SIZE)
+def parse_vertices(aline_wkt, codec=DEFAULT_CODEC):
+    """
+    Parses the vertices of a WKT line, keeping the most recently used ones
+
+    Parameters
+    ----------
+    aline_wkt: str
+            WKT of edge's geometry
+    codec: CoordinateCodec
+            storage type of the vertices
+
+    Returns
+    -------
+    vertices: np array
+            read-only (longitude, latitude) rows, encoded with codec
+    """
+    vertices = codec.encode(loads(aline_wkt).coords)
+    vertices.setflags(write=False)
+    return vertices
+
+
+# The cached function itself, whose cache_info stays available while profiling
+# replaces parse_vertices with a timing wrapper (see profiling.py)
+vertex_cache = parse_vertices
+
+
+def find_closest(linedict, point, codec=DEFAULT_CODEC, bounds=None, margins=False, sides=None):
+    """
+    Finds closest TLID to the given point, comparing its distance
+    to the vertices of each line. Finds a local minimum distance
     along the line geometry.
+
+    If the bounding boxes of the lines are given, lines are visited in order of
+    the distance to their box, which no vertex can be closer than, and lines
+    whose box is farther than the closest vertex found so far (or the second
+    closest, with margins) are skipped without parsing their vertices. The
+    result is the same as without boxes.
+
+    If the lines make up whole block sides, their merged polylines can be given
+    instead (see candidate_sides). Each side is then measured in one pass, with
+    the vertex of a node shared by two of its TLIDs measured once, and with
+    bounds, sides are visited and skipped as a whole by their own box. The
+    result is again the same.
     ----------
     linedict: dict
             TLIDs are keys, line geometry are values
     point: two-value np array
-                of latitude, longitude
+                of longitude, latitude
+    codec: CoordinateCodec
+            storage type of the coordinates in the distance calculation
+    bounds: dict
+            encoded bounding box of each TLID, as returned by candidate_bounds
+    margins: bool
+            if true, also returns how clear the match is
+    sides: list
+            merged block sides of the lines, as in the values of candidate_sides
     Returns
     -------
     closest_line: str
             TLID of closest line
+    margins: tuple
+            only if margins is true: (closest_line, distance, second closest
+            TLID, its distance, number of candidates), with distances in
+            degrees, and None and nan where there is no such line
     """
-    # Initialize minimum distance as inf
+    # Initialize minimum distance as inf, for the closest and second closest lines
     closest_line = None
     min_dist = np.inf
-
-    # Loop through all vertices of all possible TLIDs
-    for idx, aline_wkt in linedict.items():
-        if isinstance(aline_wkt, str):
-            aline = loads(aline_wkt)
-            for vert in list(aline.coords):
-                dist = straight_line_distance(vert, point)
-                if dist < min_dist:
-                    min_dist = dist
-                    closest_line = idx
+    second_line = None
+    second_dist = np.inf
+    point = codec.encode(point)
+
+    # Units measured at once: single lines, as (position in linedict, WKT), or sides
+    tlids = list(linedict)
+    if sides is not None:
+        units = sides
+        sizes = [len(side[0]) for side in sides]
+        boxes = [side[3] for side in sides] if bounds is not None else None
+    else:
+        units = [(i, aline_wkt) for i, aline_wkt in enumerate(linedict.values()) if isinstance(aline_wkt, str)]
+        sizes = [1] * len(units)
+        boxes = [bounds.get(tlids[i]) for i, _ in units] if bounds is not None else None
+    order = range(len(units))
+    lower_bounds = None
+    if boxes is not None and len(units) > 1 and None not in boxes:
+        lower_bounds = codec.box_distances(boxes, point)
+        order = sorted(order, key=lower_bounds.__getitem__)
+
+    # Closest vertex of each possible TLID, keeping the first TLID on ties
+    best = second = len(tlids)
+    for visited, u in enumerate(order):
+        if lower_bounds is not None and lower_bounds[u] > (second_dist if margins else min_dist):
+            # Every remaining unit's box is at least this far
+            instrument.count('pruned_candidates', sum(sizes[v] for v in order[visited:]))
+            break
+        if sides is not None:
+            positions, vertices, owners, box = units[u]
+            closest, found = codec.closest_distances(vertices, point, owners, len(positions))
+            distances = [(positions[j], closest[j]) for j in np.flatnonzero(found)]
+        else:
+            i, aline_wkt = units[u]
+            vertices = parse_vertices(aline_wkt, codec)
+            if vertices.shape[0] == 0:
+                continue
+            distances = [(i, codec.closest_distance(vertices, point))]
+        for i, dist in distances:
+            if dist < min_dist or (dist == min_dist and i < best):
+                second_dist, second_line, second = min_dist, closest_line, best
+                min_dist = dist
+                closest_line = tlids[i]
+                best = i
+            elif dist < second_dist or (dist == second_dist and i < second):
+                second_dist, second_line, second = dist, tlids[i], i
     if closest_line == None:
-        print("No TLID match found, last distance calculated: ", vert, point, dist)
+        logger.debug("No TLID match found for point %s", point)
+        instrument.count('no_tlid_match')
+    if margins:
+        return closest_line, codec.to_degrees(min_dist), second_line, codec.to_degrees(second_dist), len(linedict)
     return closest_line
 
 
@@ -251,8 +718,8 @@ def straight_line_distance(coord1, coord2):
     Calculates stright-line distance between two points
     ----------
     coord1: two-value np array
-                of latitude, longitude
+                of longitude, latitude
     coord2: two-value np array
-                of latitude, longitude
+                of longitude, latitude
     """
     return np.sqrt(np.sum((coord1 - coord2) ** 2))
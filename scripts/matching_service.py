@@ -0,0 +1,414 @@
+import json
+import time
+import logging
+import argparse
+import numpy as np
+from shapely.wkt import loads
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import instrument
+import stage_cache
+import tiger_xwalk
+import block_sides
+import name_index
+import match_tlid_utils as tlid_utils
+
+"""
+This script contains a long-lived matcher that assigns TLIDs to single address
+records as they arrive, using the same logic as match_tlid.py.
+
+For each county, the crosswalk created with tiger_xwalk.py and the TIGER edges are
+loaded once into a CountyIndex. The index maps each (MAF_NAME, BLKID) combination
+to its candidate TLIDs, along with the vertices of all candidates parsed into a
+single NumPy array. A query is then a dictionary lookup, plus, for multi-option
+combinations, one vectorized distance calculation over the candidates' vertices.
+The closest vertex picks the TLID, exactly as in match_tlid_utils.find_closest.
+Where the candidates make up whole block sides (see block_sides.py), the vertices
+come from the merged block-side polylines, so that node vertices shared by
+consecutive TLIDs are only measured once.
+
+Name-block combinations that are not in the crosswalk, such as new addresses,
+get their candidates from the same name match as tiger_xwalk.py (see
+NameFallback), which are then kept in the index for later queries.
+
+Queries can be answered in-process:
+    service = MatchingService(['08031'])
+    service.match({'MAF_NAME': 'N Main St', 'BLKID': '080310001001000',
+                   'LATITUDE': 39.7, 'LONGITUDE': -104.9})
+
+or over a local HTTP endpoint, which accepts a JSON object (single mode) or a
+list of objects (batch mode) POSTed to /match:
+    python matching_service.py --counties 08031 --port 8031
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class NameFallback(object):
+    """
+    The name match and possible TLID lookup of tiger_xwalk.py for single
+    name-block combinations: the closest TIGER name along the block (as in
+    tiger_xwalk.match_names), or else along the adjacent blocks (as in
+    tiger_xwalk.match_adjacent_names), and the TLIDs of that name along those
+    blocks, or every TLID of the block if no name is close enough (as in
+    tiger_xwalk.name_tlid_table)
+
+    Parameters
+    ----------
+    edge_face: pd DataFrame
+            output of tiger_xwalk.create_edge_face, with TLIDs of the same type
+            as the crosswalk's
+    faces: pd DataFrame
+            Face data from TIGER, with concatinated block id
+    cutoff: float
+            minimum difflib similarity score for a name match
+    adjacent: bool
+            if true, names are also searched for along the adjacent blocks
+    """
+    def __init__(self, edge_face, faces, cutoff=0.5, adjacent=True):
+        self.cutoff = cutoff
+        names_blocks = tiger_xwalk.create_names_blocks(edge_face, faces)
+        self.block_names = names_blocks.dropna(subset=['FULLNAME']).groupby('BLKID')['FULLNAME'].agg(list).to_dict()
+        self.name_index = name_index.NameIndex(names_blocks['FULLNAME'])
+        self.neighbors = name_index.block_neighbors(edge_face, faces).to_dict() if adjacent else {}
+        # TLIDs of each block, and of each name along each block, in edge-face order
+        edge_blocks = edge_face[['TLID', 'TFID', 'FULLNAME']].merge(faces[['TFID', 'BLKID']].drop_duplicates(),
+                                                                    on='TFID', how='inner')
+        self.by_name = edge_blocks.groupby(['BLKID', 'FULLNAME'], sort=False)['TLID'].agg(list).to_dict()
+        self.by_block = edge_blocks.groupby('BLKID', sort=False)['TLID'].agg(list).to_dict()
+
+    def possible_tlids(self, maf_name, blkid):
+        """
+        Possible TLIDs of a MAF name-block combination, an empty list if there
+        are none
+        """
+        tiger_name = tiger_xwalk.closest_name(maf_name, self.block_names.get(blkid, []), cutoff=self.cutoff)
+        if tiger_name is not None:
+            return list(self.by_name.get((blkid, tiger_name), []))
+        adjacent = self.neighbors.get(blkid, [])
+        allowed = [name for block in adjacent for name in self.block_names.get(block, [])]
+        tiger_name = self.name_index.best_match(maf_name, allowed, cutoff=self.cutoff) if allowed else None
+        if tiger_name is None:
+            # All block TLIDs are possible for names that failed the string match
+            return list(self.by_block.get(blkid, []))
+        return list(dict.fromkeys(tlid for block in adjacent for tlid in self.by_name.get((block, tiger_name), [])))
+
+
+class CountyIndex(object):
+    """
+    Candidate TLIDs and their parsed vertices for every street name-block
+    combination of one county
+
+    Parameters
+    ----------
+    xwalk: pd DataFrame
+            crosswalk, with MAF_NAME, BLKID and TLIDs (a column of lists)
+    edges: pd DataFrame
+            of edges lines, indexed by TLID, with WKT geometry
+    sides: tuple
+            block sides table and geometry, as returned by
+            block_sides.create_block_sides, with TLIDs of the same type as the
+            crosswalk's
+    fallback: NameFallback
+            if given, finds the candidates of name-block combinations that are
+            not in the crosswalk
+    """
+    def __init__(self, xwalk, edges, sides=None, fallback=None):
+        self.geometry = edges['geometry'].to_dict()
+        self.parsed = {}
+        self.fallback = fallback
+        self.candidates = {}
+        self.side_geometry = {}
+        self.side_of = {}
+        if sides is not None:
+            sides_table, self.side_geometry = sides
+            self.side_of = block_sides.side_lookup(sides_table)
+        for maf_name, blkid, tlids in zip(xwalk['MAF_NAME'].astype(str), xwalk['BLKID'].astype(str), xwalk['TLIDs']):
+            self.add(maf_name, blkid, tlids if isinstance(tlids, list) else [])
+
+    def add(self, maf_name, blkid, tlids):
+        """
+        Adds the candidates of a name-block combination to the index
+
+        Returns
+        -------
+        entry: tuple
+                candidate TLIDs, vertices, and the position in the candidates of
+                the TLID owning each vertex. Vertices and owners are None for a
+                single candidate.
+        """
+        # Empty crosswalk lists are read back as ['']
+        tlids = [tlid for tlid in tlids if tlid != '']
+        if len(tlids) <= 1:
+            entry = (tlids, None, None)
+        else:
+            entry = self.merge_sides(blkid, tlids)
+        if entry is None:
+            # Concatenate the vertices of all candidates, remembering which TLID each belongs to
+            coords, owners = [], []
+            for i, tlid in enumerate(tlids):
+                if tlid not in self.parsed:
+                    wkt = self.geometry.get(tlid)
+                    self.parsed[tlid] = np.asarray(loads(wkt).coords)[:, :2] if isinstance(wkt, str) else None
+                if self.parsed[tlid] is not None:
+                    coords.append(self.parsed[tlid])
+                    owners.append(np.full(self.parsed[tlid].shape[0], i))
+            coords = np.concatenate(coords) if coords else np.empty((0, 2))
+            entry = (tlids, coords, np.concatenate(owners) if owners else np.empty(0, int))
+        self.candidates[(maf_name, blkid)] = entry
+        return entry
+
+    def merge_sides(self, blkid, tlids):
+        """
+        Takes the vertices of a name-block combination from the merged block-side
+        polylines, if its candidates are exactly the TLIDs of whole block sides
+
+        Returns
+        -------
+        entry: tuple
+                candidate TLIDs, vertices, and the position in the candidates of
+                the TLID owning each vertex (the first candidate, for a node shared
+                by two), or None if the candidates do not make up whole sides
+        """
+        side_ids = block_sides.covering_sides(self.side_of, self.side_geometry, blkid,
+                                              [str(tlid) for tlid in dict.fromkeys(tlids)])
+        if side_ids is None:
+            return None
+        position = {}
+        for i, tlid in enumerate(tlids):
+            position.setdefault(str(tlid), i)
+        coords, owners = [], []
+        for side_id in side_ids:
+            side_tlids, side_coords, side_owners = self.side_geometry[side_id]
+            candidate_positions = np.array([position[tlid] for tlid in side_tlids])
+            coords.append(side_coords)
+            owners.append(candidate_positions[side_owners].min(axis=1) if side_owners.shape[0] else side_owners[:, 0])
+        coords, owners = np.concatenate(coords), np.concatenate(owners)
+        # Order vertices by candidate, so that on ties argmin picks the first candidate, as in find_closest
+        order = np.argsort(owners, kind='stable')
+        return list(tlids), coords[order], owners[order]
+
+    def match(self, maf_name, blkid, latitude, longitude):
+        """
+        Finds the TLID of one address
+
+        Parameters
+        ----------
+        maf_name: str
+                MAF street name
+        blkid: str
+                15-digit block id
+        latitude, longitude: float
+                address point coordinates
+
+        Returns
+        -------
+        tlid: str
+                TLID match, or None if the name-block combination has no candidates
+        status: str
+                'single', 'multi', 'no_candidates' or 'no_geometry'
+        """
+        entry = self.candidates.get((maf_name, blkid))
+        if entry is None and self.fallback is not None:
+            # Kept in the index, so that the name is only matched once
+            entry = self.add(maf_name, blkid, self.fallback.possible_tlids(maf_name, blkid))
+            instrument.count('index_fallback')
+        if entry is None or len(entry[0]) == 0:
+            return None, 'no_candidates'
+        tlids, coords, owners = entry
+        if coords is None:
+            return tlids[0], 'single'
+        if coords.shape[0] == 0:
+            return None, 'no_geometry'
+        dist = np.sqrt(((coords - (float(longitude), float(latitude))) ** 2).sum(axis=1))
+        return tlids[owners[np.argmin(dist)]], 'multi'
+
+
+def index_cache(county_code='08031', cutoff=0.5, adjacent=True):
+    """
+    Stage cache for the index of a county, keyed on the crosswalk written by
+    tiger_xwalk.py, the county's TIGER edges and faces, and the name match
+    parameters of build_county_index
+    """
+    xwalk_path = "../results/possible_tlids/" + county_code + "_address_maf_xwalk.csv"
+    return stage_cache.StageCache(county_code, params={'cutoff': cutoff, 'adjacent': adjacent},
+                                  files={'xwalk': xwalk_path})
+
+
+def build_county_index(county_code='08031', cutoff=0.5, adjacent=True):
+    """
+    Builds a CountyIndex from the crosswalk written by tiger_xwalk.py and the
+    county's TIGER edges and faces. Block sides are only merged when the edges
+    have node ids (TNIDF and TNIDT). cutoff and adjacent are the name match
+    parameters of tiger_xwalk.process_county, used for name-block combinations
+    that are not in the crosswalk (see NameFallback).
+    """
+    xwalk = tlid_utils.import_xwalk(county_code=county_code)
+    edges, faces = tiger_xwalk.load_tiger_csv("../data/tiger_csv/" + county_code + "_edges.csv",
+                                              "../data/tiger_csv/" + county_code + "_faces.csv")
+    edges = edges.assign(TLID=edges['TLID'].astype(str))
+    sides = block_sides.county_block_sides(county_code, edges=edges, faces=faces, use_cache=False)
+    fallback = NameFallback(tiger_xwalk.create_edge_face(edges, faces), faces, cutoff=cutoff, adjacent=adjacent)
+    return CountyIndex(xwalk, edges.set_index('TLID'), sides=sides, fallback=fallback)
+
+
+def load_county_index(county_code='08031', use_cache=False):
+    """
+    Loads the CountyIndex of a county
+
+    Parameters
+    ----------
+    county_code: str
+            fips code for county
+    use_cache: bool
+            if true, reuses the index from the stage cache (see stage_cache.py)
+            while the crosswalk and edges files are unchanged
+
+    Returns
+    -------
+    index: CountyIndex
+    """
+    with instrument.stage('load_index', county_code=county_code) as record:
+        if use_cache:
+            index = index_cache(county_code).cached('index', lambda: build_county_index(county_code))
+        else:
+            index = build_county_index(county_code)
+        record['combinations'] = len(index.candidates)
+    logger.info("Loaded index for county %s: %d name-block combinations", county_code, len(index.candidates))
+    return index
+
+
+class MatchingService(object):
+    """
+    Answers TLID queries for a set of preloaded counties
+
+    Parameters
+    ----------
+    county_codes: list
+            fips codes of the counties to preload
+    indexes: dict
+            already built CountyIndex objects, by county code, such as ones built
+            from tables held by pipeline.py
+    """
+    def __init__(self, county_codes=(), indexes=None):
+        self.indexes = dict(indexes or {})
+        for county_code in county_codes:
+            if county_code not in self.indexes:
+                self.indexes[county_code] = load_county_index(county_code)
+
+    def match(self, query):
+        """
+        Matches a single address
+
+        Parameters
+        ----------
+        query: dict
+                MAF_NAME, BLKID, LATITUDE and LONGITUDE. The county is taken from
+                the first five digits of BLKID, unless county_code is given.
+
+        Returns
+        -------
+        result: dict
+                the query's MAFID (if any), TLID match (or None) and status, which
+                is also 'unknown_county' for counties that are not loaded
+        """
+        blkid = str(query['BLKID'])
+        index = self.indexes.get(query.get('county_code', blkid[:5]))
+        if index is None:
+            tlid, status = None, 'unknown_county'
+        else:
+            tlid, status = index.match(str(query['MAF_NAME']), blkid, query['LATITUDE'], query['LONGITUDE'])
+        instrument.count('query_' + status)
+        return {'MAFID': query.get('MAFID'), 'TLID': tlid, 'status': status}
+
+    def match_batch(self, queries):
+        """
+        Matches a list of addresses, returning one result per query, in order
+        """
+        return [self.match(query) for query in queries]
+
+
+def make_handler(service):
+    """
+    Creates an HTTP request handler class bound to a MatchingService
+    """
+    class MatchHandler(BaseHTTPRequestHandler):
+        def send_json(self, code, body):
+            payload = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.send_json(200, {'counties': sorted(service.indexes)})
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/match':
+                self.send_json(404, {'error': 'not found'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if isinstance(body, list):
+                    self.send_json(200, service.match_batch(body))
+                else:
+                    self.send_json(200, service.match(body))
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json(400, {'error': repr(e)})
+
+        def log_message(self, format, *args):
+            logger.debug("%s " + format, self.address_string(), *args)
+
+    return MatchHandler
+
+
+def serve(service, host='127.0.0.1', port=8031):
+    """
+    Serves a MatchingService over HTTP until interrupted
+
+    Parameters
+    ----------
+    service: MatchingService
+    host: str
+            address to bind, local only by default
+    port: int
+            port to listen on
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    logger.info("Serving TLID matches for counties %s on http://%s:%d/match", sorted(service.indexes), host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def time_queries(service, queries):
+    """
+    Measures per-query latency of a MatchingService
+
+    Returns
+    -------
+    latencies: np array
+            seconds taken by each query
+    """
+    latencies = np.empty(len(queries))
+    for i, query in enumerate(queries):
+        t0 = time.perf_counter()
+        service.match(query)
+        latencies[i] = time.perf_counter() - t0
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve TLID matches for preloaded counties")
+    parser.add_argument('--counties', nargs='+', default=['08031'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8031)
+    args = parser.parse_args()
+    instrument.configure_logging()
+    serve(MatchingService(args.counties), host=args.host, port=args.port)
@@ -0,0 +1,152 @@
+import os
+import json
+import fcntl
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+
+"""
+This script contains a dictionary of street names, which maps every distinct
+name (MAF or TIGER) to an integer ID, so that joins and groupbys on street names
+run on integer keys instead of Python strings.
+
+IDs are only ever appended, so a name keeps its ID for as long as the dictionary
+exists. Dictionaries are persisted per state (the first two digits of the county
+code) in NAME_DICT_DIR, and shared by every county of the state. Saving merges
+with the saved dictionary under a file lock, so counties processed at the same
+time never drop each other's names. Names that another process saved first keep
+their IDs, and names added since loading are appended after them.
+"""
+
+logger = logging.getLogger(__name__)
+
+NAME_DICT_DIR = "../results/name_dictionary/"
+
+
+class NameDictionary(object):
+    """
+    Append-only mapping between street names and integer IDs
+
+    Parameters
+    ----------
+    names: list
+            names in ID order, such as those of a saved dictionary
+    """
+    def __init__(self, names=()):
+        self.names = list(names)
+        self.index = pd.Index(self.names, dtype=object)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, values):
+        """
+        Adds names that are not yet in the dictionary
+        """
+        uniques = pd.unique(pd.Series(values, dtype=object).dropna())
+        new = [name for name in uniques[self.index.get_indexer(uniques) < 0]]
+        if new:
+            self.names += new
+            self.index = pd.Index(self.names, dtype=object)
+        return len(new)
+
+    def encode(self, values):
+        """
+        Converts names to IDs, adding new names to the dictionary
+
+        Parameters
+        ----------
+        values: array-like
+                street names
+
+        Returns
+        -------
+        ids: np array
+                int32 ID of each name, -1 for missing names
+        """
+        self.add(values)
+        ids = self.index.get_indexer(pd.Series(values, dtype=object))
+        return ids.astype(np.int32)
+
+    def decode(self, ids):
+        """
+        Converts IDs back to names, with None for -1
+        """
+        ids = np.asarray(ids)
+        names = np.array(self.names + [None], dtype=object)
+        return names[np.where(ids < 0, len(self.names), ids)]
+
+    def digest(self, count=None):
+        """
+        Hash of the first count names (all names if None) in ID order, which
+        changes if any of their IDs does
+        """
+        names = self.names if count is None else self.names[:count]
+        return hashlib.sha256(json.dumps(names).encode()).hexdigest()[:24]
+
+    def save(self, path):
+        """
+        Saves the names in ID order, one per row, merged with any dictionary
+        saved at path since this one was loaded
+
+        Returns
+        -------
+        kept: bool
+                true if every name kept its ID. If another process saved new
+                names first, the names added here since loading are saved with
+                new IDs, and this dictionary is left unchanged.
+        """
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            saved = read_names(path) if os.path.exists(path) else []
+            merged = NameDictionary(saved)
+            merged.add(self.names)
+            kept = merged.names[:len(self.names)] == self.names
+            if kept:
+                # Only names saved by others were added, so the IDs in use stay valid
+                self.names = merged.names
+                self.index = merged.index
+            else:
+                logger.warning("Name dictionary %s changed since it was loaded; %d names were saved with new IDs",
+                               path, len(merged) - len(saved))
+            tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+            pd.DataFrame({'NAME': merged.names}).to_csv(tmp_path, index_label='NAME_ID')
+            os.replace(tmp_path, path)
+        return kept
+
+
+def dictionary_path(county_code='08031'):
+    """
+    Path of the dictionary shared by the counties of a state
+    """
+    return NAME_DICT_DIR + county_code[:2] + "_names.csv"
+
+
+def read_names(path):
+    """
+    Names of a saved dictionary, in ID order
+    """
+    saved = pd.read_csv(path, dtype={'NAME': object}, keep_default_na=False)
+    return saved.sort_values('NAME_ID')['NAME'].tolist()
+
+
+def load_names(county_code='08031'):
+    """
+    Loads the name dictionary of a county's state, or an empty one if it has not
+    been saved yet
+    """
+    path = dictionary_path(county_code)
+    if not os.path.exists(path):
+        return NameDictionary()
+    return NameDictionary(read_names(path))
+
+
+def save_names(names, county_code='08031'):
+    """
+    Saves the name dictionary of a county's state
+    """
+    names.save(dictionary_path(county_code))
+    logger.info("Saved name dictionary with %d names", len(names))
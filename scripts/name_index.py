@@ -0,0 +1,133 @@
+import difflib
+import logging
+import numpy as np
+import pandas as pd
+
+"""
+This script contains an n-gram index of a county's TIGER street names, used by
+tiger_xwalk.py to match MAF names that have no close TIGER name along their own
+block.
+
+Every distinct name is split into overlapping character n-grams (trigrams of the
+lowercased name, padded with spaces), and an inverted index maps each n-gram to
+the names that contain it. The names sharing the most n-grams with a MAF name
+are found by counting, over the posting lists of its n-grams, how often each
+name appears, without comparing strings. Only a short list of the most similar
+names (by Dice coefficient of their n-grams) is then scored with difflib, the
+same score as match_names, so a name costs the same however many names the
+county has.
+
+The second tier of the name match only searches the blocks adjacent to the
+address's block, that is the blocks on the other side of one of its edges (see
+block_neighbors), so candidate TLID lists stay as tight as for a name found on
+the address's own block.
+"""
+
+logger = logging.getLogger(__name__)
+
+NGRAM = 3
+
+# Names scored with difflib for each query
+SHORTLIST = 8
+
+
+def ngrams(name, n=NGRAM):
+    """
+    Distinct character n-grams of a name, lowercased and padded with spaces
+    """
+    padded = ' ' + ' '.join(str(name).lower().split()) + ' '
+    return {padded[i:i + n] for i in range(max(len(padded) - n + 1, 1))}
+
+
+class NameIndex(object):
+    """
+    Inverted index from character n-grams to street names
+
+    Parameters
+    ----------
+    names: array-like
+            street names, such as the FULLNAME column of
+            tiger_xwalk.create_names_blocks. Missing values and duplicates are
+            dropped.
+    n: int
+            length of the n-grams
+    """
+    def __init__(self, names, n=NGRAM):
+        self.n = n
+        self.names = pd.unique(pd.Series(names, dtype=object).dropna().astype(str))
+        self.index = pd.Index(self.names)
+        grams = [ngrams(name, n) for name in self.names]
+        self.sizes = np.array([len(g) for g in grams], dtype=np.int64)
+        gram_names = pd.Series(np.repeat(np.arange(len(grams)), self.sizes),
+                               index=[gram for g in grams for gram in g])
+        self.postings = {gram: positions.values for gram, positions in gram_names.groupby(level=0)}
+
+    def __len__(self):
+        return self.names.shape[0]
+
+    def similarities(self, name):
+        """
+        Dice coefficient of the n-grams of name with those of every indexed name
+        """
+        grams = ngrams(name, self.n)
+        postings = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not postings:
+            return np.zeros(len(self))
+        shared = np.bincount(np.concatenate(postings), minlength=len(self))
+        return 2 * shared / (len(grams) + self.sizes)
+
+    def best_match(self, name, allowed=None, cutoff=0.5, shortlist=SHORTLIST):
+        """
+        Closest indexed name to a street name
+
+        Parameters
+        ----------
+        name: str
+                street name, in MAF form
+        allowed: array-like
+                names to choose from, such as those along the blocks adjacent to
+                an address. All indexed names if None.
+        cutoff: float
+                minimum difflib similarity score for a match
+        shortlist: int
+                number of names with the most n-grams in common that are scored
+
+        Returns
+        -------
+        closest_match: str
+                the closest name, or None if no shortlisted name reaches cutoff
+        """
+        scores = self.similarities(name)
+        if allowed is None:
+            positions = np.arange(len(self))
+        else:
+            positions = self.index.get_indexer(pd.unique(pd.Series(allowed, dtype=object).dropna()))
+            positions = positions[positions >= 0]
+        positions = positions[scores[positions] > 0]
+        if positions.shape[0] > shortlist:
+            positions = positions[np.argsort(-scores[positions], kind='stable')[:shortlist]]
+        closest_match = difflib.get_close_matches(name, self.names[positions].tolist(), cutoff=cutoff, n=1)
+        return closest_match[0] if closest_match else None
+
+
+def block_neighbors(edge_face, faces):
+    """
+    Blocks on the other side of each block's edges
+
+    Parameters
+    ----------
+    edge_face: pd DataFrame
+            Output of tiger_xwalk.create_edge_face(), with TLID and TFID
+    faces: pd DataFrame
+            Face data from TIGER, with TFID and concatinated block id
+
+    Returns
+    -------
+    neighbors: pd Series
+            list of adjacent BLKIDs, indexed by BLKID
+    """
+    edge_blocks = edge_face[['TLID', 'TFID']].merge(faces[['TFID', 'BLKID']].drop_duplicates(), on='TFID')
+    edge_blocks = edge_blocks[['TLID', 'BLKID']].drop_duplicates()
+    pairs = edge_blocks.merge(edge_blocks, on='TLID', suffixes=('', '_ADJ'))
+    pairs = pairs.loc[pairs['BLKID'] != pairs['BLKID_ADJ']].drop_duplicates(['BLKID', 'BLKID_ADJ'])
+    return pairs.groupby('BLKID', sort=False)['BLKID_ADJ'].agg(list)
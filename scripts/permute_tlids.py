@@ -1,6 +1,11 @@
 import random
+import math
+import logging
 import numpy as np
 import pandas as pd
+import instrument
+import aggregate_cube
+import results_store
 
 
 """
@@ -12,6 +17,8 @@ based on an empirical (simulated) null distribution of spatial randomness
 within each block.
 """
 
+logger = logging.getLogger(__name__)
+
 def permute_houses(dem_data, iterations = 10):
     """
     Randomly permute houses within each block. This allows for
@@ -38,7 +45,7 @@ def permute_houses(dem_data, iterations = 10):
         dem_data['TLID_permuted_'+str(i)] = dem_data.groupby('BLKID')['TLID'].transform(np.random.permutation)
     return dem_data
 
-def find_global_p_val(data, iterations=10):
+def find_global_p_val(data, iterations=10, var_list=['A', 'B', 'C', 'D', 'E']):
     """
     Randomly shuffles TLID assignments within each block,
     reassigning them to each MAFID. Aggregates both the true data
@@ -53,35 +60,31 @@ def find_global_p_val(data, iterations=10):
             BLKIDs. Each row represents a MAFID-indexed household.
     iterations: int
             number of times to shuffle households and reaggregate
+    var_list: list
+            numeric columns to aggregate
 
     Returns
     -------
-    aggs_avg: pd DataFrame
-            each row is a TLID-BLKID pair, first columns are the differences in
-            aggregation for each variable, remaining columns are empirical p-values
-            averaged over all iterations
+    p_vals: dict
+            empirical p-value for each variable
     """
 
     # Aggregate "data"
     # TODO: Change this aggregation to account for real data (TLID-BLKID differences)
-    aggs = data[['TLID','A', 'B', 'C', 'D', 'E']].groupby(['TLID']).mean()
-    blk_aggs = data[['TLID','BLKID','A', 'B', 'C', 'D', 'E']].groupby(['BLKID']).mean()
-    tlid_blk_aggs = data[['TLID','BLKID','A', 'B', 'C', 'D', 'E']].groupby(['TLID','BLKID']).mean().reset_index()
-    print("TLID-BLKID aggs: \n", tlid_blk_aggs.head())
+    tlid_blk_aggs = data[['TLID','BLKID'] + var_list].groupby(['TLID','BLKID']).mean().reset_index()
+    logger.debug("TLID-BLKID aggs:\n%s", tlid_blk_aggs.head())
 
     data_sims = permute_houses(dem_data=data, iterations=iterations)
-    var_list = ['A', 'B', 'C', 'D', 'E']
 
     means_list = []
     for i in range(iterations):
-        synth_aggs = data_sims[['TLID_permuted_'+str(i),'BLKID','A', 'B', 'C', 'D', 'E']].groupby(['TLID_permuted_'+str(i), 'BLKID']).mean()
+        synth_aggs = data_sims[['TLID_permuted_'+str(i),'BLKID'] + var_list].groupby(['TLID_permuted_'+str(i), 'BLKID']).mean()
         means_list.append({var:synth_aggs[var].abs().mean() for var in var_list})
     means = pd.DataFrame(means_list)
-    print(means.abs().head(20))
-    print(tlid_blk_aggs.mean().abs())
+    logger.debug("Shuffled means:\n%s", means.abs().head(20))
 
     p_vals = {var:((means[tlid_blk_aggs[var].abs().mean() < means[var]].shape[0])/iterations) for var in var_list}
-    print(p_vals)
+    logger.info("Global p-values: %s", p_vals)
     return p_vals
 
 def average_pvals(pval_df, iterations=10):
@@ -143,7 +146,7 @@ def find_p_vals(data, iterations=10):
     aggs = data[['TLID','BLKID','A', 'B', 'C', 'D', 'E']].groupby(['TLID']).mean()
     blk_aggs = data[['TLID','BLKID','A', 'B', 'C', 'D', 'E']].groupby(['BLKID']).mean()
     tlid_blk_aggs = data[['TLID','BLKID','A', 'B', 'C', 'D', 'E']].groupby(['TLID','BLKID']).mean()
-    print("TLID-BLKID aggs: \n", tlid_blk_aggs.head())
+    logger.debug("TLID-BLKID aggs:\n%s", tlid_blk_aggs.head())
 
     for i in range(iterations):
         shuffled_data = permute_houses(data, seed=i)
@@ -183,11 +186,255 @@ def rate_more_extreme(val, synth_series):
     return p_val
 
 
+def normal_sf(z):
+    """
+    Upper-tail probability of the standard normal distribution
+
+    Parameters
+    ----------
+    z: float or np array
+            standard normal deviates
+
+    Returns
+    -------
+    p: np array
+            P(Z > z) for each value of z
+    """
+    return 0.5 * np.vectorize(math.erfc, otypes=[float])(np.asarray(z, dtype=float) / math.sqrt(2))
+
+
+def chi2_sf(x, df):
+    """
+    Upper-tail probability of the chi-square distribution. Uses the closed
+    form series for small integer degrees of freedom, and the Wilson-Hilferty
+    normal approximation for large degrees of freedom (such as global
+    statistics summed over every block in a county or state).
+
+    Parameters
+    ----------
+    x: float or np array
+            chi-square statistics
+    df: int or np array
+            degrees of freedom for each statistic
+
+    Returns
+    -------
+    p: np array
+            P(X > x) for each statistic, nan where df < 1
+    """
+    x, df = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(df, dtype=int))
+    p = np.full(x.shape, np.nan)
+    h = np.maximum(x, 0) / 2
+    log_h = np.log(np.where(h > 0, h, 1))
+
+    # Exact series for small df
+    small = (df >= 1) & (df <= 100)
+    even = small & (df % 2 == 0)
+    odd = small & (df % 2 == 1)
+    p[even] = 0
+    p[odd] = np.vectorize(math.erfc, otypes=[float])(np.sqrt(h[odd]))
+    for i in range(50):
+        even_term = even & (i < df // 2)
+        p[even_term] += np.exp(-h[even_term] + i * log_h[even_term] - math.lgamma(i + 1))
+        odd_term = odd & (i >= 1) & (i <= (df - 1) // 2) & (h > 0)
+        p[odd_term] += np.exp(-h[odd_term] + (i - .5) * log_h[odd_term] - math.lgamma(i + .5))
+
+    # Wilson-Hilferty approximation for large df
+    large = df > 100
+    k = df[large]
+    z = ((np.maximum(x[large], 0) / k) ** (1 / 3) - (1 - 2 / (9 * k))) / np.sqrt(2 / (9 * k))
+    p[large] = normal_sf(z)
+
+    p[small & (x <= 0)] = 1
+    return np.clip(p, 0, 1)
+
+
+def block_null_moments(data, var_list=['A', 'B', 'C', 'D', 'E']):
+    """
+    Finds the mean and variance of each TLID-BLKID aggregation under the null
+    hypothesis that households are randomly shuffled within their block.
+
+    Under a within-block shuffle, a TLID-BLKID group of n households is a simple
+    random sample (without replacement) of the N households in the block. Its
+    mean therefore has expectation equal to the block mean, and variance
+    sigma^2 / n * (N - n) / (N - 1), where sigma^2 is the (population) variance
+    of the block's values.
+
+    Parameters
+    ----------
+    data: pd DataFrame or aggregate_cube.AggregationCube
+            demographic (or synthetic) data with columns for TLIDs and
+            BLKIDs. Each row represents a MAFID-indexed household. The block
+            and TLID-BLKID statistics are read from an aggregation cube, built
+            here if data is not one already.
+    var_list: list
+            numeric columns to aggregate
+
+    Returns
+    -------
+    moments: pd DataFrame
+            each row is a TLID-BLKID pair, with group size ('N'), block size
+            ('BLK_N'), and for each variable the observed mean, null mean
+            ('[[var]]_null_mean') and null standard deviation ('[[var]]_null_sd')
+    """
+    cube = data if isinstance(data, aggregate_cube.AggregationCube) else aggregate_cube.build_cube(data, var_list)
+    blk_summary = cube.summary('block')
+    blk_stats = blk_summary[var_list].add_suffix('_null_mean')
+    blk_stats = blk_stats.join(pd.DataFrame({var + '_blk_var': blk_summary[var + '_var'] for var in var_list}))
+    blk_stats.loc[:, 'BLK_N'] = blk_summary['N']
+
+    tlid_blk_summary = cube.summary('tlid_blkid')
+    moments = tlid_blk_summary[var_list].copy()
+    moments.loc[:, 'N'] = tlid_blk_summary['N']
+    moments = moments.reset_index().merge(blk_stats, left_on='BLKID', right_index=True, how='left')
+
+    # Finite population correction -- a group covering its whole block never varies
+    fpc = (moments['BLK_N'] - moments['N']) / (moments['BLK_N'] - 1).where(moments['BLK_N'] > 1)
+    for var in var_list:
+        moments.loc[:, var + '_null_sd'] = np.sqrt(moments[var + '_blk_var'] / moments['N'] * fpc.fillna(0))
+        moments = moments.drop([var + '_blk_var'], axis=1)
+
+    return moments.set_index(['TLID', 'BLKID'])
+
+
+def find_p_vals_analytic(data, var_list=['A', 'B', 'C', 'D', 'E']):
+    """
+    Normal-approximation alternative to find_p_vals. Uses the exact null moments
+    of each TLID-BLKID aggregation under within-block shuffling (see
+    block_null_moments) to find approximate two-sided p-values in a single pass,
+    without simulating any permutations.
+
+    Parameters
+    ----------
+    data: pd DataFrame
+            demographic (or synthetic) data with columns for TLIDs and
+            BLKIDs. Each row represents a MAFID-indexed household.
+    var_list: list
+            numeric columns to aggregate
+
+    Returns
+    -------
+    moments: pd DataFrame
+            output of block_null_moments, with a z-score ('[[var]]_z') and
+            approximate p-value ('[[var]]_p') for each variable. Groups that cannot
+            vary under shuffling (whole-block TLIDs or constant blocks) get a
+            p-value of 1.
+    """
+    moments = block_null_moments(data, var_list=var_list)
+    for var in var_list:
+        null_sd = moments[var + '_null_sd'].where(moments[var + '_null_sd'] > 0)
+        moments.loc[:, var + '_z'] = (moments[var] - moments[var + '_null_mean']) / null_sd
+        moments.loc[:, var + '_p'] = 2 * normal_sf(moments[var + '_z'].abs())
+        moments.loc[:, var + '_p'] = moments[var + '_p'].fillna(1)
+    return moments
+
+
+def block_chi2_stats(data, var_list=['A', 'B', 'C', 'D', 'E']):
+    """
+    Finds a between-street sum of squares statistic for every block. For a block
+    with G TLIDs, sum(n * (group mean - block mean)^2) / s^2, where s^2 is the
+    sample variance of the block, has expectation G - 1 under within-block
+    shuffling, and is approximately chi-square with G - 1 degrees of freedom.
+
+    Parameters
+    ----------
+    data: pd DataFrame
+            demographic (or synthetic) data with columns for TLIDs and
+            BLKIDs. Each row represents a MAFID-indexed household.
+    var_list: list
+            numeric columns to aggregate
+
+    Returns
+    -------
+    blk_stats: pd DataFrame
+            each row is a block, with degrees of freedom ('DF') and a statistic
+            ('[[var]]_chi2') for each variable. Blocks served by a single TLID
+            have zero degrees of freedom.
+    """
+    cube = data if isinstance(data, aggregate_cube.AggregationCube) else aggregate_cube.build_cube(data, var_list)
+    moments = block_null_moments(cube, var_list=var_list).reset_index()
+    blk_stats = moments.groupby('BLKID')['TLID'].size().rename('DF').to_frame() - 1
+    blk_n = moments.groupby('BLKID')['BLK_N'].first()
+    blk_summary = cube.summary('block', ddof=1)
+    for var in var_list:
+        sq_dev = moments['N'] * (moments[var] - moments[var + '_null_mean']) ** 2
+        between_ss = sq_dev.groupby(moments['BLKID']).sum()
+        blk_var = blk_summary[var + '_var']
+        blk_stats.loc[:, var + '_chi2'] = (between_ss / blk_var.where(blk_var > 0)).fillna(0)
+    blk_stats.loc[:, 'BLK_N'] = blk_n
+    return blk_stats
+
+
+def find_global_p_val_analytic(data, var_list=['A', 'B', 'C', 'D', 'E']):
+    """
+    Normal-approximation alternative to find_global_p_val. Sums the block-level
+    between-street statistics from block_chi2_stats over every block, and compares
+    the total with a chi-square distribution whose degrees of freedom are summed
+    the same way. Runs in a single pass over the data, so it can be used to screen
+    whole states before spending Monte Carlo time.
+
+    Parameters
+    ----------
+    data: pd DataFrame
+            demographic (or synthetic) data with columns for TLIDs and
+            BLKIDs. Each row represents a MAFID-indexed household.
+    var_list: list
+            numeric columns to aggregate
+
+    Returns
+    -------
+    p_vals: dict
+            approximate p-value for each variable
+    """
+    blk_stats = block_chi2_stats(data, var_list=var_list)
+    blk_stats = blk_stats.loc[blk_stats['DF'] > 0]
+    df = blk_stats['DF'].sum()
+    p_vals = {var: float(chi2_sf(blk_stats[var + '_chi2'].sum(), df)) for var in var_list}
+    logger.info("Approximate global p-values: %s", p_vals)
+    return p_vals
+
+
+def screen_blocks(data, var_list=['A', 'B', 'C', 'D', 'E'], alpha=0.05):
+    """
+    Uses block-level analytic p-values to select blocks that are worth testing
+    with the Monte Carlo functions (find_p_vals, find_global_p_val).
+
+    Parameters
+    ----------
+    data: pd DataFrame
+            demographic (or synthetic) data with columns for TLIDs and
+            BLKIDs. Each row represents a MAFID-indexed household.
+    var_list: list
+            numeric columns to aggregate
+    alpha: float
+            blocks with an approximate p-value below alpha for any variable
+            are kept
+
+    Returns
+    -------
+    blk_p_vals: pd DataFrame
+            each row is a block with more than one TLID, with an approximate
+            p-value ('[[var]]_p') for each variable, sorted by smallest p-value
+    interesting: list
+            BLKIDs of blocks with at least one p-value below alpha
+    """
+    blk_stats = block_chi2_stats(data, var_list=var_list)
+    blk_stats = blk_stats.loc[blk_stats['DF'] > 0]
+    p_cols = [var + '_p' for var in var_list]
+    for var in var_list:
+        blk_stats.loc[:, var + '_p'] = chi2_sf(blk_stats[var + '_chi2'].values, blk_stats['DF'].values)
+    blk_p_vals = blk_stats.assign(MIN_P=blk_stats[p_cols].min(axis=1)).sort_values('MIN_P')
+    interesting = blk_p_vals.loc[blk_p_vals['MIN_P'] < alpha].index.tolist()
+    logger.info("Blocks flagged for Monte Carlo testing: %d of %d", len(interesting), blk_p_vals.shape[0])
+    return blk_p_vals.drop(['MIN_P'], axis=1), interesting
+
+
 if __name__ == "__main__":
+    instrument.configure_logging()
+
     # Load public addresses & crosswalk
     addresses = pd.read_csv('../data/addresses/08031_addresses.csv')
-    xwalk = pd.read_csv('../results/address_tlid_xwalk/08031_tlid_match.csv')
-    merged_xwalk = pd.merge(addresses, xwalk, on='MAFID')
+    merged_xwalk = results_store.load_store('08031').join(addresses, on='MAFID')
     merged_xwalk.rename(columns={'TLID_match':'TLID'}, inplace=True)
 
     # Create random data and merge it to address-xwalk table
@@ -197,7 +444,12 @@ if __name__ == "__main__":
     rand_data.loc[:,'MAFID'] = merged_xwalk['MAFID']
     synth_dem_data = pd.merge(merged_xwalk, rand_data, on='MAFID')
 
-    print("\n\nSynthetic demographic data:")
-    print(synth_dem_data.head(20))
+    logger.debug("Synthetic demographic data:\n%s", synth_dem_data.head(20))
 
-    pvals = find_global_p_val(synth_dem_data, iterations=30)
+    # Fast analytic screen, then Monte Carlo test
+    with instrument.run('permute_tlids', county_code='08031', iterations=30):
+        with instrument.stage('analytic'):
+            analytic_pvals = find_global_p_val_analytic(synth_dem_data, var_list=column_names)
+        with instrument.stage('monte_carlo') as record:
+            pvals = find_global_p_val(synth_dem_data, iterations=30)
+            record['rows'] = synth_dem_data.shape[0]
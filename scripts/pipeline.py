@@ -0,0 +1,265 @@
+import logging
+import numpy as np
+import pandas as pd
+import instrument
+import profiling
+import stage_cache
+import block_assign
+import tiger_xwalk
+import match_tlid
+import block_sides
+import edge_store
+import permute_tlids
+import prefetch
+import sampling
+
+"""
+This script runs the whole workflow for a county in a single process: building
+the possible TLID crosswalk (tiger_xwalk.py), matching addresses to TLIDs
+(match_tlid.py), and testing street-level aggregations (permute_tlids.py).
+
+Running the scripts one after another passes every table through a CSV file,
+which means writing the TLID lists as text and parsing them back. Here, each
+stage hands its pandas/NumPy tables directly to the next one: TIGER files and
+addresses are read once, the crosswalk's TLIDs stay Python lists of integer
+TLIDs, and match results stay the dict of TLID matches keyed by MAFID that
+match_tlid.match_dicts returns, joined to the addresses in memory. Intermediate
+files are only written if write_intermediate is set, in which case they are the
+same files the individual scripts would write.
+
+With use_cache, the crosswalk and match results are also reused from the stage
+cache (see stage_cache.py) when the county's input files have not changed, in
+which case the TIGER files are not read at all.
+
+run_counties runs several counties in turn, reading the next county's files
+while the current one is processed.
+"""
+
+logger = logging.getLogger(__name__)
+
+VAR_LIST = ['A', 'B', 'C', 'D', 'E']
+
+
+def synthetic_dem_data(addresses, var_list=VAR_LIST, seed=0):
+    """
+    Generates random "demographic" variables for each address, as in the main
+    function of permute_tlids.py
+
+    Parameters
+    ----------
+    addresses: pd DataFrame
+            address points with a MAFID column
+    var_list: list
+            names of the variables to generate
+    seed: int
+            random seed
+
+    Returns
+    -------
+    dem_data: pd DataFrame
+            MAFID and one column of standard normal values per variable
+    """
+    rand_data = np.random.default_rng(seed).standard_normal((addresses.shape[0], len(var_list)))
+    dem_data = pd.DataFrame(rand_data, columns=var_list)
+    dem_data.insert(0, 'MAFID', addresses['MAFID'].values)
+    return dem_data
+
+
+def join_matches(addresses, results, dem_data):
+    """
+    Joins match results and demographic data to addresses, giving the input
+    expected by permute_tlids
+
+    Parameters
+    ----------
+    addresses: pd DataFrame
+            address points with MAFID and BLKID columns
+    results: dict
+            synthetic MAFID as keys and TLID match as values
+    dem_data: pd DataFrame
+            MAFID and numeric variables
+
+    Returns
+    -------
+    matched: pd DataFrame
+            one row per matched address, with MAFID, BLKID, TLID and variables
+    """
+    matches = pd.Series(results, name='TLID').dropna()
+    matched = addresses[['MAFID', 'BLKID']].merge(matches, left_on='MAFID', right_index=True, how='inner')
+    matched = matched.merge(dem_data, on='MAFID', how='inner')
+    return matched
+
+
+def run_pipeline(county_code='08031', sample=False, dem_data=None, var_list=VAR_LIST, iterations=10,
+                 monte_carlo=True, write_intermediate=False, profile=False, use_cache=False, sort_curve=None,
+                 inputs=None, coords='float64', seed=sampling.DEFAULT_SEED, budget=None, input_metrics=None):
+    """
+    Builds the crosswalk, matches addresses to TLIDs, and tests whether street
+    aggregations differ from block aggregations, for one county in one process.
+
+    Parameters
+    ----------
+    county_code: str
+            fips code for county
+    sample: bool or float
+            if true, only match a stratified 10% sample of addresses (or this
+            fraction, if a number; see sampling.py), and estimate standard errors
+            of the match estimates and p-values
+    dem_data: pd DataFrame
+            MAFID and the numeric variables to test. If None, random variables
+            are generated, as in permute_tlids.py.
+    var_list: list
+            variables in dem_data to test
+    iterations: int
+            number of shuffles for the Monte Carlo test
+    monte_carlo: bool
+            if false, only the analytic approximation is computed
+    write_intermediate: bool
+            if true, also writes the name match, crosswalk and match results to the
+            files read and written by tiger_xwalk.py and match_tlid.py
+    profile: bool
+            if true, profiles the whole pipeline (see profiling.py)
+    use_cache: bool
+            if true, reuses the name match, crosswalk and match results from the
+            stage cache when the input files have not changed. Samples are not
+            cached.
+    sort_curve: str
+            if 'hilbert' or 'zorder', addresses are matched in that curve's order
+            (see spatial_sort.py)
+    inputs: tuple
+            the county's edges, faces and addresses, as returned by
+            tiger_xwalk.load_county, if they have already been loaded
+    coords: str
+            storage type of coordinates in the distance calculation, 'float64',
+            'float32' or 'fixed' (see match_tlid.match_dicts)
+    seed: int
+            random seed of the sample
+    budget: float
+            if given with sample, the sample is sized to about this many seconds
+            of matching
+    input_metrics: instrument.RunMetrics
+            the instrumentation buffer of loading inputs (see instrument.buffer),
+            replayed into this county's run
+
+    Returns
+    -------
+    tables: dict
+            'xwalk' (crosswalk), 'results' (dict of MAFID to TLID), 'matched'
+            (matched addresses with variables), 'analytic_p_vals' and, if
+            monte_carlo, 'p_vals'. Samples also have 'match_estimates' (see
+            sampling.SampleDesign.match_estimates), 'analytic_p_val_errors' and,
+            if monte_carlo, 'p_val_errors' (see sampling.SampleDesign.replicate).
+    """
+    tables = {}
+    with instrument.run('pipeline', county_code=county_code, sample=sample, iterations=iterations) as metrics, \
+            profiling.profile('pipeline_' + county_code, enabled=profile):
+        if input_metrics is not None:
+            metrics.replay(input_metrics)
+        cache = stage_cache.StageCache(county_code, params={'coords': coords}) if use_cache else None
+        tiger = {}
+        if inputs is not None:
+            tiger['edges'], tiger['faces'], tiger['maf'] = inputs
+
+        def load_tiger():
+            # Only read when a stage has to be computed
+            if not tiger:
+                tiger['edges'], tiger['faces'], tiger['maf'] = tiger_xwalk.load_county(county_code)
+            return tiger
+
+        with instrument.stage('xwalk'):
+            xwalk = cache.get('xwalk') if cache is not None else None
+            if xwalk is None:
+                load_tiger()
+                xwalk = tiger_xwalk.build_county_xwalk(tiger['edges'], tiger['faces'], tiger['maf'],
+                                                       county_code=county_code, names_cache=write_intermediate,
+                                                       cache=cache)
+                if cache is not None:
+                    cache.put('xwalk', xwalk)
+            if write_intermediate:
+                tiger_xwalk.write_xwalk(xwalk, county_code=county_code)
+        tables['xwalk'] = xwalk
+
+        with instrument.stage('tlid_match'):
+            if tiger:
+                county_maf = tiger['maf']
+            else:
+                county_maf = pd.read_csv("../data/addresses/" + county_code + "_addresses.csv",
+                                         converters={'BLKID': lambda x: str(x)})
+                county_maf = block_assign.fill_missing_blocks(county_maf, county_code=county_code)
+            design = None
+            if sample:
+                addresses, design = sampling.stratified_sample(
+                    county_maf, sampling.candidate_counts(county_maf, xwalk), seed=seed, budget=budget,
+                    fraction=sampling.sample_fraction(sample))
+            else:
+                addresses = county_maf
+            match_cache = cache if not sample else None
+            results = match_cache.get('match') if match_cache is not None else None
+            if results is None:
+                edges = load_tiger()['edges'][['TLID', 'geometry']].set_index('TLID')
+                single, multi, geom_list = match_tlid.tables_to_dicts(addresses.copy(), edges, xwalk,
+                                                                      sort_curve=sort_curve)
+                sides = block_sides.county_block_sides(county_code, edges=tiger['edges'], faces=tiger['faces'],
+                                                       use_cache=cache is not None)
+                box_index = edge_store.load_box_index(county_code) if cache is not None else None
+                results = match_tlid.match_dicts(single, multi, geom_list, coords=coords, sides=sides,
+                                                 box_index=box_index)
+                if match_cache is not None:
+                    match_cache.put('match', results)
+            if write_intermediate:
+                match_tlid.write_results(results, county_code=county_code, sample=sample)
+        tables['results'] = results
+        if design is not None:
+            tables['match_estimates'] = design.match_estimates(results)
+
+        with instrument.stage('permute'):
+            if dem_data is None:
+                dem_data = synthetic_dem_data(addresses, var_list=var_list)
+            matched = join_matches(addresses, results, dem_data)
+            tables['matched'] = matched
+            tables['analytic_p_vals'] = permute_tlids.find_global_p_val_analytic(matched, var_list=var_list)
+            if design is not None:
+                tables['analytic_p_val_errors'] = design.replicate(
+                    lambda data: permute_tlids.find_global_p_val_analytic(data, var_list=var_list), matched,
+                    estimate=tables['analytic_p_vals'])
+            if monte_carlo:
+                tables['p_vals'] = permute_tlids.find_global_p_val(matched, iterations=iterations, var_list=var_list)
+                if design is not None:
+                    tables['p_val_errors'] = design.replicate(
+                        lambda data: permute_tlids.find_global_p_val(data, iterations=iterations, var_list=var_list),
+                        matched, estimate=tables['p_vals'])
+    return tables
+
+
+def run_counties(county_codes, **kwargs):
+    """
+    Runs the pipeline for several counties, reading each county's inputs while
+    the previous county is being processed (see prefetch.py)
+
+    Parameters
+    ----------
+    county_codes: list
+            fips codes for counties
+    kwargs:
+            passed to run_pipeline
+
+    Returns
+    -------
+    tables: dict
+            county code to the tables returned by run_pipeline
+    """
+    def load_county(county_code):
+        # Read while another county's run is active, so buffered and replayed into the county's own run
+        with instrument.buffer('load_county', county_code=county_code) as metrics:
+            inputs = tiger_xwalk.load_county(county_code)
+        return inputs, metrics
+
+    tables = {}
+    for county_code, (inputs, metrics) in prefetch.prefetch_counties(load_county, county_codes):
+        tables[county_code] = run_pipeline(county_code=county_code, inputs=inputs, input_metrics=metrics, **kwargs)
+    return tables
+
+
+if __name__ == "__main__":
+    instrument.configure_logging()
+    run_pipeline(county_code='08031')
@@ -0,0 +1,72 @@
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+This script contains helpers to overlap reading input files with other work.
+
+run_concurrently reads and parses independent inputs (such as the edges, faces and
+address files of a county) on separate threads, so that one file is read while
+another is being parsed. prefetch_counties loads the next county's inputs on a
+background thread while the current county is being processed, so that for
+multi-county runs, reading is hidden behind matching.
+
+Both use threads: pandas' CSV parser and file reads release the GIL for much of
+their work, and the loaded tables are shared without copying. Functions run in a
+copy of the caller's context, so that their stages go to the caller's
+instrumentation buffer, if any (see instrument.buffer).
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def run_concurrently(*funcs):
+    """
+    Calls functions on separate threads, and waits for all of them
+
+    Parameters
+    ----------
+    funcs: functions
+            called without arguments
+
+    Returns
+    -------
+    results: list
+            the return value of each function, in order. If any function raises
+            an exception, it is raised here once all of them have finished.
+    """
+    if len(funcs) == 1:
+        return [funcs[0]()]
+    with ThreadPoolExecutor(max_workers=len(funcs)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, func) for func in funcs]
+    return [future.result() for future in futures]
+
+
+def prefetch_counties(loader, county_codes, ahead=1):
+    """
+    Loads the inputs of a sequence of counties, each while the previous ones are
+    being processed
+
+    Parameters
+    ----------
+    loader: function
+            takes a county code, and returns its inputs
+    county_codes: list
+            fips codes of the counties, in processing order
+    ahead: int
+            number of counties to load ahead of the one being processed
+
+    Yields
+    ------
+    county_code, inputs: str, object
+            each county's code and the return value of loader
+    """
+    county_codes = list(county_codes)
+    with ThreadPoolExecutor(max_workers=max(ahead, 1)) as executor:
+        futures = {}
+        for i, county_code in enumerate(county_codes):
+            for next_code in county_codes[i:i + ahead + 1]:
+                if next_code not in futures:
+                    logger.debug("Prefetching county %s", next_code)
+                    futures[next_code] = executor.submit(contextvars.copy_context().run, loader, next_code)
+            yield county_code, futures.pop(county_code).result()
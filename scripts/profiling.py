@@ -0,0 +1,260 @@
+import os
+import sys
+import time
+import logging
+import importlib
+import functools
+import threading
+import contextlib
+from collections import Counter
+import pandas as pd
+import instrument
+
+"""
+This script contains an opt-in profiling mode for the matching workflow
+(tiger_xwalk.process_county, match_tlid.match_county_tlid and
+match_tlid_geo.run_distance_calc, each of which takes a profile flag).
+
+While profiling is on, the hot functions listed in HOT_FUNCTIONS (CSV parsing,
+WKT parsing, name matching, the vertex loop in find_closest, pandas merges, etc.)
+are replaced by timed wrappers, and a background thread samples the Python stack.
+When profiling ends, the original functions are restored, so that the workflow
+pays nothing for profiling when it is off. Three files are written:
+
+* [[name]]_functions.csv: calls, cumulative and own seconds for each hot function
+* [[name]]_timed.collapsed: own time (microseconds) of each nested chain of hot
+  functions
+* [[name]]_sampled.collapsed: counts of sampled Python stacks
+
+The .collapsed files are in the folded stack format read by flamegraph.pl and
+speedscope.
+"""
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = "../results/profiles/"
+
+# (module, attribute) pairs that are timed while profiling. Attributes may be
+# dotted to reach methods, and a module's own reference to an imported function
+# (such as match_tlid_utils.loads) must be listed separately from its source.
+HOT_FUNCTIONS = [('pandas', 'read_csv'),
+                 ('pandas', 'merge'),
+                 ('pandas', 'DataFrame.merge'),
+                 ('pandas', 'DataFrame.apply'),
+                 ('pandas', 'DataFrame.to_csv'),
+                 ('pandas', 'DataFrame.to_dict'),
+                 ('shapely.wkt', 'loads'),
+                 ('difflib', 'get_close_matches'),
+                 ('tiger_xwalk', 'load_tiger_csv'),
+                 ('tiger_xwalk', 'create_edge_face'),
+                 ('tiger_xwalk', 'create_names_blocks'),
+                 ('tiger_xwalk', 'make_names_table'),
+                 ('tiger_xwalk', 'match_names'),
+                 ('tiger_xwalk', 'match_adjacent_names'),
+                 ('tiger_xwalk', 'name_tlid_table'),
+                 ('tiger_xwalk', 'find_possible_tlid'),
+                 ('block_sides', 'create_block_sides'),
+                 ('match_tlid_utils', 'loads'),
+                 ('match_tlid_utils', 'import_data'),
+                 ('match_tlid_utils', 'import_xwalk'),
+                 ('match_tlid_utils', 'merge_xwalk_addresses'),
+                 ('match_tlid_utils', 'get_single_TLID_addresses'),
+                 ('match_tlid_utils', 'get_multi_TLID_addresses'),
+                 ('match_tlid_utils', 'get_candidate_geoms'),
+                 ('match_tlid_utils', 'find_edge_geo'),
+                 ('match_tlid_utils', 'candidate_sides'),
+                 ('match_tlid_utils', 'candidate_bounds'),
+                 ('match_tlid_utils', 'parse_vertices'),
+                 ('match_tlid_utils', 'find_closest'),
+                 ('match_tlid', 'match_generator'),
+                 ('match_tlid_geo', 'import_data'),
+                 ('match_tlid_geo', 'merge_xwalk_addresses'),
+                 ('match_tlid_geo', 'simplify_road'),
+                 ('match_tlid_geo', 'find_midpoints'),
+                 ('match_tlid_geo', 'min_dist_geo')]
+
+
+class FunctionTimer(object):
+    """
+    Records calls, cumulative time and own time (excluding other timed functions)
+    for each wrapped function, along with the own time of each chain of nested
+    timed functions. Functions called on several threads at once (see
+    prefetch.py) are nested separately on each thread.
+    """
+    def __init__(self):
+        self.calls = Counter()
+        self.cumulative = Counter()
+        self.own = Counter()
+        self.stacks = Counter()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @property
+    def stack(self):
+        """
+        Timed calls in progress on the current thread, as [name, time spent in
+        timed children]
+        """
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = self.stack
+            stack.append([name, 0.0])
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t0
+                child_time = stack.pop()[1]
+                own = elapsed - child_time
+                if stack:
+                    stack[-1][1] += elapsed
+                with self.lock:
+                    self.calls[name] += 1
+                    self.own[name] += own
+                    # Only count the outermost call of recursive functions
+                    if all(entry[0] != name for entry in stack):
+                        self.cumulative[name] += elapsed
+                    self.stacks[';'.join([entry[0] for entry in stack] + [name])] += own
+        return wrapper
+
+    def summary(self):
+        """
+        Returns
+        -------
+        summary: pd DataFrame
+                calls, cumulative and own seconds per function, sorted by
+                cumulative time
+        """
+        summary = pd.DataFrame({'calls': pd.Series(self.calls),
+                                'cumulative_seconds': pd.Series(self.cumulative),
+                                'own_seconds': pd.Series(self.own)})
+        summary.index.name = 'function'
+        return summary.fillna(0).sort_values('cumulative_seconds', ascending=False)
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stacks of every thread at a fixed interval, counting each
+    distinct stack of (module.function) frames. Stacks start with the name of
+    their thread, so that work moved onto loader threads (see prefetch.py)
+    is kept apart from the main thread's.
+    """
+    def __init__(self, interval=0.005):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+                    # Leave out the timed wrappers themselves
+                    if not (module == 'profiling' and code.co_name == 'wrapper'):
+                        stack.append(module + '.' + code.co_name)
+                    frame = frame.f_back
+                if stack:
+                    stack.append(names.get(thread_id, 'thread-' + str(thread_id)))
+                    self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def resolve(module_name, attr):
+    """
+    Finds the object owning an attribute in HOT_FUNCTIONS, or None if its
+    module cannot be imported
+    """
+    try:
+        owner = importlib.import_module(module_name)
+    except ImportError:
+        return None, None
+    parts = attr.split('.')
+    for part in parts[:-1]:
+        owner = getattr(owner, part)
+    return owner, parts[-1]
+
+
+def write_collapsed(stacks, path, scale=1):
+    """
+    Writes stack counts in the folded format read by flamegraph.pl
+    """
+    with open(path, 'w') as f:
+        for stack, weight in sorted(stacks.items()):
+            weight = int(round(weight * scale))
+            if weight > 0:
+                f.write(stack + ' ' + str(weight) + '\n')
+
+
+@contextlib.contextmanager
+def profile(name, enabled=True, sample_interval=0.005, out_dir=PROFILE_DIR):
+    """
+    Profiles the enclosed code by timing the functions in HOT_FUNCTIONS and
+    sampling the stack, then writes the results to out_dir. Does nothing if
+    enabled is false.
+
+    Parameters
+    ----------
+    name: str
+            prefix of the output files, e.g. match_county_tlid_08031
+    enabled: bool
+            if false, the enclosed code runs without any profiling
+    sample_interval: float
+            seconds between stack samples, or None to only time hot functions
+    out_dir: str
+            directory for output files
+
+    Yields
+    ------
+    timer: FunctionTimer
+            or None if profiling is not enabled
+    """
+    if not enabled:
+        yield None
+        return
+
+    timer = FunctionTimer()
+    originals = []
+    for module_name, attr in HOT_FUNCTIONS:
+        owner, attr_name = resolve(module_name, attr)
+        if owner is None or not hasattr(owner, attr_name):
+            continue
+        original = getattr(owner, attr_name)
+        originals.append((owner, attr_name, original))
+        setattr(owner, attr_name, timer.wrap(module_name + '.' + attr, original))
+
+    sampler = None
+    if sample_interval is not None:
+        sampler = StackSampler(interval=sample_interval)
+        sampler.start()
+
+    try:
+        yield timer
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        for owner, attr_name, original in reversed(originals):
+            setattr(owner, attr_name, original)
+
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        summary = timer.summary()
+        summary.to_csv(out_dir + name + '_functions.csv')
+        write_collapsed(timer.stacks, out_dir + name + '_timed.collapsed', scale=1e6)
+        if sampler is not None:
+            write_collapsed(sampler.samples, out_dir + name + '_sampled.collapsed')
+        instrument.set_value('profile', out_dir + name)
+        logger.info("Profile written to %s*, top functions:\n%s", out_dir + name, summary.head(10))
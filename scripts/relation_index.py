@@ -0,0 +1,298 @@
+import os
+import json
+import shutil
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import instrument
+import stage_cache
+import name_dictionary
+
+"""
+This script builds a binary index of the relationships between blocks, faces and
+edges of a county, so that the edge-face and block tables do not have to be
+rebuilt from the TIGER CSVs on every run.
+
+The index maps BLKID -> faces -> edge sides as integer arrays with offsets:
+
+    blkids          sorted block ids
+    block_offsets   faces of block i are rows block_offsets[i]:block_offsets[i + 1]
+    face_tfids      TFID of each face
+    face_offsets    edge sides of face j are rows face_offsets[j]:face_offsets[j + 1]
+    tlids, sides, name_ids, roads
+                    TLID, side (0 = left, 1 = right), street name ID (see
+                    name_dictionary.py) and road flag of each edge side
+    edge_face_rows  edge side rows in the order of tiger_xwalk.create_edge_face
+
+Each array is saved as a .npy file in
+"../results/relation_index/[[vintage]]/[[county_code]]/", and loaded with memory
+mapping, so that opening an index only reads the pages that are used. The index
+is built once per county and TIGER vintage, and rebuilt if the edges or faces
+files change. Street names are stored as IDs of the state's persisted name
+dictionary, which only ever appends names, so the IDs stay valid. The index also
+records a hash of the names it may refer to, and is rebuilt if the dictionary
+it is opened with has different IDs for them.
+
+Example:
+    python relation_index.py --county-code 08031
+builds the index for Denver County
+"""
+
+logger = logging.getLogger(__name__)
+
+INDEX_DIR = "../results/relation_index/"
+
+VINTAGE = '2010'
+
+ARRAYS = ['blkids', 'block_offsets', 'face_tfids', 'face_offsets',
+          'tlids', 'sides', 'name_ids', 'roads', 'edge_face_rows']
+
+
+def index_dir(county_code='08031', vintage=VINTAGE):
+    return INDEX_DIR + vintage + '/' + county_code + '/'
+
+
+def tfid_ints(values):
+    """
+    Converts TFIDs (as read from the CSVs, possibly empty) to integers, with -1
+    for missing values
+    """
+    return pd.to_numeric(pd.Series(values), errors='coerce').fillna(-1).astype(np.int64).values
+
+
+def build_relation_index(edges, faces, name_dict):
+    """
+    Builds the relationship arrays of a county
+
+    Parameters
+    ----------
+    edges: pd DataFrame
+            edge data from TIGER files, with TLID, TFIDL, TFIDR, FULLNAME and ROADFLG
+    faces: pd DataFrame
+            face data from TIGER files, with TFID and concatinated block id
+    name_dict: name_dictionary.NameDictionary
+            dictionary used to convert street names to IDs. New names are added.
+
+    Returns
+    -------
+    arrays: dict
+            the arrays listed in ARRAYS
+    """
+    faces = faces[['TFID', 'BLKID']].drop_duplicates()
+    face_tfids = tfid_ints(faces['TFID'])
+    face_blkids = faces['BLKID'].astype(str).values
+
+    # Faces sorted by block, then TFID
+    blkids, face_block = np.unique(face_blkids, return_inverse=True)
+    face_order = np.lexsort((face_tfids, face_block))
+    face_tfids, face_block = face_tfids[face_order], face_block[face_order]
+    block_offsets = np.searchsorted(face_block, np.arange(blkids.shape[0] + 1))
+
+    # Edge sides in create_edge_face order: every right side, then every left side
+    n = edges.shape[0]
+    tlids = np.concatenate([edges['TLID'].values, edges['TLID'].values]).astype(np.int64)
+    side_tfids = np.concatenate([tfid_ints(edges['TFIDR']), tfid_ints(edges['TFIDL'])])
+    sides = np.repeat(np.array([1, 0], dtype=np.int8), n)
+    name_ids = np.tile(name_dict.encode(edges['FULLNAME'].values), 2)
+    roads = np.tile((edges['ROADFLG'] == 'Y').values, 2)
+
+    # Group the edge sides by face, dropping sides without a face (outside the county)
+    face_of = pd.Index(face_tfids).get_indexer(side_tfids)
+    kept = np.flatnonzero(face_of >= 0)
+    order = kept[np.argsort(face_of[kept], kind='stable')]
+    face_offsets = np.searchsorted(face_of[order], np.arange(face_tfids.shape[0] + 1))
+    # Position in the face-sorted arrays of each edge side, in create_edge_face order
+    edge_face_rows = np.empty(n * 2, dtype=np.int64)
+    edge_face_rows[order] = np.arange(order.shape[0])
+    edge_face_rows = edge_face_rows[kept]
+
+    return {'blkids': blkids.astype(bytes),
+            'block_offsets': block_offsets.astype(np.int64),
+            'face_tfids': face_tfids,
+            'face_offsets': face_offsets.astype(np.int64),
+            'tlids': tlids[order],
+            'sides': sides[order],
+            'name_ids': name_ids[order],
+            'roads': roads[order],
+            'edge_face_rows': edge_face_rows}
+
+
+class RelationIndex(object):
+    """
+    Block, face and edge side relationships of a county, from memory-mapped arrays
+
+    Parameters
+    ----------
+    arrays: dict
+            the arrays listed in ARRAYS
+    name_dict: name_dictionary.NameDictionary
+            dictionary the name IDs refer to
+    """
+    def __init__(self, arrays, name_dict):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.name_dict = name_dict
+
+    def face_rows(self, blkid):
+        """
+        Range of face rows of a block, empty for unknown blocks
+        """
+        key = str(blkid).encode()
+        i = np.searchsorted(self.blkids, key)
+        if i >= self.blkids.shape[0] or self.blkids[i] != key:
+            return 0, 0
+        return self.block_offsets[i], self.block_offsets[i + 1]
+
+    def lookup(self, blkid, roads_only=True):
+        """
+        Edge sides of a block
+
+        Parameters
+        ----------
+        blkid: str
+                15 digit block identifier
+        roads_only: bool
+                only includes roads if true
+
+        Returns
+        -------
+        sides: pd DataFrame
+                TFID, SIDE, NAME_ID and TLID of every edge side along the block
+        """
+        start, end = self.face_rows(blkid)
+        counts = np.diff(self.face_offsets[start:end + 1]) if end > start else np.zeros(0, dtype=np.int64)
+        rows = slice(self.face_offsets[start], self.face_offsets[end])
+        sides = pd.DataFrame({'TFID': np.repeat(self.face_tfids[start:end], counts),
+                              'SIDE': self.sides[rows], 'NAME_ID': self.name_ids[rows], 'TLID': self.tlids[rows]})
+        if roads_only:
+            sides = sides[self.roads[rows]].reset_index(drop=True)
+        return sides
+
+    def faces(self):
+        """
+        Face table, with TFID (as a string, as in the TIGER CSVs) and BLKID
+        """
+        counts = np.diff(self.block_offsets)
+        return pd.DataFrame({'TFID': self.face_tfids.astype(str),
+                             'BLKID': np.repeat(self.blkids, counts).astype(str)})
+
+    def edge_face(self, roads_only=True):
+        """
+        Edge-face table, with the rows of tiger_xwalk.create_edge_face in the same
+        order, except for edge sides without a face
+
+        Returns
+        -------
+        edge_face: pd DataFrame
+                TLID, TFID (as a string), FULLNAME, SIDE and NAME_ID
+        """
+        face_of = np.repeat(np.arange(self.face_tfids.shape[0]), np.diff(self.face_offsets))
+        rows = np.asarray(self.edge_face_rows)
+        if roads_only:
+            rows = rows[self.roads[rows]]
+        name_ids = self.name_ids[rows]
+        return pd.DataFrame({'TLID': self.tlids[rows], 'TFID': self.face_tfids[face_of[rows]].astype(str),
+                             'FULLNAME': self.name_dict.decode(name_ids), 'SIDE': self.sides[rows],
+                             'NAME_ID': name_ids})
+
+
+def save_relation_index(arrays, path, meta):
+    """
+    Saves the arrays of an index, replacing any previous index at path
+    """
+    tmp_path = path.rstrip('/') + '.tmp/'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name in ARRAYS:
+        np.save(tmp_path + name + '.npy', arrays[name])
+    with open(tmp_path + 'meta.json', 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+def read_meta(path):
+    if not os.path.exists(path + 'meta.json'):
+        return None
+    with open(path + 'meta.json') as f:
+        return json.load(f)
+
+
+def build_county_relations(county_code='08031', vintage=VINTAGE, name_dict=None):
+    """
+    Builds and saves the relationship index of a county from its TIGER CSVs,
+    reading only the columns it needs
+    """
+    cache = stage_cache.StageCache(county_code)
+    save_dict = name_dict is None
+    if save_dict:
+        name_dict = name_dictionary.load_names(county_code)
+    with instrument.stage('build_relations') as record:
+        edges = pd.read_csv(cache.files['edges'], usecols=['TLID', 'TFIDL', 'TFIDR', 'FULLNAME', 'ROADFLG'],
+                            converters={'TFIDL': lambda x: x.split('.')[0], 'TFIDR': lambda x: x.split('.')[0]})
+        faces = pd.read_csv(cache.files['faces'], usecols=['STATEFP10', 'COUNTYFP10', 'TRACTCE10', 'BLOCKCE10', 'TFID'],
+                            converters={'STATEFP10': lambda x: str(x), 'COUNTYFP10': lambda x: str(x),
+                                        'TRACTCE10': lambda x: str(x), 'BLOCKCE10': lambda x: str(x),
+                                        'TFID': lambda x: str(x)})
+        faces['BLKID'] = faces['STATEFP10'] + faces['COUNTYFP10'] + faces['TRACTCE10'] + faces['BLOCKCE10']
+        arrays = build_relation_index(edges, faces, name_dict)
+        record['blocks'], record['edge_sides'] = arrays['blkids'].shape[0], arrays['tlids'].shape[0]
+    meta = {'key': cache.key('relations'), 'vintage': vintage, 'names': len(name_dict),
+            'names_digest': name_dict.digest()}
+    save_relation_index(arrays, index_dir(county_code, vintage), meta)
+    if save_dict:
+        name_dictionary.save_names(name_dict, county_code)
+    logger.info("Built relationship index: %d blocks, %d edge sides",
+                arrays['blkids'].shape[0], arrays['tlids'].shape[0])
+    return RelationIndex(arrays, name_dict)
+
+
+def load_county_relations(county_code='08031', vintage=VINTAGE, name_dict=None, mmap=True):
+    """
+    Opens the relationship index of a county, building it first if it does not
+    exist or if the edges or faces files have changed since it was built
+
+    Parameters
+    ----------
+    county_code: str
+            fips code for county
+    vintage: str
+            TIGER vintage of the county's files
+    name_dict: name_dictionary.NameDictionary
+            the state's name dictionary, loaded if None
+    mmap: bool
+            if true, the arrays are memory-mapped instead of read into memory
+
+    Returns
+    -------
+    relations: RelationIndex
+    """
+    if name_dict is None:
+        name_dict = name_dictionary.load_names(county_code)
+    path = index_dir(county_code, vintage)
+    meta = read_meta(path)
+    key = stage_cache.StageCache(county_code).key('relations')
+    # The name IDs are only valid if the dictionary still has every name the index
+    # used, with the same IDs
+    if (meta is None or meta['key'] != key or len(name_dict) < meta['names']
+            or meta.get('names_digest') != name_dict.digest(meta['names'])):
+        logger.info("Relationship index missing or out of date, building it")
+        instrument.count('relations_built')
+        return build_county_relations(county_code, vintage=vintage, name_dict=name_dict)
+    arrays = {name: np.load(path + name + '.npy', mmap_mode='r' if mmap else None) for name in ARRAYS}
+    instrument.count('relations_loaded')
+    return RelationIndex(arrays, name_dict)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the block-face-edge relationship index of counties")
+    parser.add_argument('--county-code', nargs='+', default=['08031'])
+    parser.add_argument('--vintage', default=VINTAGE)
+    args = parser.parse_args()
+    instrument.configure_logging()
+    for county_code in args.county_code:
+        with instrument.run('relation_index', county_code=county_code):
+            build_county_relations(county_code, vintage=args.vintage)
@@ -0,0 +1,205 @@
+import os
+import json
+import shutil
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import instrument
+
+"""
+This script stores TLID match results as typed arrays sorted by MAFID, so that
+matches can be looked up and joined without reading and parsing the whole
+results CSV.
+
+A store is a directory holding MAFIDs (int64, sorted), their TLID matches
+(int64, -1 for none) and optionally the distance to the matched line (float64,
+nan if unknown), each as a .npy file that is memory-mapped when the store is
+opened. A single match is found with a binary search, and a table of households
+is joined to its matches with one vectorized search over all of its MAFIDs, so
+only the pages holding the requested MAFIDs are read.
+
+match_county_tlid saves a store for each county next to the results CSV, in
+"../results/address_tlid_xwalk/[[county_code]]_tlid_match/".
+
+Example:
+    python results_store.py --county-code 08031 --mafid 12 345
+prints the matches of two addresses
+"""
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DIR = "../results/address_tlid_xwalk/"
+
+def store_path(county_code='08031', sample=False):
+    return RESULTS_DIR + county_code + ("samp" if sample else "") + "_tlid_match/"
+
+
+def int_ids(values, name):
+    """
+    Converts ids (as strings or numbers) to an int64 array, with -1 for missing
+    values, raising a ValueError for ids that are not integers
+    """
+    values = pd.Series(list(values), dtype=object)
+    ids = pd.to_numeric(values, errors='coerce')
+    if (ids.isnull() & values.notnull()).any():
+        raise ValueError(name + " values must be integers to be stored")
+    return ids.fillna(-1).astype(np.int64).values
+
+
+def write_store(results, path, dists=None):
+    """
+    Saves match results as a store, replacing any previous store at path
+
+    Parameters
+    ----------
+    results: dict
+            synthetic MAFID as keys and TLID match as values
+    path: str
+            directory of the store
+    dists: dict or pd Series
+            distance to the matched line by MAFID, such as the DIST column of
+            match_tlid.margins_table
+    """
+    with instrument.stage('write_store') as record:
+        mafids = int_ids(results.keys(), 'MAFID')
+        tlids = int_ids(results.values(), 'TLID')
+        order = np.argsort(mafids, kind='stable')
+        arrays = {'mafids': mafids[order], 'tlids': tlids[order]}
+        if np.any(arrays['mafids'][1:] == arrays['mafids'][:-1]):
+            raise ValueError("MAFIDs must be unique")
+        if dists is not None:
+            dists = pd.Series(dists, dtype=float)
+            dists.index = int_ids(dists.index, 'MAFID')
+            arrays['dists'] = dists.reindex(arrays['mafids']).values
+
+        tmp_path = path.rstrip('/') + '.tmp/'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name, values in arrays.items():
+            np.save(tmp_path + name + '.npy', values)
+        with open(tmp_path + 'meta.json', 'w') as f:
+            json.dump({'rows': int(mafids.shape[0]), 'arrays': list(arrays)}, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+        record['rows'] = int(mafids.shape[0])
+
+
+class ResultsStore(object):
+    """
+    MAFID-sorted match results, opened from a store directory
+
+    Parameters
+    ----------
+    path: str
+            directory of the store
+    mmap: bool
+            if true, the arrays are memory-mapped instead of read into memory
+    """
+    def __init__(self, path, mmap=True):
+        with open(path + 'meta.json') as f:
+            meta = json.load(f)
+        mode = 'r' if mmap else None
+        self.mafids = np.load(path + 'mafids.npy', mmap_mode=mode)
+        self.tlids = np.load(path + 'tlids.npy', mmap_mode=mode)
+        self.dists = np.load(path + 'dists.npy', mmap_mode=mode) if 'dists' in meta['arrays'] else None
+
+    def __len__(self):
+        return self.mafids.shape[0]
+
+    def find(self, mafids):
+        """
+        Positions of MAFIDs in the store
+
+        Parameters
+        ----------
+        mafids: array-like
+                integer MAFIDs
+
+        Returns
+        -------
+        rows: np array
+                position of each MAFID in the store's arrays
+        found: np array
+                boolean, false for MAFIDs that are not in the store
+        """
+        mafids = np.asarray(mafids, dtype=np.int64)
+        if len(self) == 0:
+            return np.zeros(mafids.shape[0], dtype=np.int64), np.zeros(mafids.shape[0], dtype=bool)
+        rows = np.minimum(np.searchsorted(self.mafids, mafids), len(self) - 1)
+        return rows, self.mafids[rows] == mafids
+
+    def lookup(self, mafid):
+        """
+        TLID match of one MAFID, or None if it has none
+        """
+        rows, found = self.find([int(mafid)])
+        if not found[0] or self.tlids[rows[0]] < 0:
+            return None
+        return int(self.tlids[rows[0]])
+
+    def join(self, data, on='MAFID', how='inner'):
+        """
+        Adds the matches of a table of households
+
+        Parameters
+        ----------
+        data: pd DataFrame
+                with integer MAFIDs in column on
+        on: str
+                name of the MAFID column
+        how: str
+                'inner' keeps only households with a match, 'left' keeps every
+                household, with nan for those without one
+
+        Returns
+        -------
+        joined: pd DataFrame
+                a copy of data, in its order, with TLID_match (and DIST if the
+                store has distances)
+        """
+        rows, found = self.find(int_ids(data[on].values, on))
+        if len(self):
+            found &= self.tlids[rows] >= 0
+        if how == 'inner':
+            joined = data.loc[found].copy()
+            rows = rows[found]
+            joined['TLID_match'] = np.asarray(self.tlids[rows])
+            if self.dists is not None:
+                joined['DIST'] = np.asarray(self.dists[rows])
+        elif how == 'left':
+            joined = data.copy()
+            tlids = self.tlids[rows] if len(self) else rows
+            joined['TLID_match'] = pd.Series(tlids, index=data.index, dtype='Int64').mask(~found)
+            if self.dists is not None:
+                joined['DIST'] = np.where(found, self.dists[rows] if len(self) else np.nan, np.nan)
+        else:
+            raise ValueError("how must be 'inner' or 'left'")
+        instrument.count('store_joined', int(found.sum()))
+        return joined
+
+    def to_dict(self):
+        """
+        All results, as returned by match_tlid.match_county_tlid (with integer ids)
+        """
+        present = np.asarray(self.tlids) >= 0
+        return dict(zip(np.asarray(self.mafids)[present].tolist(), np.asarray(self.tlids)[present].tolist()))
+
+
+def load_store(county_code='08031', sample=False, mmap=True):
+    """
+    Opens the results store saved by match_county_tlid for a county
+    """
+    return ResultsStore(store_path(county_code, sample=sample), mmap=mmap)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Look up TLID matches by MAFID")
+    parser.add_argument('--county-code', default='08031')
+    parser.add_argument('--mafid', nargs='+', type=int, required=True)
+    args = parser.parse_args()
+    store = load_store(args.county_code)
+    for mafid in args.mafid:
+        print(mafid, store.lookup(mafid))
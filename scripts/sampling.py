@@ -0,0 +1,397 @@
+import os
+import math
+import logging
+import numpy as np
+import pandas as pd
+import instrument
+
+"""
+This script draws seeded, stratified samples of a county's addresses for quick
+runs, and estimates county-wide quantities, with standard errors, from them.
+
+Addresses are stratified by their number of candidate TLIDs in the crosswalk
+(none, one, two, three or four, five or more), since that is what matching time
+and match quality depend on. Within a candidate stratum, addresses are ordered
+by block and drawn systematically from a random start, so every block gets its
+share of the sample (implicit stratification by block). Each candidate stratum
+gets at least MIN_STRATUM_SAMPLE addresses, so rare multi-candidate strata are
+not left out of small samples; weights (stratum size over sample size) correct
+for this in the estimates. The same seed always draws the same sample.
+
+Instead of a fraction, a sample can be given a runtime budget (in seconds): the
+fraction is then the largest one whose estimated matching time (SECONDS_PER_ADDRESS and
+SECONDS_PER_CANDIDATE) fits in the budget.
+
+Estimates from a sample come with design-based standard errors: stratified
+variances for shares and means (SampleDesign.estimate_mean), and random groups
+for other statistics, such as p-values (SampleDesign.replicate). The sampled
+blocks are dealt at random into REPLICATES groups, keeping the sampled
+addresses of a block together so that block-level tests can be run on each
+group, and the spread of the statistic over the groups gives its standard
+error.
+"""
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_FRACTION = .1
+
+DEFAULT_SEED = 0
+
+# Lower bounds of the candidate count strata
+CANDIDATE_STRATA = [0, 1, 2, 3, 5]
+STRATUM_NAMES = ['none', 'single', '2', '3-4', '5+']
+
+MIN_STRATUM_SAMPLE = 30
+
+REPLICATES = 10
+
+# Rough matching time of match_tlid.match_dicts, per address and per candidate
+# distance of multi-candidate addresses
+SECONDS_PER_ADDRESS = 1e-6
+SECONDS_PER_CANDIDATE = 2e-5
+
+# Designs of the samples drawn in this process, by (county_code, fraction, seed, budget)
+DESIGNS = {}
+
+
+def sample_fraction(sample, budget=None):
+    """
+    Fraction of addresses requested by the sample argument of the import
+    functions: SAMPLE_FRACTION for True, the value itself for a number, and
+    None (no sampling) for False
+    """
+    if sample is False or sample is None:
+        return None
+    if sample is True:
+        return SAMPLE_FRACTION
+    if not 0 < sample <= 1:
+        raise ValueError("sample fraction must be in (0, 1]")
+    return float(sample)
+
+
+def stratum_codes(candidates):
+    """
+    Positions in STRATUM_NAMES of the strata of candidate counts
+    """
+    strata = np.searchsorted(CANDIDATE_STRATA, np.asarray(candidates, dtype=np.int64), side='right') - 1
+    return np.maximum(strata, 0)
+
+
+def candidate_strata(candidates):
+    """
+    Stratum names of candidate counts
+    """
+    return np.asarray(STRATUM_NAMES)[stratum_codes(candidates)]
+
+
+def candidate_counts(addresses, xwalk):
+    """
+    Number of candidate TLIDs of each address, 0 for addresses not in the crosswalk
+
+    Parameters
+    ----------
+    addresses: pd DataFrame
+            of address points, with MAF_NAME and BLKID
+    xwalk: pd DataFrame
+            crosswalk with MAF_NAME, BLKID and OPTIONS
+
+    Returns
+    -------
+    candidates: np array
+            in the order of addresses
+    """
+    options = xwalk[['MAF_NAME', 'BLKID', 'OPTIONS']].astype({'MAF_NAME': str, 'BLKID': str})
+    options = options.drop_duplicates(['MAF_NAME', 'BLKID']).set_index(['MAF_NAME', 'BLKID'])['OPTIONS']
+    keys = pd.MultiIndex.from_arrays([addresses['MAF_NAME'].astype(str).values,
+                                      addresses['BLKID'].astype(str).values])
+    return options.reindex(keys).fillna(0).astype(np.int64).values
+
+
+def county_candidate_counts(addresses, county_code='08031'):
+    """
+    candidate_counts from the crosswalk saved by tiger_xwalk.py, or zeros (a
+    single stratum) if the county has no crosswalk yet
+    """
+    path = "../results/possible_tlids/" + county_code + "_address_maf_xwalk.csv"
+    if not os.path.exists(path):
+        logger.warning("No crosswalk for %s, sampling is only stratified by block", county_code)
+        return np.zeros(addresses.shape[0], dtype=np.int64)
+    xwalk = pd.read_csv(path, usecols=['MAF_NAME', 'BLKID', 'OPTIONS'], converters={'BLKID': lambda x: str(x)})
+    return candidate_counts(addresses, xwalk)
+
+
+def match_seconds(candidates):
+    """
+    Estimated matching time of addresses with the given candidate counts
+    """
+    candidates = np.asarray(candidates)
+    return SECONDS_PER_ADDRESS + SECONDS_PER_CANDIDATE * np.where(candidates > 1, candidates, 0)
+
+
+def allocate(population, fraction, min_stratum=MIN_STRATUM_SAMPLE):
+    """
+    Sample size of each stratum: fraction of its size, but at least min_stratum
+    (or the whole stratum, if smaller)
+    """
+    sizes = np.maximum(np.round(population * fraction), np.minimum(min_stratum, population))
+    return np.minimum(sizes, population).astype(np.int64)
+
+
+def budget_fraction(population, costs, budget, min_stratum=MIN_STRATUM_SAMPLE):
+    """
+    Largest sampling fraction whose estimated matching time fits in the budget
+
+    Parameters
+    ----------
+    population: np array
+            number of addresses in each stratum
+    costs: np array
+            mean estimated matching seconds of an address in each stratum
+    budget: float
+            seconds
+
+    Returns
+    -------
+    fraction: float
+            at most 1. If even the minimum stratum samples do not fit, their
+            fraction is used and a warning is logged.
+    """
+    def seconds(fraction):
+        return float((allocate(population, fraction, min_stratum) * costs).sum())
+
+    if seconds(1) <= budget:
+        return 1.
+    low, high = 0., 1.
+    for _ in range(40):
+        mid = (low + high) / 2
+        low, high = (mid, high) if seconds(mid) <= budget else (low, mid)
+    if seconds(low) > budget:
+        logger.warning("Budget of %.1fs is below the minimum stratum samples (%.1fs)", budget, seconds(low))
+    return low
+
+
+class SampleDesign(object):
+    """
+    Strata, weights and random groups of a stratified sample
+
+    Parameters
+    ----------
+    strata: pd Series
+            stratum of each sampled address, indexed by MAFID
+    groups: pd Series
+            random group of each sampled address, indexed by MAFID
+    population: pd Series
+            number of addresses in each stratum of the county
+    fraction: float
+            requested sampling fraction
+    """
+    def __init__(self, strata, groups, population, fraction):
+        self.strata = strata
+        self.groups = groups
+        self.population = population
+        self.fraction = fraction
+        self.sizes = strata.value_counts().reindex(population.index, fill_value=0)
+        self.weights = (population / self.sizes.where(self.sizes > 0)).reindex(strata.values).set_axis(strata.index)
+
+    def __len__(self):
+        return self.strata.shape[0]
+
+    def estimate_mean(self, values):
+        """
+        County-wide mean of a variable of the sampled addresses, with its standard
+        error. Missing values are outside the variable's domain: the mean is over
+        the addresses where it is defined (a ratio estimate).
+
+        Parameters
+        ----------
+        values: pd Series
+                indexed by MAFID. Sampled addresses that are not in values are
+                missing.
+
+        Returns
+        -------
+        estimate, se: float
+        """
+        values = pd.Series(values, dtype=float).reindex(self.strata.index)
+        domain = values.notnull().astype(float)
+        weighted = (self.weights * domain).sum()
+        if weighted == 0:
+            return np.nan, np.nan
+        estimate = (self.weights * values.fillna(0)).sum() / weighted
+        # Linearized variance of the ratio, from the stratified variance of its residuals
+        residuals = domain * (values.fillna(0) - estimate)
+        variance = 0.
+        for stratum, group in residuals.groupby(self.strata.values):
+            n, size = self.sizes[stratum], self.population[stratum]
+            if n > 1:
+                variance += size ** 2 * (1 - n / size) * group.var(ddof=1) / n
+        return float(estimate), float(math.sqrt(variance) / weighted)
+
+    def estimate_total(self, values):
+        """
+        County-wide total of a variable, with its standard error
+        """
+        values = pd.Series(values, dtype=float).reindex(self.strata.index).fillna(0)
+        estimate, se = self.estimate_mean(values)
+        total = self.population.sum()
+        return estimate * total, se * total
+
+    def replicate(self, statistic, data, on='MAFID', estimate=None):
+        """
+        Computes a statistic on the whole sample and on each random group, and
+        estimates its standard error from the spread over the groups. The groups
+        are REPLICATES times smaller than the sample, so statistics that depend
+        on sample size (such as the power of a test) are not comparable across
+        sample sizes; the error reflects which addresses were drawn.
+
+        Parameters
+        ----------
+        statistic: function
+                takes a table like data, returns a dict of values (such as
+                permute_tlids.find_global_p_val_analytic)
+        data: pd DataFrame
+                table of sampled addresses, with MAFIDs in column on
+        estimate: dict
+                the statistic on the whole sample, if already computed
+
+        Returns
+        -------
+        estimates: pd DataFrame
+                'ESTIMATE' and 'SE' of each value of the statistic
+        """
+        groups = self.groups.reindex(data[on].values).values
+        full = statistic(data) if estimate is None else estimate
+        replicates = pd.DataFrame([statistic(data.loc[groups == group]) for group in np.unique(groups[~np.isnan(groups)])])
+        r = replicates.shape[0]
+        se = replicates.std(ddof=1) / math.sqrt(r) if r > 1 else pd.Series(np.nan, index=list(full))
+        return pd.DataFrame({'ESTIMATE': pd.Series(full), 'SE': se})
+
+    def match_estimates(self, results, margins=None):
+        """
+        County-wide match estimates from the matches of the sample
+
+        Parameters
+        ----------
+        results: dict
+                synthetic MAFID as keys and TLID match as values
+        margins: pd DataFrame
+                output of match_tlid.margins_table, if available
+
+        Returns
+        -------
+        estimates: pd DataFrame
+                'ESTIMATE' and 'SE' of the share and number of addresses with a
+                match, the share of matched addresses with several candidates
+                and, with margins, the mean distance to the match and the mean
+                margin of multi-candidate matches
+        """
+        matches = [mafid for mafid, tlid in results.items() if tlid is not None]
+        matched = pd.Series(self.strata.index.isin(matches), index=self.strata.index, dtype=float)
+        multi = pd.Series(~np.isin(self.strata.values, ['none', 'single']), index=self.strata.index, dtype=float)
+        rows = {'matched_share': self.estimate_mean(matched),
+                'matched_addresses': self.estimate_total(matched),
+                'multi_candidate_share': self.estimate_mean(multi.where(matched > 0))}
+        if margins is not None:
+            rows['mean_dist'] = self.estimate_mean(margins['DIST'])
+            rows['mean_margin'] = self.estimate_mean(margins['MARGIN'])
+        estimates = pd.DataFrame.from_dict(rows, orient='index', columns=['ESTIMATE', 'SE'])
+        logger.info("Estimates from a %d address sample:\n%s", len(self), estimates.to_string())
+        return estimates
+
+
+def stratified_sample(addresses, candidates=None, fraction=SAMPLE_FRACTION, seed=DEFAULT_SEED, budget=None,
+                      min_stratum=MIN_STRATUM_SAMPLE, replicates=REPLICATES):
+    """
+    Draws a stratified sample of addresses
+
+    Parameters
+    ----------
+    addresses: pd DataFrame
+            of address points, with MAFID and BLKID
+    candidates: array-like
+            number of candidate TLIDs of each address (see candidate_counts).
+            If None, addresses are only stratified by block.
+    fraction: float
+            share of each candidate stratum to draw
+    seed: int
+            random seed
+    budget: float
+            if given, seconds of estimated matching time, which sets the fraction
+    min_stratum: int
+            smallest sample of a candidate stratum
+    replicates: int
+            number of random groups
+
+    Returns
+    -------
+    sample: pd DataFrame
+            sampled rows of addresses, in their original order
+    design: SampleDesign
+    """
+    with instrument.stage('sample') as record:
+        candidates = np.zeros(addresses.shape[0], dtype=np.int64) if candidates is None else np.asarray(candidates)
+        codes = stratum_codes(candidates)
+        strata = np.asarray(STRATUM_NAMES)[codes]
+        population = pd.Series(strata).value_counts().reindex(STRATUM_NAMES).dropna().astype(np.int64)
+        if budget is not None:
+            costs = pd.Series(match_seconds(candidates)).groupby(strata).mean().reindex(population.index).values
+            fraction = budget_fraction(population.values, costs, budget, min_stratum)
+        sizes = pd.Series(allocate(population.values, fraction, min_stratum), index=population.index)
+
+        # Order by stratum (in the order of STRATUM_NAMES, like population), then block, then
+        # at random, and take evenly spaced rows of each stratum
+        rng = np.random.default_rng(seed)
+        order = np.lexsort((rng.random(addresses.shape[0]), addresses['BLKID'].astype(str).values, codes))
+        rows = []
+        start = 0
+        for stratum, size in population.items():
+            n = sizes[stratum]
+            step = size / n
+            positions = np.floor(rng.random() * step + step * np.arange(n)).astype(np.int64)
+            rows.append(order[start + positions])
+            start += size
+        rows = np.concatenate(rows)
+        # Random groups of whole blocks
+        blkids, block_of = np.unique(addresses['BLKID'].astype(str).values[rows], return_inverse=True)
+        groups = (rng.permutation(blkids.shape[0]) % replicates)[block_of]
+        mafids = addresses['MAFID'].values[rows]
+        design = SampleDesign(pd.Series(strata[rows], index=mafids), pd.Series(groups, index=mafids, dtype=float),
+                              population, fraction)
+        sample = addresses.iloc[np.sort(rows)]
+        record['rows'], record['fraction'] = sample.shape[0], fraction
+    logger.info("Sampled %d of %d addresses (fraction %.4f, seed %d)", sample.shape[0], addresses.shape[0],
+                fraction, seed)
+    return sample, design
+
+
+def sample_addresses(addresses, county_code='08031', sample=True, seed=DEFAULT_SEED, budget=None):
+    """
+    Samples a county's addresses as requested by the sample argument of the
+    import functions, stratifying by the candidate counts of the county's
+    crosswalk. The design is kept for county_design.
+
+    Returns
+    -------
+    addresses: pd DataFrame
+            the sampled addresses, or all of them if sample is false
+    """
+    fraction = sample_fraction(sample, budget)
+    if fraction is None:
+        return addresses
+    candidates = county_candidate_counts(addresses, county_code=county_code)
+    addresses, design = stratified_sample(addresses, candidates, fraction=fraction, seed=seed, budget=budget)
+    DESIGNS[(county_code, fraction, seed, budget)] = design
+    return addresses
+
+
+def county_design(county_code='08031', sample=True, seed=DEFAULT_SEED, budget=None):
+    """
+    Design of the sample that sample_addresses draws with these arguments,
+    drawing it again if it was not drawn in this process
+    """
+    key = (county_code, sample_fraction(sample, budget), seed, budget)
+    if key not in DESIGNS:
+        addresses = pd.read_csv("../data/addresses/" + county_code + "_addresses.csv",
+                                usecols=['MAFID', 'MAF_NAME', 'BLKID'], converters={'BLKID': lambda x: str(x)})
+        sample_addresses(addresses, county_code=county_code, sample=sample, seed=seed, budget=budget)
+    return DESIGNS[key]
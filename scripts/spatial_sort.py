@@ -0,0 +1,94 @@
+import numpy as np
+
+"""
+This script orders address points along a space-filling curve, so that points
+that are close together on the map are close together in the address table.
+
+Addresses are otherwise processed in file order, which after sampling is
+effectively random. Matched in curve order, consecutive addresses tend to share
+candidate TLIDs, so their parsed geometries are reused from match_tlid_utils'
+geometry cache, and any contiguous slice of the table (a batch or a shard) covers
+a compact area with a small set of candidate geometries.
+
+Two curves are available: the Hilbert curve, which keeps neighbors together
+better, and the Z-order (Morton) curve, which is cheaper to compute.
+"""
+
+CURVES = ['hilbert', 'zorder']
+
+
+def grid_coords(longitude, latitude, bits=16):
+    """
+    Scales coordinates to integers on a 2**bits by 2**bits grid spanning the points
+
+    Returns
+    -------
+    x, y: np array
+            integer grid coordinates
+    """
+    coords = np.column_stack([np.asarray(longitude, dtype=float), np.asarray(latitude, dtype=float)])
+    low = np.nanmin(coords, axis=0) if coords.shape[0] else np.zeros(2)
+    span = np.maximum(np.nanmax(coords, axis=0) - low, 1e-12) if coords.shape[0] else np.ones(2)
+    scaled = (coords - low) / span * (2 ** bits - 1)
+    # Points without coordinates go to the end of the curve
+    scaled = np.nan_to_num(scaled, nan=2 ** bits - 1)
+    return scaled[:, 0].astype(np.int64), scaled[:, 1].astype(np.int64)
+
+
+def zorder_key(x, y, bits=16):
+    """
+    Interleaves the bits of integer grid coordinates into Z-order keys
+    """
+    key = np.zeros(x.shape[0], dtype=np.int64)
+    for bit in range(bits):
+        key |= ((x >> bit) & 1) << (2 * bit)
+        key |= ((y >> bit) & 1) << (2 * bit + 1)
+    return key
+
+
+def hilbert_key(x, y, bits=16):
+    """
+    Distance along the Hilbert curve of integer grid coordinates, vectorized
+    over points
+    """
+    n = 2 ** bits
+    x, y = x.copy(), y.copy()
+    key = np.zeros(x.shape[0], dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = ((x & s) > 0).astype(np.int64)
+        ry = ((y & s) > 0).astype(np.int64)
+        key += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so that the curve inside it has the standard orientation
+        flip = (ry == 0) & (rx == 1)
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        swap = ry == 0
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s //= 2
+    return key
+
+
+def spatial_sort(addresses, curve='hilbert', bits=16):
+    """
+    Sorts address points along a space-filling curve
+
+    Parameters
+    ----------
+    addresses: pd DataFrame
+            of address points, with LATITUDE and LONGITUDE
+    curve: str
+            'hilbert' or 'zorder'
+    bits: int
+            resolution of the curve, in bits per coordinate (at most 31)
+
+    Returns
+    -------
+    addresses: pd DataFrame
+            the same rows, in curve order
+    """
+    if curve not in CURVES:
+        raise ValueError("curve must be one of " + ", ".join(CURVES))
+    x, y = grid_coords(addresses['LONGITUDE'].values, addresses['LATITUDE'].values, bits=bits)
+    key = hilbert_key(x, y, bits=bits) if curve == 'hilbert' else zorder_key(x, y, bits=bits)
+    return addresses.iloc[np.argsort(key, kind='stable')]
@@ -0,0 +1,227 @@
+import os
+import json
+import pickle
+import hashlib
+import logging
+import threading
+import instrument
+
+"""
+This script contains a cache for the results of workflow stages, keyed on the
+content of each stage's inputs and on its parameters.
+
+Stages and their inputs are listed in STAGES. An input is either one of the
+county's files (edges, faces, addresses, or any other file registered with the
+cache) or another stage, in which case that stage's key is used. A change to an
+input file or a parameter therefore changes the key of every stage downstream of
+it, while stages whose inputs did not change are reused from the cache.
+
+File digests are SHA-256 hashes of file contents. So that large files are not
+rehashed on every run, digests are remembered alongside each file's size and
+modification time, and only recomputed when either of those changes.
+"""
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = "../results/cache/"
+
+# Bump to invalidate every cached stage, e.g. after changing how a stage is computed
+CACHE_VERSION = 1
+
+# Stage name: (inputs, parameters)
+STAGES = {'names': (['edges', 'faces', 'addresses'], ['roads_only', 'cutoff', 'adjacent']),
+          'xwalk': (['names', 'edges', 'faces'], ['roads_only']),
+          'match': (['xwalk', 'addresses', 'edges'], ['mode', 'coords']),
+          'margins': (['xwalk', 'addresses', 'edges'], ['mode', 'coords']),
+          'index': (['xwalk', 'edges', 'faces'], ['cutoff', 'adjacent']),
+          'edge_offsets': (['edges'], []),
+          'edge_boxes': (['edges'], []),
+          'relations': (['edges', 'faces'], []),
+          'sides': (['edges', 'faces'], [])}
+
+# Guards read-modify-write updates of the digest index by concurrent loaders (see prefetch.py)
+DIGEST_INDEX_LOCK = threading.Lock()
+
+DEFAULT_PARAMS = {'roads_only': True, 'cutoff': 0.5, 'adjacent': True, 'mode': 'vertex', 'coords': 'float64'}
+
+
+def county_input_paths(county_code='08031'):
+    """
+    Paths to the input files of a county
+    """
+    return {'edges': "../data/tiger_csv/" + county_code + "_edges.csv",
+            'faces': "../data/tiger_csv/" + county_code + "_faces.csv",
+            'addresses': "../data/addresses/" + county_code + "_addresses.csv"}
+
+
+def read_digest_index(index_path):
+    """
+    Previously computed file digests (see file_digest), empty if none were saved
+    """
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def update_digest_index(index_path, abs_path, entry):
+    """
+    Records one file's digest in the digest index. The index is re-read under a
+    lock so that entries written meanwhile are kept, and replaced atomically so
+    that readers never see a partly written file.
+    """
+    with DIGEST_INDEX_LOCK:
+        digest_index = read_digest_index(index_path)
+        digest_index[abs_path] = entry
+        if not os.path.exists(os.path.dirname(index_path)):
+            os.makedirs(os.path.dirname(index_path))
+        tmp_path = index_path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(digest_index, f)
+        os.replace(tmp_path, index_path)
+
+
+def file_digest(path, digest_index=None):
+    """
+    Finds the SHA-256 digest of a file's contents
+
+    Parameters
+    ----------
+    path: str
+            path to the file
+    digest_index: dict
+            previously computed digests, keyed by absolute path, with the size and
+            modification time of the file when it was hashed. Updated in place.
+
+    Returns
+    -------
+    digest: str
+            hex digest, or None if the file does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    abs_path = os.path.abspath(path)
+    if digest_index is not None:
+        entry = digest_index.get(abs_path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['digest']
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+    if digest_index is not None:
+        digest_index[abs_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest}
+    return digest
+
+
+class StageCache(object):
+    """
+    Content-hashed cache of stage results for one county
+
+    Parameters
+    ----------
+    county_code: str
+            fips code for county
+    params: dict
+            parameters of the run, such as roads_only, cutoff and mode. Missing
+            parameters take their values from DEFAULT_PARAMS.
+    files: dict
+            additional input files, by input name. For example, match_county_tlid
+            registers the crosswalk CSV as the 'xwalk' input, in place of the
+            'xwalk' stage.
+    cache_dir: str
+            directory where results are stored
+    """
+    def __init__(self, county_code='08031', params=None, files=None, cache_dir=CACHE_DIR):
+        self.county_code = county_code
+        self.params = dict(DEFAULT_PARAMS, **(params or {}))
+        self.files = county_input_paths(county_code)
+        self.files.update(files or {})
+        self.cache_dir = cache_dir + county_code + '/'
+        self.index_path = cache_dir + 'file_digests.json'
+        self.digests = {}
+        self.keys = {}
+
+    def digest(self, name):
+        """
+        Digest of an input file, computed once per cache object
+        """
+        if name not in self.digests:
+            with DIGEST_INDEX_LOCK:
+                digest_index = read_digest_index(self.index_path)
+            abs_path = os.path.abspath(self.files[name])
+            before = digest_index.get(abs_path)
+            self.digests[name] = file_digest(self.files[name], digest_index)
+            # Only files that were (re)hashed need a new entry
+            if digest_index.get(abs_path) not in (None, before):
+                update_digest_index(self.index_path, abs_path, digest_index[abs_path])
+        return self.digests[name]
+
+    def key(self, stage):
+        """
+        Key of a stage: a hash of its inputs' digests (or keys, for inputs that
+        are stages) and of its parameters
+        """
+        if stage not in self.keys:
+            inputs, param_names = STAGES[stage]
+            parts = {'version': CACHE_VERSION,
+                     'stage': stage,
+                     'county_code': self.county_code,
+                     'inputs': {name: self.digest(name) if name in self.files else self.key(name) for name in inputs},
+                     'params': {name: self.params[name] for name in param_names}}
+            self.keys[stage] = hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:24]
+        return self.keys[stage]
+
+    def path(self, stage):
+        return self.cache_dir + stage + '_' + self.key(stage) + '.pkl'
+
+    def get(self, stage):
+        """
+        Returns
+        -------
+        result: object
+                the cached result of the stage, or None if its inputs or
+                parameters have changed since it was last stored
+        """
+        path = self.path(stage)
+        if not os.path.exists(path):
+            logger.info("Cache miss for stage %s", stage)
+            instrument.count('cache_miss')
+            return None
+        with open(path, 'rb') as f:
+            result = pickle.load(f)
+        logger.info("Cache hit for stage %s", stage)
+        instrument.count('cache_hit')
+        return result
+
+    def put(self, stage, result):
+        """
+        Stores the result of a stage
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = self.path(stage)
+        # Write to a temporary file first, so an interrupted run never leaves a partial result
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    def cached(self, stage, compute):
+        """
+        Returns the cached result of a stage, or computes and stores it
+
+        Parameters
+        ----------
+        stage: str
+                one of STAGES
+        compute: function
+                called without arguments to compute the stage on a cache miss
+        """
+        result = self.get(stage)
+        if result is None:
+            result = compute()
+            self.put(stage, result)
+        return result
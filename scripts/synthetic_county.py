@@ -0,0 +1,382 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+"""
+This script generates a synthetic county in the same formats as the inputs to
+tiger_xwalk.py and match_tlid.py: a TIGER edges CSV, a TIGER faces CSV (both with
+WKT geometry columns, as written by make_csv.py), and an address points CSV with
+MAF street names and block IDs.
+
+The county is a grid of rectangular blocks. Horizontal streets are avenues and
+vertical streets are streets. Each block side is cut into several street segments
+(as TIGER does wherever a road meets a ditch, pipeline, trail, etc.), so that
+many addresses have more than one possible TLID. A share of non-road edges and
+of non-standard MAF street names is included so that the road flag filter and
+the name matching step in tiger_xwalk.py are exercised.
+
+Generated counties are used by benchmark.py to time the workflow at scales from
+thousands to hundreds of millions of address points.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Origin and block dimensions, in degrees (roughly 200m x 220m blocks near Denver)
+ORIGIN = (-105.1, 39.6)
+BLOCK_WIDTH = 0.0025
+BLOCK_HEIGHT = 0.002
+
+# Blocks per side of a tract
+TRACT_SIZE = 10
+
+STREET_WORDS = ['Acoma', 'Bannock', 'Cherokee', 'Delaware', 'Elati', 'Fox', 'Galapago',
+                'Huron', 'Inca', 'Jason', 'Kalamath', 'Lipan', 'Mariposa', 'Navajo',
+                'Osage', 'Pecos', 'Quivas', 'Raritan', 'Shoshone', 'Tejon', 'Umatilla',
+                'Vallejo', 'Wyandot', 'Zuni']
+
+
+def ordinal(n):
+    """
+    Formats an integer as an ordinal street number, i.e. 1st, 2nd, 11th
+
+    Parameters
+    ----------
+    n: int
+
+    Returns
+    -------
+    ordinal: str
+    """
+    if 10 <= n % 100 <= 20:
+        suffix = 'th'
+    else:
+        suffix = {1: 'st', 2: 'nd', 3: 'rd'}.get(n % 10, 'th')
+    return str(n) + suffix
+
+
+def avenue_name(j):
+    """
+    TIGER name of the j-th horizontal street
+    """
+    return 'E ' + ordinal(j + 1) + ' Ave'
+
+
+def street_name(i):
+    """
+    TIGER name of the i-th vertical street
+    """
+    word = STREET_WORDS[i % len(STREET_WORDS)]
+    if i >= len(STREET_WORDS):
+        word = word + ' ' + str(i // len(STREET_WORDS) + 1)
+    return 'N ' + word + ' St'
+
+
+def maf_variant(tiger_name):
+    """
+    Rewrites a TIGER street name the way an intake system might, so that
+    names must be matched with difflib rather than by equality
+
+    Parameters
+    ----------
+    tiger_name: str
+
+    Returns
+    -------
+    maf_name: str
+    """
+    maf_name = tiger_name.replace(' Ave', ' Avenue').replace(' St', ' Street')
+    return maf_name.replace('E ', 'East ', 1).replace('N ', 'North ', 1)
+
+
+def block_ids(i, j, state, county):
+    """
+    Builds 15 digit block IDs (state, county, tract, block) for grid cells
+
+    Parameters
+    ----------
+    i: np array
+            grid column of each block
+    j: np array
+            grid row of each block
+    state: str
+            two digit state fips code
+    county: str
+            three digit county fips code
+
+    Returns
+    -------
+    tract: np array
+            six digit tract codes
+    block: np array
+            four digit block codes
+    """
+    tract = ((j // TRACT_SIZE) * 1000 + (i // TRACT_SIZE) + 1) * 100
+    block = 1000 + (j % TRACT_SIZE) * TRACT_SIZE + (i % TRACT_SIZE)
+    tract = np.char.zfill(tract.astype(str), 6)
+    block = block.astype(str)
+    return tract, block
+
+
+def linestring_wkt(xs, ys):
+    """
+    Formats vertex arrays as a WKT linestring
+    """
+    return 'LINESTRING (' + ', '.join('%.7f %.7f' % xy for xy in zip(xs, ys)) + ')'
+
+
+def split_run(start, end, n_segments, vertices_per_segment, rng):
+    """
+    Cuts the street run between two intersections into segments at random
+    points, and adds intermediate vertices to each segment
+
+    Parameters
+    ----------
+    start: float
+            coordinate of the first intersection along the run
+    end: float
+            coordinate of the second intersection along the run
+    n_segments: int
+            number of street segments on the run
+    vertices_per_segment: int
+            number of interior vertices in each segment
+    rng: np random Generator
+
+    Returns
+    -------
+    segments: list
+            list of arrays containing the coordinates of each segment's vertices
+    """
+    cuts = np.sort(rng.uniform(start, end, n_segments - 1))
+    bounds = np.concatenate([[start], cuts, [end]])
+    return [np.linspace(bounds[k], bounds[k + 1], vertices_per_segment + 2) for k in range(n_segments)]
+
+
+def make_run_edges(fixed, start, end, horizontal, left_face, right_face, name,
+                   node_from, node_to, counters, segments_per_side, vertices_per_segment, rng):
+    """
+    Creates edge records for every segment of a single street run between
+    two intersections
+
+    Returns
+    -------
+    rows: list
+            list of edge records (dicts)
+    """
+    n_segments = 1 + rng.poisson(segments_per_side - 1) if segments_per_side > 1 else 1
+    rows = []
+    segments = split_run(start, end, n_segments, vertices_per_segment, rng)
+    for k, coords in enumerate(segments):
+        # Interior cut points become new topology nodes
+        tnidf = node_from if k == 0 else counters['node'] + k - 1
+        tnidt = node_to if k == n_segments - 1 else counters['node'] + k
+        if horizontal:
+            geometry = linestring_wkt(coords, np.full(coords.shape, fixed))
+        else:
+            geometry = linestring_wkt(np.full(coords.shape, fixed), coords)
+        rows.append({'TLID': counters['tlid'], 'TFIDL': left_face, 'TFIDR': right_face,
+                     'MTFCC': 'S1400', 'FULLNAME': name, 'ROADFLG': 'Y',
+                     'TNIDF': tnidf, 'TNIDT': tnidt, 'geometry': geometry})
+        counters['tlid'] += 1
+    counters['node'] += n_segments - 1
+    return rows
+
+
+def make_grid_row(j, nx, ny, state, county, counters, segments_per_side,
+                  vertices_per_segment, nonroad_rate, rng):
+    """
+    Creates edges and faces for one row of blocks: the avenue along the bottom
+    of the row, the streets crossing the row, and the avenue along the top of
+    the row if it is the last one.
+
+    Returns
+    -------
+    edges: pd DataFrame
+    faces: pd DataFrame
+    """
+    x0, y0 = ORIGIN
+    rows = []
+
+    def face(i, jj):
+        # Face 0 is outside of the county
+        if (0 <= i < nx) and (0 <= jj < ny):
+            return 1 + jj * nx + i
+        return 0
+
+    def node(i, jj):
+        return 1 + jj * (nx + 1) + i
+
+    avenues = [j, j + 1] if j == ny - 1 else [j]
+    for jj in avenues:
+        y = y0 + jj * BLOCK_HEIGHT
+        for i in range(nx):
+            # Directed west to east, so the block above is on the left
+            rows += make_run_edges(y, x0 + i * BLOCK_WIDTH, x0 + (i + 1) * BLOCK_WIDTH, True,
+                                   face(i, jj), face(i, jj - 1), avenue_name(jj),
+                                   node(i, jj), node(i + 1, jj), counters,
+                                   segments_per_side, vertices_per_segment, rng)
+
+    y_start, y_end = y0 + j * BLOCK_HEIGHT, y0 + (j + 1) * BLOCK_HEIGHT
+    for i in range(nx + 1):
+        # Directed south to north, so the block to the west is on the left
+        rows += make_run_edges(x0 + i * BLOCK_WIDTH, y_start, y_end, False,
+                               face(i - 1, j), face(i, j), street_name(i),
+                               node(i, j), node(i, j + 1), counters,
+                               segments_per_side, vertices_per_segment, rng)
+
+    # Non-road edges (trails, ditches) inside blocks
+    for i in np.flatnonzero(rng.random(nx) < nonroad_rate):
+        xs = x0 + (i + np.array([.3, .7])) * BLOCK_WIDTH
+        ys = y0 + (j + np.array([.5, .5])) * BLOCK_HEIGHT
+        rows.append({'TLID': counters['tlid'], 'TFIDL': face(i, j), 'TFIDR': face(i, j),
+                     'MTFCC': 'H3010', 'FULLNAME': np.nan, 'ROADFLG': 'N',
+                     'TNIDF': counters['node'], 'TNIDT': counters['node'] + 1,
+                     'geometry': linestring_wkt(xs, ys)})
+        counters['tlid'] += 1
+        counters['node'] += 2
+
+    edges = pd.DataFrame(rows)
+    edges.insert(0, 'COUNTYFP', county)
+    edges.insert(0, 'STATEFP', state)
+
+    i = np.arange(nx)
+    tract, block = block_ids(i, np.full(nx, j), state, county)
+    xs, ys = x0 + i * BLOCK_WIDTH, y0 + j * BLOCK_HEIGHT
+    faces = pd.DataFrame({'STATEFP10': state, 'COUNTYFP10': county,
+                          'TRACTCE10': tract, 'BLOCKCE10': block,
+                          'TFID': 1 + j * nx + i,
+                          'geometry': ['POLYGON ((%.7f %.7f, %.7f %.7f, %.7f %.7f, %.7f %.7f, %.7f %.7f))'
+                                       % (x, ys, x + BLOCK_WIDTH, ys, x + BLOCK_WIDTH, ys + BLOCK_HEIGHT,
+                                          x, ys + BLOCK_HEIGHT, x, ys) for x in xs]})
+    return edges, faces
+
+
+def make_row_addresses(j, nx, state, county, addresses_per_block, name_variant_rate,
+                       bad_name_rate, first_mafid, rng):
+    """
+    Creates address points for one row of blocks. Each address lies a short
+    distance inside its block, facing one of the four streets around it.
+
+    Returns
+    -------
+    addresses: pd DataFrame
+    """
+    x0, y0 = ORIGIN
+    counts = rng.poisson(addresses_per_block, nx)
+    i = np.repeat(np.arange(nx), counts)
+    n = i.shape[0]
+
+    # 0 = bottom avenue, 1 = top avenue, 2 = left street, 3 = right street
+    side = rng.integers(0, 4, n)
+    along = rng.uniform(.02, .98, n)
+    depth = rng.uniform(.05, .2, n)
+
+    fx = np.where(side < 2, along, np.where(side == 2, depth, 1 - depth))
+    fy = np.where(side >= 2, along, np.where(side == 0, depth, 1 - depth))
+    lon = x0 + (i + fx) * BLOCK_WIDTH
+    lat = y0 + (j + fy) * BLOCK_HEIGHT
+
+    names = np.where(side == 0, avenue_name(j),
+                     np.where(side == 1, avenue_name(j + 1), ''))
+    names = names.astype(object)
+    street_sides = side >= 2
+    names[street_sides] = [street_name(k) for k in (i + (side == 3))[street_sides]]
+
+    variants = rng.random(n) < name_variant_rate
+    names[variants] = [maf_variant(name) for name in names[variants]]
+    names[rng.random(n) < bad_name_rate] = 'Unknown Rd'
+
+    tract, block = block_ids(i, np.full(n, j), state, county)
+    blkid = np.char.add(np.char.add(state + county, tract), block)
+
+    return pd.DataFrame({'MAFID': np.arange(first_mafid, first_mafid + n),
+                         'LATITUDE': np.round(lat, 8), 'LONGITUDE': np.round(lon, 8),
+                         'MAF_NAME': names, 'BLKID': blkid})
+
+
+def generate_county(county_code='99001', n_addresses=10000, addresses_per_block=40,
+                    segments_per_side=2, vertices_per_segment=3, nonroad_rate=.1,
+                    name_variant_rate=.1, bad_name_rate=.01, seed=0, data_dir='../data/',
+                    rows_per_chunk=50):
+    """
+    Generates a synthetic county and writes it to the locations read by
+    tiger_xwalk.py and match_tlid.py:
+    [[data_dir]]/tiger_csv/[[county_code]]_edges.csv,
+    [[data_dir]]/tiger_csv/[[county_code]]_faces.csv and
+    [[data_dir]]/addresses/[[county_code]]_addresses.csv.
+    Files are written in chunks of block rows, so counties with hundreds of millions
+    of addresses can be generated without holding them in memory.
+
+    Parameters
+    ----------
+    county_code: str
+            five digit fips code for the synthetic county. Defaults to an unused code.
+    n_addresses: int
+            approximate number of address points to generate
+    addresses_per_block: float
+            mean number of addresses in each block
+    segments_per_side: float
+            mean number of street segments along each side of a block
+    vertices_per_segment: int
+            number of interior vertices in each street segment
+    nonroad_rate: float
+            expected number of non-road edges per block
+    name_variant_rate: float
+            share of addresses whose MAF name differs from the TIGER name
+    bad_name_rate: float
+            share of addresses whose MAF name matches no TIGER name
+    seed: int
+            random seed
+    data_dir: str
+            relative path to the data directory
+    rows_per_chunk: int
+            number of block rows to write at once
+
+    Returns
+    -------
+    summary: dict
+            county code and number of addresses, edges, faces and blocks written
+    """
+    rng = np.random.default_rng(seed)
+    state, county = county_code[:2], county_code[2:]
+
+    # Lay blocks out in a roughly square grid
+    n_blocks = max(int(np.ceil(n_addresses / addresses_per_block)), 1)
+    nx = int(np.ceil(np.sqrt(n_blocks)))
+    ny = int(np.ceil(n_blocks / nx))
+
+    for sub_dir in ['tiger_csv/', 'addresses/']:
+        if not os.path.exists(data_dir + sub_dir):
+            os.makedirs(data_dir + sub_dir)
+    edge_path = data_dir + 'tiger_csv/' + county_code + '_edges.csv'
+    face_path = data_dir + 'tiger_csv/' + county_code + '_faces.csv'
+    address_path = data_dir + 'addresses/' + county_code + '_addresses.csv'
+
+    counters = {'tlid': 100000000, 'node': (nx + 1) * (ny + 1) + 1}
+    summary = {'county_code': county_code, 'addresses': 0, 'edges': 0, 'faces': 0, 'blocks': nx * ny}
+    for chunk_start in range(0, ny, rows_per_chunk):
+        edge_chunks, face_chunks, address_chunks = [], [], []
+        for j in range(chunk_start, min(chunk_start + rows_per_chunk, ny)):
+            edges, faces = make_grid_row(j, nx, ny, state, county, counters, segments_per_side,
+                                         vertices_per_segment, nonroad_rate, rng)
+            addresses = make_row_addresses(j, nx, state, county, addresses_per_block, name_variant_rate,
+                                           bad_name_rate, summary['addresses'], rng)
+            summary['addresses'] += addresses.shape[0]
+            edge_chunks.append(edges)
+            face_chunks.append(faces)
+            address_chunks.append(addresses)
+
+        first = chunk_start == 0
+        for chunks, path in [(edge_chunks, edge_path), (face_chunks, face_path), (address_chunks, address_path)]:
+            chunk = pd.concat(chunks, ignore_index=True)
+            chunk.to_csv(path, mode='w' if first else 'a', header=first, index=False)
+        summary['edges'] += sum(chunk.shape[0] for chunk in edge_chunks)
+        summary['faces'] += sum(chunk.shape[0] for chunk in face_chunks)
+
+    logger.info("Generated synthetic county: %s", summary)
+    return summary
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    generate_county(county_code='99001', n_addresses=10000)
@@ -3,6 +3,15 @@ import pandas as pd
 import numpy as np
 import copy
 import difflib
+import logging
+import instrument
+import profiling
+import stage_cache
+import block_assign
+import name_dictionary
+import prefetch
+import relation_index
+import name_index
 
 # Hide warnings from output
 import warnings
@@ -26,6 +35,9 @@ https://www2.census.gov/geo/pdfs/maps-data/data/tiger/tgrshp2014/TGRSHP2014_Tech
 
 """
 
+logger = logging.getLogger(__name__)
+
+
 def load_tiger(edge_path, face_path):
     """
     Loads already downloaded TIGER data from paths, keeps relevant attributes,
@@ -84,24 +96,23 @@ def load_tiger_csv(edge_path, face_path):
     face: pd DataFrame
             face data from TIGER files
     """
-    # Import TIGER edge data
-    edges = pd.read_csv(edge_path, converters={'TFIDL': lambda x: x.split('.')[0],
-                                                 'TFIDR': lambda x: x.split('.')[0]})
-    print("\nLoaded publically available edges table:")
-    print(edges[['FULLNAME','TLID','TFIDL','TFIDR']].head())
+    # Import TIGER edge and face data, reading each file while the other is parsed
+    edges, faces = prefetch.run_concurrently(
+        lambda: pd.read_csv(edge_path, converters={'TFIDL': lambda x: x.split('.')[0],
+                                                   'TFIDR': lambda x: x.split('.')[0]}),
+        lambda: pd.read_csv(face_path, converters={'STATEFP10': lambda x: str(x),
+                                                   'COUNTYFP10': lambda x: str(x),
+                                                   'TRACTCE10': lambda x: str(x),
+                                                   'BLOCKCE10': lambda x: str(x),
+                                                   'TFID': lambda x: str(x)}))
+    logger.info("Loaded publically available edges table: %d rows", edges.shape[0])
+    logger.debug("Edges:\n%s", edges[['FULLNAME','TLID','TFIDL','TFIDR']].head())
 
-
-    # Import TIGER face data
-    faces = pd.read_csv(face_path, converters={'STATEFP10': lambda x: str(x),
-                                                    'COUNTYFP10': lambda x: str(x),
-                                                    'TRACTCE10': lambda x: str(x),
-                                                    'BLOCKCE10': lambda x: str(x),
-                                                    'TFID': lambda x: str(x)})
     faces.loc[:,'BLKID'] = faces['STATEFP10'] + faces['COUNTYFP10'] + faces['TRACTCE10'] + faces['BLOCKCE10']
     faces = faces[['TFID','BLKID']]
     faces.set_index('TFID')
-    print("\nLoaded publically available faces table:")
-    print(faces.head())
+    logger.info("Loaded publically available faces table: %d rows", faces.shape[0])
+    logger.debug("Faces:\n%s", faces.head())
 
     return edges, faces
 
@@ -130,19 +141,14 @@ def create_edge_face(edges, faces, roads_only=True):
     """
 
     # Create edge-face table by splitting face ID and side indicator into two columns
-    right_edges = edges[['TLID','TFIDR','FULLNAME','ROADFLG']]
-    right_edges.loc[:,'SIDE'] = 1
-    right_edges = right_edges.rename(columns={'TFIDR': 'TFID'})
+    right_edges = edges[['TLID','TFIDR','FULLNAME','ROADFLG']].rename(columns={'TFIDR': 'TFID'}).assign(SIDE=1)
+    left_edges = edges[['TLID','TFIDL','FULLNAME','ROADFLG']].rename(columns={'TFIDL': 'TFID'}).assign(SIDE=0)
 
-    left_edges = edges[['TLID','TFIDL','FULLNAME','ROADFLG']]
-    left_edges.loc[:,'SIDE'] = 0
-    left_edges = left_edges.rename(columns={'TFIDL': 'TFID'})
-
-    edge_face = right_edges.append(left_edges)
+    edge_face = pd.concat([right_edges, left_edges])
 
     if roads_only == True:
         edge_face = edge_face[edge_face['ROADFLG'] == 'Y']
-        edge_face.drop(['ROADFLG'], axis=1)
+        edge_face = edge_face.drop(['ROADFLG'], axis=1)
 
     return edge_face
 
@@ -166,16 +172,20 @@ def create_names_blocks(edge_face, faces):
     -------
     name_blocks: pd DataFrame
             Contains a column with TIGER names, and one with the neighboring block
-            id.
+            id. If edge_face has integer name IDs ('NAME_ID'), duplicates are
+            found on those, and they are kept in the output.
 
     """
     # Link face IDs with block IDs using the edge-face
     edge_face_blocks = edge_face.merge(faces, on='TFID', how='left')
-    name_blocks = edge_face_blocks[['FULLNAME', 'BLKID']].drop_duplicates()
+    if 'NAME_ID' in edge_face_blocks.columns:
+        name_blocks = edge_face_blocks[['FULLNAME', 'BLKID', 'NAME_ID']].drop_duplicates(['NAME_ID', 'BLKID'])
+    else:
+        name_blocks = edge_face_blocks[['FULLNAME', 'BLKID']].drop_duplicates()
     return name_blocks
 
 
-def match_names(street_name, block_id, names_blocks, counter = 0):
+def match_names(street_name, block_id, names_blocks, counter = 0, cutoff = 0.5):
     """
     Given a MAF street name and block id, finds the closest TIGER street name match
     among the street names associated with the same block.
@@ -189,6 +199,8 @@ def match_names(street_name, block_id, names_blocks, counter = 0):
     name_blocks: pd DataFrame
             Contains a column with TIGER names, and one with the neighboring block
             id
+    cutoff: float
+            minimum difflib similarity score for a match
 
     Returns
     -------
@@ -198,17 +210,59 @@ def match_names(street_name, block_id, names_blocks, counter = 0):
     """
     names_subset = names_blocks.loc[names_blocks['BLKID'] == block_id]
     possible_names = names_subset['FULLNAME'].dropna().tolist()
-    closest_match = difflib.get_close_matches(street_name, possible_names, cutoff=0.5, n=1)
+    return closest_name(street_name, possible_names, cutoff=cutoff)
+
+
+def closest_name(street_name, possible_names, cutoff = 0.5):
+    """
+    Closest of a list of TIGER street names to a MAF street name, as in
+    match_names, or None if none reaches cutoff
+    """
+    closest_match = difflib.get_close_matches(street_name, possible_names, cutoff=cutoff, n=1)
     if len(closest_match)>0:
         return closest_match[0]
     else:
         return None
 
 
-def make_names_table(maf, names_blocks):
+def match_adjacent_names(names, names_blocks, neighbors, cutoff = 0.5):
+    """
+    Second tier of the name match: for MAF name-block combinations without a
+    TIGER name along their block, finds the closest TIGER name along the adjacent
+    blocks, using an n-gram index of the county's names (see name_index.py)
+
+    Parameters
+    ----------
+    names: pd DataFrame
+            MAF names ('MAF_NAME') and block ids ('BLKID') to match
+    name_blocks: pd DataFrame
+            Contains a column with TIGER names, and one with the neighboring block
+            id
+    neighbors: pd Series
+            list of adjacent BLKIDs, indexed by BLKID (see name_index.block_neighbors)
+    cutoff: float
+            minimum difflib similarity score for a match
+
+    Returns
+    -------
+    closest_matches: pd Series
+            closest TIGER name of each row of names, None where there is none
+    """
+    index = name_index.NameIndex(names_blocks['FULLNAME'])
+    block_names = names_blocks.dropna(subset=['FULLNAME']).groupby('BLKID')['FULLNAME'].agg(list)
+    closest_matches = []
+    for street_name, block_id in zip(names['MAF_NAME'], names['BLKID']):
+        adjacent = neighbors.get(block_id, [])
+        allowed = [name for block in adjacent for name in block_names.get(block, [])]
+        closest_matches.append(index.best_match(street_name, allowed, cutoff=cutoff) if allowed else None)
+    return pd.Series(closest_matches, index=names.index, dtype=object)
+
+
+def make_names_table(maf, names_blocks, cutoff = 0.5, neighbors=None):
     """
     Using all name-block combinations in the MAF and TIGER, makes a table matching
-    MAF street name with TIGER street name. This does so by calling match_names()
+    MAF street name with TIGER street name. This does so by calling match_names(),
+    and match_adjacent_names() for names that are not found along their block
 
     Parameters
     ----------
@@ -218,28 +272,47 @@ def make_names_table(maf, names_blocks):
     name_blocks: pd DataFrame
             Contains a column with TIGER names, and one with the neighboring block
             id.
+    cutoff: float
+            minimum difflib similarity score for a match
+    neighbors: pd Series
+            list of adjacent BLKIDs, indexed by BLKID (see
+            name_index.block_neighbors). If None, names are only searched for
+            along their own block.
 
     Returns
     -------
     names: pd DataFrame
             Contains a column with TIGER names, one with the neighboring block
-            id, and one with MAF name
+            id, one with MAF name, and one ('ADJACENT') that is true where the
+            TIGER name was found along an adjacent block
     """
 
     names = maf[['MAF_NAME', 'BLKID']]
     names = names.drop_duplicates(keep='first')
     names = names.reset_index(drop=True)
-    names.loc[:,'FULLNAME'] =  names.apply(lambda row: match_names(row['MAF_NAME'], row['BLKID'], names_blocks), axis=1)
+    names.loc[:,'FULLNAME'] =  names.apply(lambda row: match_names(row['MAF_NAME'], row['BLKID'], names_blocks, cutoff=cutoff), axis=1)
+    names['ADJACENT'] = False
+    if neighbors is not None:
+        missing = names['FULLNAME'].isna()
+        adjacent = match_adjacent_names(names.loc[missing], names_blocks, neighbors, cutoff=cutoff).dropna()
+        names.loc[adjacent.index, 'FULLNAME'] = adjacent
+        names.loc[adjacent.index, 'ADJACENT'] = True
+        logger.info("Names found along adjacent blocks: %d of %d", adjacent.shape[0], int(missing.sum()))
+        instrument.count('name_adjacent_match', adjacent.shape[0])
     name_errors = names[names['FULLNAME'].isna()]
-    print("No match rate:", name_errors.shape[0]/names.shape[0])
+    logger.info("No match rate: %s", name_errors.shape[0]/names.shape[0])
+    instrument.count('name_no_match', name_errors.shape[0])
+    instrument.set_value('name_no_match_rate', name_errors.shape[0]/names.shape[0])
     name_errors.to_csv("../results/names_blocks_xwalk/name_match_errors.csv")
     return names
 
 
-def name_tlid_table(names, faces, edge_face):
+def name_tlid_table(names, faces, edge_face, name_dict=None, neighbors=None):
     """
-    Applies find_possible_tlid() to a names table contining both MAF and TIGER street names,
-    by joining with face-edge information
+    Finds possible TLIDs for a names table contining both MAF and TIGER street names,
+    by joining with face-edge information. Gives the same lists as applying
+    find_possible_tlid() to each row, but with one join on integer name IDs and
+    block ids instead of a scan of the edge-face table per row.
 
     Parameters
     ----------
@@ -252,16 +325,42 @@ def name_tlid_table(names, faces, edge_face):
             Contains a column for TLID, one with the TIGER name,
             one for neighboring TFID, and one which describes which
             side the face is on (0 = left, 1 = right)
+    name_dict: name_dictionary.NameDictionary
+            dictionary used to convert street names to integer IDs. A temporary
+            one is used if None.
+    neighbors: pd Series
+            list of adjacent BLKIDs, indexed by BLKID. For names found along an
+            adjacent block (where 'ADJACENT' is true), the possible TLIDs are
+            those of the name along the adjacent blocks.
     Returns
     -------
     tlid_results: pd DataFrame
             Contains a column with TIGER names, one with the neighboring block
             id, one with MAF name, and one with a list of possible TLIDs
     """
-    names.loc[:,'TLIDs'] = names.apply(lambda row: find_possible_tlid(row['FULLNAME'],
-                                                                        row['BLKID'],
-                                                                        faces,
-                                                                        edge_face), axis=1)
+    if name_dict is None:
+        name_dict = name_dictionary.NameDictionary()
+    if 'NAME_ID' not in edge_face.columns:
+        edge_face = edge_face.assign(NAME_ID=name_dict.encode(edge_face['FULLNAME']))
+    name_ids = name_dict.encode(names['FULLNAME'])
+
+    # TLIDs of each block, and of each name along each block, in edge-face order
+    edge_blocks = edge_face[['TLID', 'TFID', 'NAME_ID']].merge(faces[['TFID', 'BLKID']].drop_duplicates(),
+                                                                on='TFID', how='inner')
+    by_name = edge_blocks.groupby(['BLKID', 'NAME_ID'], sort=False)['TLID'].agg(list)
+    by_block = edge_blocks.groupby('BLKID', sort=False)['TLID'].agg(list)
+    named = by_name.reindex(pd.MultiIndex.from_arrays([names['BLKID'].values, name_ids])).values
+    whole_block = by_block.reindex(names['BLKID'].values).values
+
+    # All block TLIDs are possible for names that failed the string match
+    empty = (names['FULLNAME'].isnull() | names['FULLNAME'].isin(['', 'nan'])).values
+    instrument.count('empty_name', int(empty.sum()))
+    tlids = np.where(empty, whole_block, named)
+    if neighbors is not None and 'ADJACENT' in names.columns:
+        for i in np.flatnonzero(names['ADJACENT'].values.astype(bool) & ~empty):
+            adjacent = [by_name.get((block, name_ids[i]), []) for block in neighbors.get(names['BLKID'].iloc[i], [])]
+            tlids[i] = list(dict.fromkeys(tlid for block_tlids in adjacent for tlid in block_tlids))
+    names['TLIDs'] = [t if isinstance(t, list) else [] for t in tlids]
     return names
 
 
@@ -292,11 +391,10 @@ def find_possible_tlid(tiger_name, block_id, face, edge_face):
 
 
     # This check assigns all block TLIDs as possible for those that fail the string match
-    if (tiger_name == None) or (tiger_name == '') or (tiger_name == 'nan'):
-        print("Empty name found")
-        print("Number of possible faces: ", len(possible_faces))
+    if pd.isnull(tiger_name) or (tiger_name == '') or (tiger_name == 'nan'):
+        instrument.count('empty_name')
+        logger.debug("Empty name found for block %s, number of possible faces: %d", block_id, len(possible_faces))
         possible_edge_faces = edge_face.loc[(edge_face['TFID'].isin(possible_faces))]
-        print(possible_edge_faces)
     else:
         possible_edge_faces = edge_face.loc[(edge_face['TFID'].isin(possible_faces))
                                 & (edge_face['FULLNAME'] == tiger_name)]
@@ -304,52 +402,214 @@ def find_possible_tlid(tiger_name, block_id, face, edge_face):
     possible_tlid = possible_edge_faces['TLID'].tolist()
     return possible_tlid
 
-def process_county(county_code = '08031'):
-    # Load TIGER data
-    county_edges, county_faces = load_tiger_csv("../data/tiger_csv/" + county_code + "_edges.csv",
-                                            "../data/tiger_csv/" + county_code + "_faces.csv")
+def load_county(county_code = '08031'):
+    """
+    Loads the csv-converted TIGER edges and faces, and the address points, for a county.
+    The three files are read concurrently.
+
+    Parameters
+    ----------
+    county_code: str
+            fips code for county
+
+    Returns
+    -------
+    county_edges: pd DataFrame
+            edge data from TIGER files
+    county_faces: pd DataFrame
+            face data from TIGER files, with concatinated block id
+    county_maf: pd DataFrame
+            address points with MAF street names and block ids. Missing block ids
+            are assigned from the address coordinates (see block_assign.py).
+    """
+    def load_tiger():
+        with instrument.stage('load_tiger') as record:
+            county_edges, county_faces = load_tiger_csv("../data/tiger_csv/" + county_code + "_edges.csv",
+                                                    "../data/tiger_csv/" + county_code + "_faces.csv")
+            record['edges'], record['faces'] = county_edges.shape[0], county_faces.shape[0]
+        return county_edges, county_faces
+
+    (county_edges, county_faces), county_maf = prefetch.run_concurrently(load_tiger,
+                                                                         lambda: load_addresses(county_code))
+    return county_edges, county_faces, county_maf
+
+
+def load_addresses(county_code = '08031'):
+    """
+    Loads the address points for a county. Missing block ids are assigned from
+    the address coordinates (see block_assign.py).
+    """
     # Load Denver address data (block IDs were imputed using a spatial join with face data)
-    county_maf = pd.read_csv("../data/addresses/" + county_code + "_addresses.csv", converters={'BLKID': lambda x: str(x)})
-    print("\nLoaded address data:")
-    print(county_maf[['LATITUDE','LONGITUDE','MAF_NAME','BLKID']].head())
+    with instrument.stage('load_addresses') as record:
+        county_maf = pd.read_csv("../data/addresses/" + county_code + "_addresses.csv", converters={'BLKID': lambda x: str(x)})
+        # Addresses without a block get one from their coordinates
+        county_maf = block_assign.fill_missing_blocks(county_maf, county_code=county_code)
+        record['rows'] = county_maf.shape[0]
+    logger.info("Loaded address data: %d rows", county_maf.shape[0])
+    logger.debug("Addresses:\n%s", county_maf[['LATITUDE','LONGITUDE','MAF_NAME','BLKID']].head())
+    return county_maf
+
+
+def build_county_xwalk(county_edges, county_faces, county_maf, county_code = '08031', names_cache=True,
+                       roads_only=True, cutoff=0.5, cache=None, name_dict=None, relations=None, adjacent=True):
+    """
+    Builds the crosswalk between MAF street name-block combinations and lists of
+    possible TLIDs from tables already in memory
+
+    Parameters
+    ----------
+    county_edges: pd DataFrame
+            edge data from TIGER files
+    county_faces: pd DataFrame
+            face data from TIGER files, with concatinated block id
+    county_maf: pd DataFrame
+            address points with MAF street names and block ids
+    county_code: str
+            fips code for county, used to name the name match file
+    names_cache: bool
+            if true, saves the MAF-TIGER name match as
+            "../results/names_blocks_xwalk/[[county_code]]_address_names.csv"
+    roads_only: bool
+            only includes roads in the edge-face table if true
+    cutoff: float
+            minimum difflib similarity score for a name match
+    cache: stage_cache.StageCache
+            if given, the name match is reused from the cache when the edges, faces
+            and addresses files and the parameters have not changed
+    name_dict: name_dictionary.NameDictionary
+            dictionary of street name IDs used for joins. If None, the dictionary
+            of the county's state is loaded, and saved with any new names.
+    relations: relation_index.RelationIndex
+            if given, the edge-face and face tables are taken from this index
+            instead of county_edges and county_faces, which may be None
+    adjacent: bool
+            if true, names without a close TIGER name along their block are
+            searched for along the adjacent blocks (see match_adjacent_names),
+            instead of getting every TLID of their block
+
+    Returns
+    -------
+    county_add_xwalk: pd DataFrame
+            Contains a column with TIGER names, one with the neighboring block
+            id, one with MAF name, one with a list of possible TLIDs, and one with
+            the number of possible TLIDs ('OPTIONS')
+    """
+    save_dict = name_dict is None
+    if save_dict:
+        name_dict = relations.name_dict if relations is not None else name_dictionary.load_names(county_code)
 
     # Create edge-face relationship table
-    county_edge_face = create_edge_face(county_edges, county_faces)
-    print("\nEdge-face relationship table: ")
-    print(county_edge_face[['TLID', 'TFID', 'FULLNAME']].head())
+    with instrument.stage('edge_face', indexed=relations is not None) as record:
+        if relations is not None:
+            county_edge_face = relations.edge_face(roads_only=roads_only)
+            county_faces = relations.faces()
+        else:
+            county_edge_face = create_edge_face(county_edges, county_faces, roads_only=roads_only)
+        record['rows'] = county_edge_face.shape[0]
+    if relations is None or name_dict is not relations.name_dict:
+        county_edge_face = county_edge_face.assign(NAME_ID=name_dict.encode(county_edge_face['FULLNAME']))
+    logger.debug("Edge-face relationship table:\n%s", county_edge_face[['TLID', 'TFID', 'FULLNAME']].head())
 
     # Create names-blocks relationship table using TIGER names
-    county_tiger_names = create_names_blocks(county_edge_face, county_faces)
-    print("\nTIGER Names-Blocks relationship table: ")
-    print(county_tiger_names.head())
+    with instrument.stage('names_blocks') as record:
+        county_tiger_names = create_names_blocks(county_edge_face, county_faces)
+        record['rows'] = county_tiger_names.shape[0]
+    logger.debug("TIGER Names-Blocks relationship table:\n%s", county_tiger_names.head())
+    neighbors = name_index.block_neighbors(county_edge_face, county_faces) if adjacent else None
 
     # Match names to create MAFname-block-TIGERname tables (most time consuming step)
-    print("\n Matching names... \n")
-    if os.path.exists("../results/names_blocks_xwalk/" + county_code + "_address_names.csv"):
-        county_add_names = pd.read_csv("../results/names_blocks_xwalk/" + county_code + "_address_names.csv", converters={'BLKID': lambda x: str(x)})
-        county_add_names = county_add_names.fillna('')
-        print("\nLoaded pre-built name match: ")
-        print(county_add_names.head(30))
-    else:
+    logger.info("Matching names...")
+    names_path = "../results/names_blocks_xwalk/" + county_code + "_address_names.csv"
+    with instrument.stage('match_names') as record:
         if not os.path.exists("../results/names_blocks_xwalk/"):
             os.mkdir("../results/names_blocks_xwalk/")
-        county_add_names = make_names_table(county_maf, county_tiger_names)
-        county_add_names.to_csv("../results/names_blocks_xwalk/" + county_code + "_address_names.csv")
-    print("\nNames match relationship table: ")
-    print(county_add_names[['MAF_NAME', 'BLKID', 'FULLNAME']].head())
+        compute_names = lambda: make_names_table(county_maf, county_tiger_names, cutoff=cutoff, neighbors=neighbors)
+        if cache is not None:
+            county_add_names = cache.cached('names', compute_names)
+        else:
+            county_add_names = compute_names()
+        if names_cache:
+            county_add_names.to_csv(names_path)
+        record['rows'] = county_add_names.shape[0]
+    logger.debug("Names match relationship table:\n%s", county_add_names[['MAF_NAME', 'BLKID', 'FULLNAME']].head())
+
+    logger.info("Finding possible TLIDs...")
+    with instrument.stage('possible_tlids') as record:
+        county_add_xwalk = name_tlid_table(county_add_names, county_faces, county_edge_face, name_dict=name_dict,
+                                           neighbors=neighbors)
+        county_add_xwalk.loc[:,'OPTIONS'] = county_add_xwalk.apply(lambda row: len(row['TLIDs']), axis=1)
+        record['rows'] = county_add_xwalk.shape[0]
+    needs_geo = county_add_xwalk.loc[county_add_xwalk['OPTIONS'] > 1]
+    instrument.observe_counts('candidate_count', county_add_xwalk['OPTIONS'].value_counts())
+    instrument.set_value('needs_spatial_rate', needs_geo.shape[0]/county_add_xwalk.shape[0])
+    logger.debug("Final results:\n%s", county_add_xwalk[['MAF_NAME', 'BLKID', 'TLIDs']].head())
+    logger.info("Rate needing spatial selection: %s", needs_geo.shape[0]/county_add_xwalk.shape[0])
+    if save_dict:
+        name_dictionary.save_names(name_dict, county_code)
+    return county_add_xwalk
 
-    print("\n Finding possible TLIDs... \n")
 
-    county_add_xwalk = name_tlid_table(county_add_names, county_faces, county_edge_face)
-    print("\n Final results: \n")
-    county_add_xwalk.loc[:,'OPTIONS'] = county_add_xwalk.apply(lambda row: len(row['TLIDs']), axis=1)
-    needs_geo = county_add_xwalk.loc[county_add_xwalk['OPTIONS'] > 1]
-    print(county_add_xwalk[['MAF_NAME', 'BLKID', 'TLIDs']].head())
-    print("\nRate needing spatial selection: ", needs_geo.shape[0]/county_add_xwalk.shape[0])
-    if not os.path.exists("../results/possible_tlids/"):
-        os.mkdir("../results/possible_tlids/")
-    county_add_xwalk.to_csv("../results/possible_tlids/" + county_code + "_address_maf_xwalk.csv")
+def write_xwalk(county_add_xwalk, county_code = '08031'):
+    """
+    Saves the crosswalk as "../results/possible_tlids/[[county_code]]_address_maf_xwalk.csv"
+    """
+    with instrument.stage('write'):
+        if not os.path.exists("../results/possible_tlids/"):
+            os.mkdir("../results/possible_tlids/")
+        county_add_xwalk.to_csv("../results/possible_tlids/" + county_code + "_address_maf_xwalk.csv")
+
+
+def process_county(county_code = '08031', profile=False, use_cache=True, roads_only=True, cutoff=0.5, adjacent=True):
+    """
+    Builds the crosswalk between MAF street name-block combinations and lists of
+    possible TLIDs for a county, saving it as
+    "../results/possible_tlids/[[county_code]]_address_maf_xwalk.csv"
+
+    Parameters
+    ----------
+    county_code: str
+            fips code for county
+    profile: bool
+            if true, times hot functions and samples stacks, writing the results
+            to "../results/profiles/process_county_[[county_code]]*" (see profiling.py)
+    use_cache: bool
+            if true, reuses the name match and crosswalk from the stage cache (see
+            stage_cache.py) when the input files and parameters have not changed
+    roads_only: bool
+            only includes roads in the edge-face table if true
+    cutoff: float
+            minimum difflib similarity score for a name match
+    adjacent: bool
+            if true, names not found along their block are searched for along
+            the adjacent blocks (see build_county_xwalk)
+
+    Returns
+    -------
+    county_add_xwalk: pd DataFrame
+            the crosswalk
+    """
+    with instrument.run('process_county', county_code=county_code), \
+            profiling.profile('process_county_' + county_code, enabled=profile):
+        cache = None
+        county_add_xwalk = None
+        if use_cache:
+            cache = stage_cache.StageCache(county_code, params={'roads_only': roads_only, 'cutoff': cutoff,
+                                                                'adjacent': adjacent})
+            county_add_xwalk = cache.get('xwalk')
+        if county_add_xwalk is None:
+            # Only the addresses and the relationship index are needed, not the edge geometries
+            relations, county_maf = prefetch.run_concurrently(
+                lambda: relation_index.load_county_relations(county_code),
+                lambda: load_addresses(county_code))
+            county_add_xwalk = build_county_xwalk(None, None, county_maf, county_code=county_code,
+                                                  roads_only=roads_only, cutoff=cutoff, cache=cache,
+                                                  relations=relations, adjacent=adjacent)
+            if cache is not None:
+                cache.put('xwalk', county_add_xwalk)
+        write_xwalk(county_add_xwalk, county_code=county_code)
+    return county_add_xwalk
 
 
 if __name__ == "__main__":
+    instrument.configure_logging()
     process_county(county_code = '08031')